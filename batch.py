@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+# Compile many c-minus files at once with a pool of worker processes.
+#
+#   python batch.py src/ extra/*.c -j 8 -o build/
+#
+# Arguments can be files, directories (searched for *.c) or glob patterns.
+# Each worker builds its lexer once and reuses it for every file it gets.
+# With -o the IR of every file goes to <dir>/<relative path>.ir, otherwise
+# all of it is written to one stream in argument order, each file preceded
+# by a "# <path>" line. A file that fails is reported and the rest of the
+# batch carries on. With --cache, files whose source is unchanged since
+# they were last compiled are read back from the compile cache.
+from __future__ import print_function
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+import cache
+import icg
+
+SOURCE_EXTENSION = ".c"
+IR_EXTENSION = ".ir"
+
+def expand_paths(patterns):
+    paths = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found = []
+            for root, dirs, files in os.walk(pattern):
+                found.extend(os.path.join(root, name) for name in files
+                             if name.endswith(SOURCE_EXTENSION))
+        elif os.path.exists(pattern):
+            found = [pattern]
+        else:
+            found = glob.glob(pattern)
+            if not found:
+                raise ValueError("no files match %s" % pattern)
+        for path in sorted(found):
+            path = os.path.normpath(path)
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+def common_directory(paths):
+    # commonprefix on lists of components matches whole directory names
+    parts = [os.path.dirname(os.path.abspath(path)).split(os.sep)
+             for path in paths]
+    return os.sep.join(os.path.commonprefix(parts)) or os.sep
+
+def output_path(output_dir, base_dir, path):
+    relative = os.path.relpath(path, base_dir)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + IR_EXTENSION)
+
+# State of a worker process, set up once by init_worker
+worker = {}
+
+def init_worker(compiled_lexer, pratt, cache_dir=None,
+                max_cache_bytes=None):
+    if compiled_lexer:
+        worker["lexer"] = icg.CompiledLexer(icg.TRANSITIONS_MAP)
+    else:
+        worker["lexer"] = icg.LexicalAnalyzer(icg.TRANSITIONS_MAP)
+    if pratt:
+        worker["generator_class"] = icg.PrattCodeGenerator
+    else:
+        worker["generator_class"] = icg.IntermediateCodeGenerator
+    if cache_dir is not None:
+        worker["cache"] = cache.CompileCache(
+            cache_dir, max_cache_bytes or cache.DEFAULT_MAX_BYTES)
+    else:
+        worker["cache"] = None
+
+def compile_file(path):
+    # Returns (path, ir text or None, error or None, source bytes, whether
+    # the text came from the cache)
+    size = 0
+    try:
+        with open(path) as fhandle:
+            source = fhandle.read()
+        size = len(source)
+        compile_cache = worker["cache"]
+        if compile_cache is None:
+            ir = icg.compile_source(source, worker["lexer"],
+                                    worker["generator_class"])
+            return path, ir.text(), None, size, False
+        hits = compile_cache.hits
+        text = compile_cache.compile(source, worker["lexer"],
+                                     worker["generator_class"])
+        return path, text, None, size, compile_cache.hits > hits
+    except Exception as error:
+        return path, None, "%s: %s" % (type(error).__name__, error), size, \
+            False
+
+def run_batch(paths, jobs=None, compiled_lexer=False, pratt=False,
+              cache_dir=None, max_cache_bytes=None):
+    # Yields the result of every path, in the order of paths
+    init_args = (compiled_lexer, pratt, cache_dir, max_cache_bytes)
+    if jobs == 1:
+        init_worker(*init_args)
+        for path in paths:
+            yield compile_file(path)
+        return
+
+    pool = multiprocessing.Pool(jobs, init_worker, init_args)
+    try:
+        chunksize = max(1, len(paths) // (4 * (jobs or multiprocessing.cpu_count())))
+        for result in pool.imap(compile_file, paths, chunksize):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def write_output(output_dir, base_dir, path, text):
+    target = output_path(output_dir, base_dir, path)
+    directory = os.path.dirname(target)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(target, "w") as fhandle:
+        fhandle.write(text)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate intermediate code for many c-minus files")
+    parser.add_argument("sources", nargs="+",
+                        help="source files, directories or glob patterns")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("-o", "--output-dir",
+                        help="write each file's IR under this directory")
+    parser.add_argument("--compiled-lexer", action="store_true",
+                        help="lex with the precompiled dense DFA tables")
+    parser.add_argument("--pratt", action="store_true",
+                        help="use the precedence climbing expression parser")
+    parser.add_argument("--cache", action="store_true",
+                        help="reuse the code generated for unchanged sources")
+    parser.add_argument("--cache-dir",
+                        help="cache directory (default: $ICG_CACHE_DIR/ir)")
+    parser.add_argument("--cache-size", type=int, metavar="MB",
+                        help="evict the least recently used entries past "
+                             "this size (default: %d)"
+                             % (cache.DEFAULT_MAX_BYTES // (1024 * 1024)))
+    args = parser.parse_args(argv)
+    if args.cache_dir or args.cache_size:
+        args.cache = True
+
+    try:
+        paths = expand_paths(args.sources)
+    except ValueError as error:
+        parser.error(str(error))
+    if not paths:
+        parser.error("no source files found")
+    base_dir = common_directory(paths)
+
+    cache_dir = None
+    if args.cache:
+        cache_dir = args.cache_dir or cache.default_cache_dir()
+    max_cache_bytes = args.cache_size * 1024 * 1024 if args.cache_size else None
+
+    failures = []
+    hits = 0
+    total_bytes = 0
+    total_lines = 0
+    start = time.time()
+    for path, text, error, size, hit in run_batch(
+            paths, args.jobs, args.compiled_lexer, args.pratt, cache_dir,
+            max_cache_bytes):
+        total_bytes += size
+        hits += hit
+        if error is not None:
+            failures.append((path, error))
+            print("%s: failed: %s" % (path, error), file=sys.stderr)
+            continue
+        total_lines += text.count("\n")
+        if args.output_dir:
+            write_output(args.output_dir, base_dir, os.path.abspath(path), text)
+        else:
+            sys.stdout.write("# %s\n" % path)
+            sys.stdout.write(text)
+    elapsed = time.time() - start
+
+    compiled = len(paths) - len(failures)
+    print("%d files compiled, %d failed in %.3f s: %.1f files/s, "
+          "%.1f KB/s of source, %.0f IR lines/s"
+          % (compiled, len(failures), elapsed, len(paths) / elapsed,
+             total_bytes / 1024.0 / elapsed, total_lines / elapsed),
+          file=sys.stderr)
+    if args.cache:
+        lookups = len(paths) - len(failures)
+        print("cache: %d hits, %d misses" % (hits, lookups - hits),
+              file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
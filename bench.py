@@ -0,0 +1,837 @@
+#! /usr/bin/env python
+# Micro benchmarks for icg.py. Run "python bench.py <benchmark> --help"
+# for the options of each benchmark.
+from __future__ import print_function
+import argparse
+import gc
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import icg
+import ir
+import irbin
+import loops
+import optimize
+import parallel
+import synthetic
+import vm
+
+SYNTHETIC_FUNCTION = """
+int f%d(int x, int y)
+{ int a;
+  a = (x + %d) * y - 3;
+  while (a > 0) {
+    if (a < y) a = a - f%d(x, y / 2); else a = a - 1;
+  }
+  return a + x * y;
+}
+"""
+
+def synthetic_source(num_functions):
+    return "".join(SYNTHETIC_FUNCTION % (i, i, i)
+                   for i in range(num_functions))
+
+def synthetic_tokens(num_tokens):
+    # Repeat the synthetic function until there are at least num_tokens
+    lexical_analyzer = icg.LexicalAnalyzer(icg.TRANSITIONS_MAP)
+    tokens_per_function = len(lexical_analyzer.parse(synthetic_source(1)))
+    num_functions = max(1, num_tokens // tokens_per_function)
+    lexical_analyzer = icg.LexicalAnalyzer(icg.TRANSITIONS_MAP)
+    return lexical_analyzer.parse(synthetic_source(num_functions))
+
+def time_codegen(tokens):
+    start = time.time()
+    icg.IntermediateCodeGenerator(tokens).generate_code()
+    return time.time() - start
+
+def bench_scaling(args):
+    # Code generation time for growing token counts. With a linear
+    # token stream the time per token stays flat across sizes.
+    print("%10s %10s %14s" % ("tokens", "seconds", "us/token"))
+    size = args.min
+    while size <= args.max:
+        tokens = synthetic_tokens(size)
+        elapsed = time_codegen(tokens)
+        print("%10d %10.3f %14.3f" % (len(tokens), elapsed,
+                                       elapsed * 1e6 / len(tokens)))
+        size *= 10
+
+def time_lexer(lexer, source, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        lexer.parse(source)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_lexer(args):
+    # Character throughput of the FiniteStateMachine lexer next to the
+    # precompiled dense table lexer, plus the cost of building each one.
+    # The compiled lexer is set up from its disk cache, not from the
+    # tables its process already holds, and compared with building them.
+    source = synthetic_source(args.functions)
+
+    def setup_fsm():
+        return icg.LexicalAnalyzer(icg.TRANSITIONS_MAP)
+    def setup_compiled():
+        icg.CompiledLexer.loaded_tables.clear()
+        return icg.CompiledLexer(icg.TRANSITIONS_MAP)
+
+    print("%-10s %12s %12s %14s" % ("lexer", "setup ms", "seconds", "chars/s"))
+    for name, setup in (("fsm", setup_fsm), ("compiled", setup_compiled)):
+        lexer = setup()
+        elapsed = time_lexer(lexer, source, args.repeat)
+        print("%-10s %12.3f %12.3f %14.0f" % (
+            name, best_time(setup, args.repeat) * 1000, elapsed,
+            len(source) / elapsed))
+    build = best_time(
+        lambda: icg.CompiledLexer.build_tables(icg.TRANSITIONS_MAP),
+        args.repeat)
+    print("building the compiled tables without the cache: %.3f ms"
+          % (build * 1000))
+
+class DictToken:
+    # The Token layout before kinds and __slots__, kept for comparison
+    def __init__(self, type, value, start=-1, end=-1, line=0, column=0):
+        self.type = type
+        self.value = value
+        self.start = start
+        self.end = end
+        self.line = line
+        self.column = column
+
+def bytes_per_token(tokens, factory):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        copies = [factory(token) for token in tokens]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return float(after - before) / len(copies)
+
+def bench_tokens(args):
+    # Memory per token and the cost of classifying a token, by operator
+    # equality against the @ny wildcard tokens or by a kind mask test
+    tokens = synthetic_tokens(args.tokens)
+
+    print("%-28s %12s" % ("layout", "bytes/token"))
+    print("%-28s %12.1f" % ("dict (type strings)", bytes_per_token(
+        tokens, lambda t: DictToken(t.type, t.value, t.start, t.end,
+                                    t.line, t.column))))
+    print("%-28s %12.1f" % ("__slots__ (int kinds)", bytes_per_token(
+        tokens, lambda t: icg.Token(t.kind, t.value, t.start, t.end,
+                                    t.line, t.column))))
+
+    operators = (icg.REL_OP_TOKEN, icg.ADD_OP_TOKEN, icg.MUL_OP_TOKEN,
+                 icg.OPEN_PAREN_TOKEN, icg.CLOSE_PAREN_TOKEN)
+    mask = icg.EXPRESSION_OPERATOR_KINDS
+
+    def by_equality():
+        for token in tokens:
+            token in operators
+
+    def by_mask():
+        for token in tokens:
+            (1 << token.kind) & mask
+
+    print()
+    print("%-28s %12s" % ("operator test", "ns/token"))
+    for name, function in (("__eq__ against @ny tokens", by_equality),
+                           ("kind mask", by_mask)):
+        elapsed = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        print("%-28s %12.1f" % (name, elapsed * 1e9 / len(tokens)))
+
+class QuadraticPostfixGenerator(icg.IntermediateCodeGenerator):
+    # Reduces postfix lists the way expand_simple_expression used to, by
+    # rescanning the list for its first operator after every triplet.
+    # The stress benchmark times it and tests/test_expressions.py checks
+    # the generator against it.
+
+    def emit_postfix(self, postfix, temp=None):
+        if len(postfix) == 1:
+            return icg.IntermediateCodeGenerator.emit_postfix(
+                self, postfix, temp)
+
+        while set(postfix) & set(icg.all_operators):
+            first_op_i = icg.index_if(postfix, lambda x: x in icg.all_operators)
+            temp = self.get_temp()
+            left = postfix[first_op_i - 2]
+            op = postfix[first_op_i]
+            right = postfix[first_op_i - 1]
+            self.produce_triplet(temp, "=", left, op, right)
+
+            postfix = postfix[:first_op_i - 2] + [temp] + postfix[first_op_i + 1:]
+
+        return temp
+
+def long_expression(num_operators, rng):
+    # Flat chain of operators over numbers, ids and calls
+    operators = ("+", "-", "*", "/", "<", ">", "==")
+    parts = [str(rng.randint(0, 9))]
+    for i in range(num_operators):
+        parts.append(rng.choice(operators))
+        if i % 50 == 0:
+            parts.append("f(x, %d)" % i)
+        else:
+            parts.append(rng.choice(("x", "y", str(i))))
+    return " ".join(parts)
+
+def nested_expression(num_operators, rng):
+    # Each operator opens a parenthesis that closes at the very end, like
+    # the parenthesised operands of complicated.c taken to depth
+    operators = ("+", "-", "*", "/")
+    text = []
+    for i in range(num_operators):
+        text.append("(%s %s " % (rng.choice(("x", "y", str(i))),
+                                 rng.choice(operators)))
+    text.append("fact(x - 1)")
+    text.append(")" * num_operators)
+    return "".join(text)
+
+def expression_program(expression):
+    return ("int f(int x, int y)\n{ int z;\n  z = %s;\n"
+            "  while (%s) z = z - 1;\n  return z;\n}\n"
+            % (expression, expression))
+
+def generate(generator_class, source):
+    tokens = icg.CompiledLexer(icg.TRANSITIONS_MAP).parse(source)
+    codegen = generator_class(tokens)
+    start = time.time()
+    codegen.generate_code()
+    return codegen.ir.text(), time.time() - start
+
+def bench_stress(args):
+    # Code generation for expressions with thousands of operators, next to
+    # the quadratic reduction for sizes up to --reference-max
+    rng = random.Random(args.seed)
+    print("%-8s %10s %10s %12s" % ("shape", "operators", "seconds",
+                                  "reference"))
+    for size in args.sizes:
+        for shape, build in (("flat", long_expression),
+                             ("nested", nested_expression)):
+            source = expression_program(build(size, rng))
+            elapsed = generate(icg.IntermediateCodeGenerator, source)[1]
+            reference = "-"
+            if size <= args.reference_max:
+                reference = "%.3f" % generate(QuadraticPostfixGenerator,
+                                              source)[1]
+            print("%-8s %10d %10.3f %12s" % (shape, size, elapsed, reference))
+
+def bench_expressions(args):
+    # Tokens per second of the postfix and Pratt expression engines on
+    # expression heavy sources
+    rng = random.Random(args.seed)
+    with open(os.path.join(os.path.dirname(ICG_PATH), "complicated.c")) as fhandle:
+        complicated = fhandle.read()
+    inputs = (
+        ("flat", expression_program(long_expression(args.operators, rng))),
+        ("nested", "".join(expression_program(nested_expression(args.depth, rng))
+                           for _ in range(args.operators // args.depth))),
+        ("complicated.c", complicated * args.copies),
+    )
+
+    print("%-14s %10s %14s %14s" % ("input", "tokens", "postfix tok/s",
+                                    "pratt tok/s"))
+    for name, source in inputs:
+        tokens = icg.CompiledLexer(icg.TRANSITIONS_MAP).parse(source)
+        rates = []
+        for generator_class in (icg.IntermediateCodeGenerator,
+                                icg.PrattCodeGenerator):
+            elapsed = min(generate(generator_class, source)[1]
+                          for _ in range(args.repeat))
+            rates.append(len(tokens) / elapsed)
+        print("%-14s %10d %14.0f %14.0f" % (name, len(tokens),
+                                            rates[0], rates[1]))
+
+# Runs a script and reports its peak resident set size in KB on stderr
+MAXRSS_WRAPPER = """
+import resource, runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    sys.stderr.write("%d\\n" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+ICG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "icg.py")
+
+def peak_rss_kb(argv):
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(
+            [sys.executable, "-c", MAXRSS_WRAPPER] + argv,
+            stdout=devnull, stderr=subprocess.PIPE, universal_newlines=True)
+        _, stderr = process.communicate()
+    if process.returncode:
+        raise RuntimeError(stderr)
+    peak = int(stderr.strip().splitlines()[-1])
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+def write_synthetic_file(path, size):
+    # Write whole synthetic functions until the file reaches size bytes
+    with open(path, "w") as fhandle:
+        written = 0
+        i = 0
+        while written < size:
+            function = SYNTHETIC_FUNCTION % (i, i, i)
+            fhandle.write(function)
+            written += len(function)
+            i += 1
+
+def bench_stream(args):
+    # Peak memory of a whole-file compile next to a streaming one for
+    # growing source files. The streaming column should stay flat.
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print("%10s %14s %14s" % ("MB", "whole KB", "stream KB"))
+        for size in args.sizes:
+            path = os.path.join(temp_dir, "synthetic-%d.c" % size)
+            write_synthetic_file(path, size * 1024 * 1024)
+            whole = peak_rss_kb([ICG_PATH, "--compiled-lexer", path])
+            stream = peak_rss_kb([ICG_PATH, "--compiled-lexer", "--stream", path])
+            print("%10d %14d %14d" % (size, whole, stream))
+    finally:
+        shutil.rmtree(temp_dir)
+
+def bench_parallel(args):
+    # Code generation for one file with many functions, serially and with
+    # growing numbers of worker processes. Speedup is against the serial
+    # compile; efficiency is speedup / jobs.
+    source = synthetic_source(args.functions)
+    lexer = icg.LexicalAnalyzer(icg.TRANSITIONS_MAP)
+
+    start = time.time()
+    icg.compile_source(source, lexer)
+    serial = time.time() - start
+
+    print("%6s %10s %10s %12s" % ("jobs", "seconds", "speedup", "efficiency"))
+    print("%6s %10.3f %10.2f %12s" % ("serial", serial, 1.0, "-"))
+    for jobs in args.jobs:
+        start = time.time()
+        parallel.compile_parallel(source, jobs)
+        elapsed = time.time() - start
+        print("%6d %10.3f %10.2f %11.0f%%" % (jobs, elapsed, serial / elapsed,
+                                              100 * serial / elapsed / jobs))
+
+FACT_SOURCE = """int fact(int n)
+{
+if (n < 2) {
+return 1;
+}
+return n * fact(n - 1);
+}
+
+int main()
+{ int i;
+ int s;
+i = 0;
+s = 0;
+while (i < %d) {
+s = s + fact(%d) / 1000;
+i = i + 1;
+}
+return s;
+}
+"""
+
+def bench_vm(args):
+    # IR instructions executed per second by the interpreter, for the
+    # recursive fact at every optimization level
+    source = FACT_SOURCE % (args.iterations, args.n)
+    unoptimized = icg.compile_source(source,
+                                     icg.LexicalAnalyzer(icg.TRANSITIONS_MAP))
+    print("%6s %12s %10s %14s" % ("level", "executed", "seconds", "ops/second"))
+    for level in sorted(optimize.LEVELS):
+        buffer = optimize.Optimizer(level).optimize(unoptimized)
+        counts = vm.VM(buffer).run_counted()[1]
+        machine = vm.VM(buffer)
+        start = time.time()
+        machine.run()
+        elapsed = time.time() - start
+        executed = sum(counts)
+        print("%6s %12d %10.3f %14.0f" % ("-O%d" % level, executed, elapsed,
+                                          executed / elapsed))
+
+LOOPS_SOURCE = """int main()
+{ int n;
+ int i;
+ int j;
+ int s;
+n = %d;
+s = 0;
+i = 0;
+while (i < n) {
+j = 0;
+while (j < n) {
+s = s + i * n + j * 4 + (n - 1) * (n + 1) / 2;
+j = j + 1;
+}
+i = i + 1;
+}
+return s;
+}
+"""
+
+def bench_loops(args):
+    # Instructions and multiplies executed in nested loops and run time,
+    # with and without the loop optimizations
+    source = LOOPS_SOURCE % args.n
+    unoptimized = icg.compile_source(source,
+                                     icg.LexicalAnalyzer(icg.TRANSITIONS_MAP))
+    versions = (("-O%d" % args.level, unoptimized),
+                ("--loops -O%d" % args.level, loops.optimize_loops(unoptimized)))
+    print("%-14s %12s %12s %10s" % ("options", "executed", "multiplies",
+                                    "seconds"))
+    for name, buffer in versions:
+        buffer = optimize.Optimizer(args.level).optimize(buffer)
+        machine = vm.VM(buffer)
+        counts = machine.run_counted()[1]
+        multiplies = sum(count for pc, count in enumerate(counts)
+                         if machine.instructions[machine.positions[pc]].opcode
+                         == ir.MUL)
+        machine = vm.VM(buffer)
+        start = time.time()
+        machine.run()
+        elapsed = time.time() - start
+        print("%-14s %12d %12d %10.3f" % (name, sum(counts), multiplies,
+                                          elapsed))
+
+# Sizes of the synthetic programs of the suite. Each axis is scaled by
+# the factors in turn while the others keep these values.
+SUITE_SIZES = {"functions": 40, "statements": 20, "depth": 4,
+               "expression": 8, "fan_out": 2}
+SUITE_FACTORS = (1, 2, 4, 8)
+
+# For every metric, whether a larger value is better
+SUITE_METRICS = {"tokens_per_second": True, "lines_per_second": True,
+                 "peak_kb": False, "exponent": False}
+
+def measure(source, repeat):
+    # Best of repeat lexes and code generations, with the garbage
+    # collector off like timeit does, then one more of both under
+    # tracemalloc for the peak memory
+    lex_seconds = codegen_seconds = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.time()
+            tokens = icg.LexicalAnalyzer(icg.TRANSITIONS_MAP).parse(source)
+            middle = time.time()
+            buffer = icg.IRBuffer()
+            icg.IntermediateCodeGenerator(tokens, buffer).generate_code()
+            end = time.time()
+        finally:
+            gc.enable()
+        if lex_seconds is None or middle - start < lex_seconds:
+            lex_seconds = middle - start
+        if codegen_seconds is None or end - middle < codegen_seconds:
+            codegen_seconds = end - middle
+    num_tokens, lines = len(tokens), len(buffer)
+    del tokens, buffer
+
+    tracemalloc.start()
+    try:
+        tokens = icg.LexicalAnalyzer(icg.TRANSITIONS_MAP).parse(source)
+        icg.IntermediateCodeGenerator(tokens, icg.IRBuffer()).generate_code()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"tokens": num_tokens, "lines": lines,
+            "lex_seconds": lex_seconds, "codegen_seconds": codegen_seconds,
+            "tokens_per_second": num_tokens / lex_seconds,
+            "lines_per_second": lines / codegen_seconds,
+            "peak_kb": peak // 1024}
+
+def scaling_exponent(sizes, seconds):
+    # Slope of log(seconds) against log(size) by least squares: 1 for
+    # linear time, 2 for quadratic
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(value, 1e-9)) for value in seconds]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if not variance:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+def run_suite(axes, seed, repeat):
+    results = {"version": 1, "seed": seed, "axes": {}}
+    print("%-11s %6s %8s %8s %12s %12s %9s" % (
+        "axis", "size", "tokens", "lines", "tokens/s", "lines/s", "peak KB"))
+    for axis in axes:
+        runs = []
+        for factor in SUITE_FACTORS:
+            sizes = dict(SUITE_SIZES)
+            sizes[axis] = SUITE_SIZES[axis] * factor
+            run = measure(synthetic.generate(seed, **sizes), repeat)
+            run["size"] = sizes[axis]
+            runs.append(run)
+            print("%-11s %6d %8d %8d %12.0f %12.0f %9d" % (
+                axis, run["size"], run["tokens"], run["lines"],
+                run["tokens_per_second"], run["lines_per_second"],
+                run["peak_kb"]))
+        exponent = scaling_exponent(
+            [run["size"] for run in runs],
+            [run["lex_seconds"] + run["codegen_seconds"] for run in runs])
+        print("%-11s exponent %.2f" % (axis, exponent))
+        results["axes"][axis] = {"runs": runs, "exponent": exponent}
+    return results
+
+def regressions(results, baseline, threshold):
+    # Descriptions of every metric that is worse than in baseline by more
+    # than threshold, as a fraction of the baseline value
+    found = []
+    def check(name, metric, value, expected):
+        if SUITE_METRICS[metric]:
+            worse = value < expected * (1 - threshold)
+        else:
+            worse = value > expected * (1 + threshold)
+        if worse:
+            found.append("%s %s: %.4g, baseline %.4g" % (name, metric, value,
+                                                         expected))
+
+    for axis, result in sorted(results["axes"].items()):
+        expected = baseline.get("axes", {}).get(axis)
+        if expected is None:
+            continue
+        check(axis, "exponent", result["exponent"], expected["exponent"])
+        expected_runs = dict((run["size"], run) for run in expected["runs"])
+        for run in result["runs"]:
+            expected_run = expected_runs.get(run["size"])
+            if expected_run is None:
+                continue
+            for metric in ("tokens_per_second", "lines_per_second", "peak_kb"):
+                check("%s=%d" % (axis, run["size"]), metric, run[metric],
+                      expected_run[metric])
+    return found
+
+def bench_suite(args):
+    # Lexer and code generator throughput, peak memory and scaling
+    # exponent along every axis of the synthetic programs
+    results = run_suite(args.axes or synthetic.AXES, args.seed, args.repeat)
+    if args.output:
+        with open(args.output, "w") as fhandle:
+            json.dump(results, fhandle, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fhandle:
+            baseline = json.load(fhandle)
+        for regression in regressions(results, baseline, args.threshold):
+            print("regression: " + regression)
+
+# Sources nesting one construct depth times, for the depth benchmark and
+# tests/test_depth.py, with the value of x they leave for that depth.
+# Every level of nesting adds one to x, except for chained assignments.
+NESTED_SHAPES = (
+    ("blocks", lambda depth: "{ x = x + 1; " * depth + "}" * depth,
+     lambda depth: depth),
+    ("if", lambda depth: "if (x < %d) { x = x + 1; " % depth * depth
+     + "}" * depth, lambda depth: depth),
+    ("while", lambda depth: "while (x < %d) { x = x + 1; " % depth * depth
+     + "}" * depth, lambda depth: depth),
+    ("else", lambda depth: "if (x < 0) x = 0; else { x = x + 1; " * depth
+     + "}" * depth, lambda depth: depth),
+    ("calls", lambda depth: "x = " + "f(" * depth + "x" + ")" * depth + ";",
+     lambda depth: depth),
+    ("parens", lambda depth: "x = " + "(1 + " * depth + "x" + ")" * depth
+     + ";", lambda depth: depth),
+    ("assignments", lambda depth: "x = " * depth + "x + 1;",
+     lambda depth: 1),
+)
+
+def nested_program(body):
+    return "int f(int a)\n{\n  return a + 1;\n}\n\nint main(void)\n" \
+           "{ int x;\n  x = 0;\n" + body + "\n  return x;\n}\n"
+
+def bench_depth(args):
+    # Code generation for deeply nested sources by the iterative generator,
+    # and whether the recursive one survives them
+    lexer = icg.CompiledLexer(icg.TRANSITIONS_MAP)
+    print("%-12s %8s %10s %10s %16s" % ("shape", "depth", "lines", "seconds",
+                                       "recursive"))
+    for name, build, _ in NESTED_SHAPES:
+        tokens = lexer.parse(nested_program(build(args.depth)))
+        start = time.time()
+        ir = icg.IRBuffer()
+        icg.IterativeCodeGenerator(tokens, ir).generate_code()
+        elapsed = time.time() - start
+        try:
+            icg.IntermediateCodeGenerator(tokens, icg.IRBuffer()).generate_code()
+            recursive = "ok"
+        except RuntimeError:
+            # RecursionError, a RuntimeError before Python 3.5
+            recursive = "RecursionError"
+        print("%-12s %8d %10d %10.3f %16s" % (name, args.depth, len(ir),
+                                              elapsed, recursive))
+
+NESTED_CALLS_SOURCE = """int f(int a)
+{
+  return a + 1;
+}
+
+int main(void)
+{ int x;
+  x = %s1%s;
+  x = %sx + 1;
+  return x;
+}
+"""
+
+def bench_nesting(args):
+    # Expressions nested args.depth deep, compiled by the iterative
+    # generator under the default recursion limit and run. The nested
+    # calls of f add depth to 1 and the chained assignment adds one more.
+    source = NESTED_CALLS_SOURCE % ("f(" * args.depth, ")" * args.depth,
+                                    "x = " * args.depth)
+    start = time.time()
+    buffer = icg.compile_source(source, icg.CompiledLexer(icg.TRANSITIONS_MAP),
+                                icg.IterativeCodeGenerator)
+    elapsed = time.time() - start
+    start = time.time()
+    result = vm.VM(buffer).run()
+    print("depth %d, recursion limit %d: %d instructions in %.3f s, "
+          "returns %d in %.3f s" % (args.depth, sys.getrecursionlimit(),
+                                    len(buffer), elapsed, result,
+                                    time.time() - start))
+
+def write_large_function(path, size):
+    # Write a single function of about size bytes
+    with open(path, "w") as fhandle:
+        fhandle.write("int f(int x, int y)\n{ int a;\n")
+        written = 0
+        i = 0
+        while written < size:
+            statement = "  if (a < y) a = (x + %d) * y - a / 3; else a = a - 1;\n" % i
+            fhandle.write(statement)
+            written += len(statement)
+            i += 1
+        fhandle.write("  return a;\n}\n")
+
+def traced_stream_peak_kb(path):
+    # Peak of the memory allocated by Python during a streaming compile,
+    # finer grained than the RSS, which the interpreter itself dominates
+    with open(os.devnull, "w") as devnull:
+        tracemalloc.start()
+        try:
+            tokens = icg.CompiledLexer(icg.TRANSITIONS_MAP).tokenize(
+                icg.read_chunks(path))
+            icg.IntermediateCodeGenerator(
+                tokens, icg.IRBuffer(sink=devnull)).generate_code()
+            return tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+
+def bench_memory(args):
+    # Peak memory of streaming compiles, for growing files of small
+    # functions and for one growing function. The first should stay flat:
+    # memory depends on the largest function, not on the size of the file
+    # (tests/test_stream.py checks that one function is held at a time).
+    # The traced peak of one file varies by some 500 KB from run to run,
+    # so it is reported as a slope between the smallest and largest file:
+    # without flushing per function it grows by about 19 MB per MB.
+    if len(set(args.sizes)) < 2:
+        sys.exit("memory needs at least two sizes of files of small functions")
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print("%-10s %10s %12s %12s" % ("input", "MB", "RSS KB", "traced KB"))
+        small = []
+        for kind, sizes, write in (
+                ("functions", args.sizes, write_synthetic_file),
+                ("function", args.function_sizes, write_large_function)):
+            for size in sizes:
+                path = os.path.join(temp_dir, "%s-%g.c" % (kind, size))
+                write(path, int(size * 1024 * 1024))
+                rss = peak_rss_kb([ICG_PATH, "--compiled-lexer", "--stream",
+                                   path])
+                traced = traced_stream_peak_kb(path)
+                if kind == "functions":
+                    small.append((size, traced))
+                print("%-10s %10g %12d %12d" % (kind, size, rss, traced))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    (first_size, first_peak), (last_size, last_peak) = min(small), max(small)
+    growth = float(last_peak - first_peak) / (last_size - first_size)
+    print("traced peak grows %.0f KB per MB from the smallest to the largest "
+          "file of small functions" % growth)
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_binary(args):
+    # Size and load time of the text and binary IR of a synthetic program:
+    # parsing the text, loading all of the binary file, opening it and
+    # reading one function, and reading every instruction lazily
+    source = synthetic.generate(args.seed, functions=args.functions)
+    buffer = icg.compile_source(source, icg.CompiledLexer(icg.TRANSITIONS_MAP))
+    temp_dir = tempfile.mkdtemp()
+    try:
+        text_path = os.path.join(temp_dir, "program.ir")
+        binary_path = os.path.join(temp_dir, "program.irb")
+        with open(text_path, "w") as fhandle:
+            buffer.write(fhandle)
+        irbin.write(buffer, binary_path)
+
+        def parse_text():
+            with open(text_path) as fhandle:
+                return icg.IRBuffer.parse(fhandle)
+        def load_binary():
+            return irbin.load(binary_path)
+        middle = "f%d" % (args.functions // 2)
+        def one_function():
+            with irbin.BinaryIR(binary_path) as reader:
+                return reader.function(middle)
+        def lazy_iteration():
+            with irbin.BinaryIR(binary_path) as reader:
+                for instruction in reader:
+                    pass
+
+        print("%d instructions" % len(buffer))
+        print("%-16s %12s %10s" % ("", "bytes", "seconds"))
+        print("%-16s %12d %10.4f" % ("text parse", os.path.getsize(text_path),
+                                     best_time(parse_text, args.repeat)))
+        binary_size = os.path.getsize(binary_path)
+        for name, function in (("binary load", load_binary),
+                               ("binary function", one_function),
+                               ("binary lazy", lazy_iteration)):
+            print("%-16s %12d %10.4f" % (name, binary_size,
+                                         best_time(function, args.repeat)))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    scaling = subparsers.add_parser(
+        "scaling", help="code generation time from 1K to 1M tokens")
+    scaling.add_argument("--min", type=int, default=1000)
+    scaling.add_argument("--max", type=int, default=1000000)
+    scaling.set_defaults(run=bench_scaling)
+
+    lexer = subparsers.add_parser(
+        "lexer", help="characters per second of each lexer")
+    lexer.add_argument("--functions", type=int, default=2000)
+    lexer.add_argument("--repeat", type=int, default=3)
+    lexer.set_defaults(run=bench_lexer)
+
+    stream = subparsers.add_parser(
+        "stream", help="peak memory of streaming and whole-file compiles")
+    stream.add_argument("sizes", type=int, nargs="*", default=[1, 4, 16],
+                        help="source sizes in MB")
+    stream.set_defaults(run=bench_stream)
+
+    tokens = subparsers.add_parser(
+        "tokens", help="memory per token and token classification cost")
+    tokens.add_argument("--tokens", type=int, default=100000)
+    tokens.add_argument("--repeat", type=int, default=5)
+    tokens.set_defaults(run=bench_tokens)
+
+    stress = subparsers.add_parser(
+        "stress", help="expressions with thousands of operators")
+    stress.add_argument("sizes", type=int, nargs="*",
+                        default=[1000, 10000, 50000])
+    stress.add_argument("--reference-max", type=int, default=10000,
+                        help="largest size timed with the quadratic "
+                             "reduction")
+    stress.add_argument("--seed", type=int, default=0)
+    stress.set_defaults(run=bench_stress)
+
+    expressions = subparsers.add_parser(
+        "expressions", help="postfix against Pratt expression engine")
+    expressions.add_argument("--operators", type=int, default=20000)
+    expressions.add_argument("--depth", type=int, default=50,
+                             help="parenthesis depth of the nested input")
+    expressions.add_argument("--copies", type=int, default=500,
+                             help="copies of complicated.c")
+    expressions.add_argument("--repeat", type=int, default=3)
+    expressions.add_argument("--seed", type=int, default=0)
+    expressions.set_defaults(run=bench_expressions)
+
+    parallel_ = subparsers.add_parser(
+        "parallel", help="per-function code generation on several processes")
+    parallel_.add_argument("--functions", type=int, default=5000)
+    parallel_.add_argument("jobs", type=int, nargs="*", default=[1, 2, 4, 8])
+    parallel_.set_defaults(run=bench_parallel)
+
+    vm_ = subparsers.add_parser(
+        "vm", help="IR instructions per second of the interpreter")
+    vm_.add_argument("--iterations", type=int, default=20000)
+    vm_.add_argument("-n", type=int, default=12, help="argument of fact")
+    vm_.set_defaults(run=bench_vm)
+
+    loops_ = subparsers.add_parser(
+        "loops", help="instructions executed in loops with and without "
+                      "--loops")
+    loops_.add_argument("-n", type=int, default=300,
+                        help="iterations of both nested loops")
+    loops_.add_argument("-O", dest="level", type=int, default=2,
+                        choices=(0, 1, 2))
+    loops_.set_defaults(run=bench_loops)
+
+    depth = subparsers.add_parser(
+        "depth", help="iterative code generation for deeply nested sources")
+    depth.add_argument("--depth", type=int, default=100000)
+    depth.set_defaults(run=bench_depth)
+
+    nesting = subparsers.add_parser(
+        "nesting", help="deeply nested expressions compile and run")
+    nesting.add_argument("--depth", type=int, default=100000)
+    nesting.set_defaults(run=bench_nesting)
+
+    memory = subparsers.add_parser(
+        "memory", help="peak memory of streaming compiles against file and "
+                       "function size")
+    memory.add_argument("sizes", type=float, nargs="*", default=[1, 2, 4],
+                        help="sizes in MB of the files of small functions")
+    memory.add_argument("--function-sizes", type=float, nargs="*",
+                        default=[0.25, 0.5, 1],
+                        help="sizes in MB of the single function files")
+    memory.set_defaults(run=bench_memory)
+
+    binary = subparsers.add_parser(
+        "binary", help="size and load time of text and binary IR")
+    binary.add_argument("--functions", type=int, default=2000)
+    binary.add_argument("--repeat", type=int, default=3)
+    binary.add_argument("--seed", type=int, default=0)
+    binary.set_defaults(run=bench_binary)
+
+    suite = subparsers.add_parser(
+        "suite", help="throughput, memory and scaling on synthetic programs")
+    suite.add_argument("--axis", dest="axes", action="append",
+                       choices=synthetic.AXES,
+                       help="axis to scale, can be repeated (default: all)")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--repeat", type=int, default=3)
+    suite.add_argument("-o", "--output", metavar="JSON",
+                       help="save the results")
+    suite.add_argument("--baseline", metavar="JSON",
+                       help="results to compare with, the metrics that "
+                            "regressed are listed")
+    suite.add_argument("--threshold", type=float, default=0.25,
+                       help="allowed regression as a fraction of the "
+                            "baseline (default: 0.25)")
+    suite.set_defaults(run=bench_suite)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,164 @@
+# On-disk cache of generated code, keyed by the contents of the source.
+#
+# An entry is found by the sha256 of the compiler version, the code
+# generator used and the source text, so a hit needs neither lexing nor
+# code generation. Entries are written to a temporary file and renamed
+# into place, which lets concurrent batch workers share one cache. A hit
+# refreshes the entry's mtime and, when the cache grows past its size cap,
+# the entries with the oldest mtimes are evicted first.
+from __future__ import print_function
+import hashlib
+import marshal
+import os
+import tempfile
+
+import icg
+
+# Bump when the layout of the entries or the code generated for the same
+# source changes
+CACHE_VERSION = 4
+
+IR_SUFFIX = ".ir"
+TOKENS_SUFFIX = ".tok"
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+def default_cache_dir():
+    return os.path.join(icg.get_cache_dir(), "ir")
+
+def cache_key(source, generator_class=icg.IntermediateCodeGenerator,
+              options=""):
+    # options stands for any other setting that changes the output
+    digest = hashlib.sha256()
+    digest.update(("%s\0%d\0%s\0%s\0" % (icg.__version__, CACHE_VERSION,
+                                         generator_class.__name__,
+                                         options)).encode("utf-8"))
+    digest.update(source.encode("utf-8"))
+    return digest.hexdigest()
+
+class CompileCache:
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES,
+                 store_tokens=False):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.store_tokens = store_tokens
+        # Bytes in the cache as far as this process knows, None until the
+        # first store scans the directory
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+
+    def read(self, key, suffix):
+        path = self.path(key, suffix)
+        try:
+            with open(path, "rb") as fhandle:
+                data = fhandle.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def write(self, key, suffix, data):
+        # Failing to cache is not an error
+        path = self.path(key, suffix)
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "wb") as fhandle:
+                fhandle.write(data)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            return
+        self.stores += 1
+        if self.size is None:
+            self.size = self.disk_usage()
+        else:
+            self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def get(self, key):
+        data = self.read(key, IR_SUFFIX)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data.decode("utf-8")
+
+    def put(self, key, text, tokens=None):
+        self.write(key, IR_SUFFIX, text.encode("utf-8"))
+        if self.store_tokens and tokens is not None:
+            self.write(key, TOKENS_SUFFIX, marshal.dumps(
+                [(token.kind, token.value, token.start, token.end, token.line,
+                  token.column) for token in tokens]))
+
+    def get_tokens(self, key):
+        data = self.read(key, TOKENS_SUFFIX)
+        if data is None:
+            return None
+        return [icg.Token(*fields) for fields in marshal.loads(data)]
+
+    def entries(self):
+        # (mtime, size, path) of every file in the cache
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def disk_usage(self):
+        return sum(size for mtime, size, path in self.entries())
+
+    def evict(self):
+        # Remove the least recently used files until the cache is back
+        # under its cap
+        entries = sorted(self.entries())
+        size = sum(size for mtime, size, path in entries)
+        for mtime, file_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= file_size
+            self.evictions += 1
+        self.size = size
+
+    def compile(self, source, lexical_analyzer,
+                generator_class=icg.IntermediateCodeGenerator):
+        # Returns the IR text of source, from the cache when possible
+        key = cache_key(source, generator_class)
+        text = self.get(key)
+        if text is not None:
+            return text
+        tokens = lexical_analyzer.parse(source)
+        ir = icg.IRBuffer()
+        generator_class(tokens, ir).generate_code()
+        text = ir.text()
+        self.put(key, text, tokens)
+        return text
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "stores": self.stores, "evictions": self.evictions}
+
+    def stats_line(self):
+        lookups = self.hits + self.misses
+        return "cache: %d hits, %d misses (%.0f%% hit rate), %d stores, " \
+               "%d evictions" % (self.hits, self.misses,
+                                 100.0 * self.hits / lookups if lookups else 0,
+                                 self.stores, self.evictions)
@@ -0,0 +1,230 @@
+# Control flow graph of the generated intermediate code.
+#
+# Every function (entry ... exit) is split into basic blocks: a block
+# starts at a Label, after a goto, if_false or return, and exit always
+# gets a block of its own. simplify cleans up the jumps the generator
+# leaves behind, until nothing changes:
+#
+#   if_false on a constant    dropped, or turned into a goto
+#   jump threading            a jump to a label whose block is empty or
+#                             only a goto jumps to the final target
+#   branch to next            a jump to the block that follows anyway is
+#                             dropped
+#   unreachable blocks        dropped; the exit block is always kept
+#   unused labels             dropped, which merges blocks that were only
+#                             separated by them
+from __future__ import print_function
+
+import ir
+
+JUMPS = frozenset((ir.GOTO, ir.IF_FALSE))
+# Instructions after which control does not reach the next instruction
+NO_FALLTHROUGH = frozenset((ir.GOTO, ir.RETURN, ir.EXIT))
+BLOCK_ENDS = frozenset((ir.GOTO, ir.IF_FALSE, ir.RETURN))
+
+def jump_target(instruction):
+    if instruction.opcode == ir.GOTO:
+        return instruction.a
+    elif instruction.opcode == ir.IF_FALSE:
+        return instruction.b
+    return None
+
+def retarget(instruction, label):
+    if instruction.opcode == ir.GOTO:
+        return instruction._replace(a=label)
+    return instruction._replace(b=label)
+
+def block_label(block):
+    if block[0].opcode == ir.LABEL:
+        return block[0].a
+    return None
+
+def split_functions(instructions):
+    # Lists of the instructions of every function, entry to exit
+    functions = []
+    current = None
+    for instruction in instructions:
+        if instruction.opcode == ir.ENTRY or current is None:
+            current = []
+            functions.append(current)
+        current.append(instruction)
+    return functions
+
+def split_blocks(instructions):
+    blocks = []
+    block = []
+    for instruction in instructions:
+        if block and instruction.opcode in (ir.LABEL, ir.EXIT):
+            blocks.append(block)
+            block = []
+        block.append(instruction)
+        if instruction.opcode in BLOCK_ENDS:
+            blocks.append(block)
+            block = []
+    if block:
+        blocks.append(block)
+    return blocks
+
+def successors(blocks, labels, i):
+    # Indexes of the blocks control can go to after block i, the jump
+    # target last
+    last = blocks[i][-1]
+    following = []
+    if last.opcode not in NO_FALLTHROUGH and i + 1 < len(blocks):
+        following.append(i + 1)
+    target = jump_target(last)
+    if target is not None and target in labels:
+        following.append(labels[target])
+    return following
+
+def label_map(blocks):
+    return dict((block_label(block), i) for i, block in enumerate(blocks)
+                if block_label(block) is not None)
+
+class Simplifier:
+
+    def __init__(self):
+        # How often each simplification was applied
+        self.stats = {"folded": 0, "threaded": 0, "branches": 0,
+                      "unreachable": 0, "labels": 0}
+
+    def simplify(self, instructions):
+        simplified = []
+        for function in split_functions(instructions):
+            simplified.extend(self.simplify_function(function))
+        return simplified
+
+    def simplify_function(self, instructions):
+        while True:
+            # A block left empty by a pass just falls through to the next
+            # one, so it can be dropped
+            blocks = split_blocks(instructions)
+            self.fold_branches(blocks)
+            blocks = [block for block in blocks if block]
+            self.thread_jumps(blocks)
+            self.remove_branches_to_next(blocks)
+            blocks = self.remove_unreachable([block for block in blocks if block])
+            simplified = self.remove_unused_labels(
+                [instruction for block in blocks for instruction in block])
+            if simplified == instructions:
+                return simplified
+            instructions = simplified
+
+    def fold_branches(self, blocks):
+        for block in blocks:
+            last = block[-1]
+            if (last.opcode == ir.IF_FALSE and last.a is not None
+                    and last.a.lstrip("-").isdigit()):
+                self.stats["folded"] += 1
+                if int(last.a):
+                    block.pop()
+                else:
+                    block[-1] = ir.Instruction(ir.GOTO, None, last.b, None,
+                                               last.indent)
+
+    def resolve(self, blocks, labels, label):
+        # The label a jump to label ends up at
+        seen = set()
+        while label not in seen and label in labels:
+            seen.add(label)
+            i = labels[label]
+            body = blocks[i][1:]
+            if not body and i + 1 < len(blocks) and block_label(blocks[i + 1]):
+                label = block_label(blocks[i + 1])
+            elif len(body) == 1 and body[0].opcode == ir.GOTO:
+                label = body[0].a
+            else:
+                break
+        return label
+
+    def thread_jumps(self, blocks):
+        labels = label_map(blocks)
+        for block in blocks:
+            target = jump_target(block[-1])
+            if target is not None:
+                resolved = self.resolve(blocks, labels, target)
+                if resolved != target:
+                    self.stats["threaded"] += 1
+                    block[-1] = retarget(block[-1], resolved)
+
+    def remove_branches_to_next(self, blocks):
+        for i, block in enumerate(blocks):
+            target = jump_target(block[-1])
+            if target is None:
+                continue
+            # Labels reached by falling through from block, across blocks
+            # that hold nothing but their label
+            j = i + 1
+            while j < len(blocks):
+                if block_label(blocks[j]) == target:
+                    self.stats["branches"] += 1
+                    block.pop()
+                    break
+                if len(blocks[j]) > 1 or block_label(blocks[j]) is None:
+                    break
+                j += 1
+
+    def remove_unreachable(self, blocks):
+        labels = label_map(blocks)
+        reachable = set()
+        pending = [0]
+        while pending:
+            i = pending.pop()
+            if i not in reachable:
+                reachable.add(i)
+                pending.extend(successors(blocks, labels, i))
+        kept = []
+        for i, block in enumerate(blocks):
+            if i in reachable or block[0].opcode == ir.EXIT:
+                kept.append(block)
+            else:
+                self.stats["unreachable"] += 1
+        return kept
+
+    def remove_unused_labels(self, instructions):
+        used = set(jump_target(instruction) for instruction in instructions)
+        kept = []
+        for instruction in instructions:
+            if instruction.opcode == ir.LABEL and instruction.a not in used:
+                self.stats["labels"] += 1
+                continue
+            kept.append(instruction)
+        return kept
+
+    def report(self):
+        return ", ".join("%d %s" % (self.stats[name], name) for name in
+                         ("folded", "threaded", "branches", "unreachable",
+                          "labels"))
+
+def simplify(instructions):
+    return Simplifier().simplify(instructions)
+
+def dot_escape(text):
+    return text.replace("\\", "\\\\").replace('"', '\\"')
+
+def to_dot(instructions):
+    # Graphviz source with one cluster per function. Jumps of if_false are
+    # labelled false, falling through after it true.
+    lines = ["digraph cfg {", '    node [shape=box, fontname="monospace"];']
+    for number, function in enumerate(split_functions(instructions)):
+        blocks = split_blocks(function)
+        labels = label_map(blocks)
+        name = function[0].a if function[0].opcode == ir.ENTRY else ""
+        lines.append("    subgraph cluster_%d {" % number)
+        lines.append('        label="%s";' % dot_escape(name or ""))
+        for i, block in enumerate(blocks):
+            text = "".join(dot_escape(ir.format_instruction(
+                instruction._replace(indent=0)).rstrip()) + "\\l"
+                for instruction in block)
+            lines.append('        f%d_b%d [label="%s"];' % (number, i, text))
+        for i, block in enumerate(blocks):
+            following = successors(blocks, labels, i)
+            for k, j in enumerate(following):
+                attributes = ""
+                if block[-1].opcode == ir.IF_FALSE and len(following) == 2:
+                    attributes = ' [label="%s"]' % ("true", "false")[k]
+                lines.append("        f%d_b%d -> f%d_b%d%s;"
+                             % (number, i, number, j, attributes))
+        lines.append("    }")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
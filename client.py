@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+# Client of server.py: compiles files on a running compile server.
+#
+#   python client.py --socket /tmp/icg.sock file.c ...
+#
+# icg.py uses compile_remote when ICG_SERVER is set to the server's socket,
+# so existing scripts move to the server by setting one variable.
+from __future__ import print_function
+import argparse
+import json
+import os
+import socket
+import sys
+
+def default_socket():
+    # Same directory as icg.get_cache_dir, without importing the compiler
+    if os.environ.get("ICG_SERVER"):
+        return os.environ["ICG_SERVER"]
+    cache_dir = os.environ.get("ICG_CACHE_DIR",
+                               os.path.join(os.path.expanduser("~"), ".cache", "icg"))
+    return os.path.join(cache_dir, "server.sock")
+
+def compile_remote(socket_path, path=None, source=None, pratt=False):
+    # Compile one file on the server at socket_path and return its IR.
+    # Raises OSError when the server cannot be reached or its reply is
+    # empty or malformed, and ValueError with the server's message when
+    # the compile fails.
+    request = {"id": 0, "pratt": pratt}
+    if source is not None:
+        request["source"] = source
+    else:
+        request["path"] = os.path.abspath(path)
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        connection.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = connection.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        connection.close()
+
+    try:
+        response = json.loads(b"".join(chunks).decode("utf-8"))
+    except ValueError:
+        raise IOError("malformed reply from the compile server")
+    if not isinstance(response, dict):
+        raise IOError("malformed reply from the compile server")
+    if "error" in response:
+        raise ValueError(response["error"])
+    if "ir" not in response:
+        raise IOError("malformed reply from the compile server")
+    return response["ir"]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate intermediate code on a running compile server")
+    parser.add_argument("sources", nargs="+")
+    parser.add_argument("--socket", default=None,
+                        help="server socket (default: $ICG_SERVER or "
+                             "server.sock in the cache directory)")
+    parser.add_argument("--pratt", action="store_true",
+                        help="use the precedence climbing expression parser")
+    args = parser.parse_args(argv)
+    socket_path = args.socket or default_socket()
+
+    status = 0
+    for path in args.sources:
+        try:
+            sys.stdout.write(compile_remote(socket_path, path, pratt=args.pratt))
+        except (ValueError, IOError, OSError) as error:
+            print("%s: %s" % (path, error), file=sys.stderr)
+            status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
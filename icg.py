@@ -1,8 +1,26 @@
 #! /usr/bin/env python
 from __future__ import print_function
+import argparse
+import codecs
+import hashlib
+import itertools
 import logging
+import marshal
+import mmap
 import os
 import sys
+import tempfile
+from types import GeneratorType
+
+from ir import IRBuffer
+import instrument
+
+__version__ = "1.0"
+
+try:
+    intern
+except NameError:
+    from sys import intern
 
 if os.environ.get('DEBUG'):
     logging.basicConfig(level=logging.DEBUG)
@@ -19,11 +37,44 @@ class TokenType:
     delimiter = "delimiter"
     reserved = "reserved"
 
-class Token:
-
-    def __init__(self, type, value):
-        self.type = type
+# Token kinds. Each reserved word and delimiter has a kind of its own, so
+# the code generator tells tokens apart by comparing small integers, and
+# sets of kinds are bit masks (see kind_mask).
+(ID_KIND, NUMBER_KIND, RELOP_KIND, ADDOP_KIND, MULOP_KIND, ASSIGNMENT_KIND,
+ INT_KIND, VOID_KIND, IF_KIND, ELSE_KIND, WHILE_KIND, RETURN_KIND, READ_KIND,
+ WRITE_KIND, COMMA_KIND, SEMICOLON_KIND, OPEN_PAREN_KIND, CLOSE_PAREN_KIND,
+ OPEN_BRACE_KIND, CLOSE_BRACE_KIND) = range(20)
+
+KIND_TYPES = (
+    TokenType.id, TokenType.number, TokenType.relop, TokenType.addop,
+    TokenType.mulop, TokenType.assignment
+) + (TokenType.reserved,) * 8 + (TokenType.delimiter,) * 6
+
+OPERATOR_KINDS = (RELOP_KIND, ADDOP_KIND, MULOP_KIND)
+
+def kind_mask(*kinds):
+    # Set of token kinds, test membership with (1 << token.kind) & mask
+    mask = 0
+    for kind in kinds:
+        mask |= 1 << kind
+    return mask
+
+class Token(object):
+    __slots__ = ("kind", "value", "start", "end", "line", "column")
+
+    def __init__(self, kind, value, start=-1, end=-1, line=0, column=0):
+        self.kind = kind
         self.value = value
+        # Offsets of the lexeme in the source and where it starts, tokens
+        # that do not come from a source keep the defaults
+        self.start = start
+        self.end = end
+        self.line = line
+        self.column = column
+
+    @property
+    def type(self):
+        return KIND_TYPES[self.kind]
 
     def __repr__(self):
         return "Token('%s', '%s')" % (self.type, self.value)
@@ -32,51 +83,66 @@ class Token:
         return self.value
 
     def __eq__(self, other):
-        if self.type != other.type:
+        # Operators match any operator of their kind when either value is
+        # the "@ny" wildcard. The code generator itself compares kinds.
+        if self.kind != other.kind:
             return False
 
-        if self.type in (TokenType.id, TokenType.number):
-            return self.type == other.type
+        if (self.kind in OPERATOR_KINDS and
+            self.value != "@ny" and other.value != "@ny"):
+            return self.value == other.value
 
-        if (self.type in (TokenType.relop, TokenType.addop, TokenType.mulop) and
-            self.value == "@ny" or other.value == "@ny"):
-            return self.type == other.type
-
-        return self.type == other.type and self.value == other.value
+        return True
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    __hash__ = None
+
 RESERVED_WORDS = (
     "int", "void", "if", "else", "while", "return", "read", "write"
 )
 
+RESERVED_KINDS = dict(zip(RESERVED_WORDS, (
+    INT_KIND, VOID_KIND, IF_KIND, ELSE_KIND, WHILE_KIND, RETURN_KIND,
+    READ_KIND, WRITE_KIND
+)))
+
 def index_if(iterable, predicate):
     for i, element in enumerate(iterable):
         if predicate(element):
             return i
     return None
 
-VOID_TOKEN = Token(TokenType.reserved, "void")
-INT_TOKEN = Token(TokenType.reserved, "int")
-IF_TOKEN = Token(TokenType.reserved, "if")
-RETURN_TOKEN = Token(TokenType.reserved, "return")
-ELSE_TOKEN = Token(TokenType.reserved, "else")
-WHILE_TOKEN = Token(TokenType.reserved, "while")
-COMMA_TOKEN = Token(TokenType.delimiter, ",")
-SEMICOLON_TOKEN = Token(TokenType.delimiter, ";")
-OPEN_PAREN_TOKEN = Token(TokenType.delimiter, "(")
-CLOSE_PAREN_TOKEN = Token(TokenType.delimiter, ")")
-OPEN_BRACE_TOKEN = Token(TokenType.delimiter, "{")
-CLOSE_BRACE_TOKEN = Token(TokenType.delimiter, "}")
-ID_TOKEN = Token(TokenType.id, "")
-ASSIGNMENT_TOKEN = Token(TokenType.assignment, "=")
-NUMBER_TOKEN = Token(TokenType.number, "")
-REL_OP_TOKEN = Token(TokenType.relop, "@ny")
-ADD_OP_TOKEN = Token(TokenType.addop, "@ny")
-MUL_OP_TOKEN = Token(TokenType.mulop, "@ny")
-READ_TOKEN = Token(TokenType.reserved, "read")
-WRITE_TOKEN = Token(TokenType.reserved, "write")
+VOID_TOKEN = Token(VOID_KIND, "void")
+INT_TOKEN = Token(INT_KIND, "int")
+IF_TOKEN = Token(IF_KIND, "if")
+RETURN_TOKEN = Token(RETURN_KIND, "return")
+ELSE_TOKEN = Token(ELSE_KIND, "else")
+WHILE_TOKEN = Token(WHILE_KIND, "while")
+COMMA_TOKEN = Token(COMMA_KIND, ",")
+SEMICOLON_TOKEN = Token(SEMICOLON_KIND, ";")
+OPEN_PAREN_TOKEN = Token(OPEN_PAREN_KIND, "(")
+CLOSE_PAREN_TOKEN = Token(CLOSE_PAREN_KIND, ")")
+OPEN_BRACE_TOKEN = Token(OPEN_BRACE_KIND, "{")
+CLOSE_BRACE_TOKEN = Token(CLOSE_BRACE_KIND, "}")
+ID_TOKEN = Token(ID_KIND, "")
+ASSIGNMENT_TOKEN = Token(ASSIGNMENT_KIND, "=")
+NUMBER_TOKEN = Token(NUMBER_KIND, "")
+REL_OP_TOKEN = Token(RELOP_KIND, "@ny")
+ADD_OP_TOKEN = Token(ADDOP_KIND, "@ny")
+MUL_OP_TOKEN = Token(MULOP_KIND, "@ny")
+READ_TOKEN = Token(READ_KIND, "read")
+WRITE_TOKEN = Token(WRITE_KIND, "write")
+
+# Kind sets used by the code generators
+TYPE_KINDS = kind_mask(INT_KIND, VOID_KIND)
+OPERAND_KINDS = kind_mask(ID_KIND, NUMBER_KIND)
+BINARY_OPERATOR_KINDS = kind_mask(RELOP_KIND, ADDOP_KIND, MULOP_KIND)
+CALLABLE_KINDS = kind_mask(ID_KIND, READ_KIND, WRITE_KIND)
+EXPRESSION_OPERATOR_KINDS = kind_mask(RELOP_KIND, ADDOP_KIND, MULOP_KIND,
+                                      OPEN_PAREN_KIND, CLOSE_PAREN_KIND)
+EXPRESSION_END_KINDS = kind_mask(COMMA_KIND, SEMICOLON_KIND)
 
 OP_PRECEDENCE = {
     '>': 0,
@@ -89,6 +155,10 @@ OP_PRECEDENCE = {
     '(': 3
 }
 
+# Binary operators that group to the right in PrattCodeGenerator, all the
+# others group to the left
+RIGHT_ASSOCIATIVE = frozenset()
+
 # Character groups used for the finite state machine
 whitespace = " \t\n"
 lowercase = "abcdefghijklmnopqrstuvwxyz"
@@ -99,11 +169,42 @@ add_operators = tuple("+-")
 mul_operators = tuple("*/")
 rel_operators = tuple(list("><") + ["=="])
 all_operators = tuple(add_operators + mul_operators + rel_operators)
+OPERATORS = frozenset(all_operators)
 assignment_operators = ("=",)
 delimiters = tuple("(){};,")
 unitary = (add_operators + mul_operators + rel_operators + assignment_operators +
            delimiters)
 
+# Token kind of every single character operator and delimiter
+UNITARY_KINDS = dict(
+    [(char, ADDOP_KIND) for char in add_operators] +
+    [(char, MULOP_KIND) for char in mul_operators] +
+    [(char, RELOP_KIND) for char in rel_operators] +
+    list(zip(delimiters, (OPEN_PAREN_KIND, CLOSE_PAREN_KIND, OPEN_BRACE_KIND,
+                          CLOSE_BRACE_KIND, SEMICOLON_KIND, COMMA_KIND)))
+)
+
+TRANSITIONS_MAP = {
+    "start": {
+        whitespace: "start",
+        letters: "id",
+        digits: "number",
+        unitary: "unitary"
+    },
+    "id": {
+        whitespace: "start",
+        letters: "id",
+        digits: "id",
+        unitary: "unitary"
+    },
+    "number": {
+        whitespace: "start",
+        letters: "error",
+        digits: "number",
+        unitary: "unitary"
+    }
+}
+
 class FiniteStateMachine:
 
     def __init__(self):
@@ -133,82 +234,489 @@ class LexicalAnalyzer:
         self.fsm = FiniteStateMachine()
         self.fsm.set_initial_state("start")
         for from_state in transitions_dict:
-            for activator_string, to_state in transitions_dict[from_state].iteritems():
+            for activator_string, to_state in transitions_dict[from_state].items():
                 for activator in activator_string:
                     self.fsm.add_transition(from_state, to_state, activator)
 
     def parse(self, source):
-        token_stream = []
-        production_value = ""
+        return list(self.tokenize((source,)))
+
+    def tokenize(self, chunks):
+        # Generator over the tokens of a source given as an iterable of text
+        # chunks, tokens can span chunk boundaries. The lexeme of an id or
+        # number is sliced from the chunk once the token ends, with the part
+        # from earlier chunks carried over.
+        counter = LineCounter()
+        carry = ""
+        begin = 0
+        token_start = token_line = token_column = 0
+        pending_equals = False
+        # The machine is shared by every source this lexer reads, and a
+        # source that failed leaves it wherever it stopped
+        self.fsm.reset()
+
+        for chunk in chunks:
+            if not chunk:
+                continue
+
+            offset = counter.offset
+            skip_one = False
+            if pending_equals:
+                # The previous chunk ended with =, decide whether it was
+                # an assignment or the first half of the relop ==
+                pending_equals = False
+                if chunk[0] == '=':
+                    yield Token(RELOP_KIND, '==', offset - 1, offset + 1,
+                                token_line, token_column)
+                    skip_one = True
+                else:
+                    yield Token(ASSIGNMENT_KIND, '=', offset - 1, offset,
+                                token_line, token_column)
 
-        skip_one = False
+            for i, char in enumerate(chunk):
+                if skip_one:
+                    skip_one = False
+                    continue
+
+                previous_state = self.fsm.current_state
+                try:
+                    self.fsm.transition(char)
+                except KeyError:
+                    line, column = counter.locate(chunk, i)
+                    raise ValueError("unexpected character %r at line %d, "
+                                     "column %d" % (char, line, column))
+                current_state = self.fsm.current_state
+
+                production_ready = (
+                    (current_state == "start" and current_state != previous_state) or
+                    (current_state == "unitary")
+                )
+
+                if production_ready:
+                    if previous_state != "start":
+                        production_value = chunk[begin:i]
+                        if carry:
+                            production_value = carry + production_value
+                            carry = ""
+
+                        kind = ID_KIND
+                        is_reserved = production_value in RESERVED_KINDS
+
+                        if previous_state == "number":
+                            kind = NUMBER_KIND
+                        elif is_reserved:
+                            kind = RESERVED_KINDS[production_value]
+                        else:
+                            production_value = intern(production_value)
+
+                        yield Token(kind, production_value, token_start,
+                                    offset + i, token_line, token_column)
+
+                    if current_state == "unitary":
+                        token_line, token_column = counter.locate(chunk, i)
+                        if char in assignment_operators:
+                            # Check for another = in which case it is relop ==
+                            if i + 1 == len(chunk):
+                                pending_equals = True
+                            elif chunk[i+1] == '=':
+                                yield Token(RELOP_KIND, '==', offset + i,
+                                            offset + i + 2, token_line,
+                                            token_column)
+                                skip_one = True
+                            else:
+                                yield Token(ASSIGNMENT_KIND, char, offset + i,
+                                            offset + i + 1, token_line,
+                                            token_column)
+                        else:
+                            yield Token(UNITARY_KINDS[char], char, offset + i,
+                                        offset + i + 1, token_line, token_column)
+                        self.fsm.reset()
+
+                elif current_state != "start" and previous_state == "start":
+                    begin = i
+                    token_start = offset + i
+                    token_line, token_column = counter.locate(chunk, i)
 
-        for i, char in enumerate(source):
-            if skip_one:
-                skip_one = False
+            if self.fsm.current_state != "start":
+                carry += chunk[begin:]
+                begin = 0
+            counter.end_chunk(chunk)
+
+        if pending_equals:
+            yield Token(ASSIGNMENT_KIND, '=', counter.offset - 1,
+                        counter.offset, token_line, token_column)
+
+class LineCounter:
+    # Turns offsets into line and column numbers (both starting at 1) by
+    # counting the newlines between successive positions in a chunk, so
+    # lexers do not have to look at every newline themselves
+
+    def __init__(self):
+        self.line = 1
+        self.line_start = 0
+        self.offset = 0
+        self.scanned = 0
+
+    def locate(self, chunk, i):
+        newlines = chunk.count("\n", self.scanned, i)
+        if newlines:
+            self.line += newlines
+            self.line_start = self.offset + chunk.rindex("\n", self.scanned, i) + 1
+        self.scanned = i
+        return self.line, self.offset + i - self.line_start + 1
+
+    def end_chunk(self, chunk):
+        self.locate(chunk, len(chunk))
+        self.offset += len(chunk)
+        self.scanned = 0
+
+def get_cache_dir():
+    return os.environ.get("ICG_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "icg"))
+
+def minimize_states(num_states, rows, initial_classes):
+    # Moore's partition refinement. Two states stay in the same class while
+    # they belong to the same initial class and all their transitions lead
+    # to the same classes; negative targets (no transition) compare as is.
+    # Returns the class number of every state.
+    classes = list(initial_classes)
+    while True:
+        signatures = {}
+        refined = []
+        for state in range(num_states):
+            signature = (classes[state],) + tuple(
+                classes[target] if target >= 0 else target
+                for target in rows[state])
+            refined.append(signatures.setdefault(signature, len(signatures)))
+        if len(signatures) == len(set(classes)):
+            return refined
+        classes = refined
+
+class CompiledLexer:
+    # Table driven version of LexicalAnalyzer producing the same tokens.
+    # The transitions map is minimized into integer states and laid out as
+    # a dense table of TABLE_WIDTH entries per state indexed by byte value.
+    # States are stored as the offset of their row, so the next state is
+    # table[state + byte]. Built tables are cached in get_cache_dir() and
+    # kept in memory for the other lexers of the process.
+
+    TABLE_WIDTH = 256
+    TABLE_VERSION = 2
+    DEAD = -1
+
+    # Tables already built or loaded by this process, by cache key
+    loaded_tables = {}
+
+    def __init__(self, transitions_dict, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = get_cache_dir()
+
+        key = hashlib.sha1(repr((
+            self.TABLE_VERSION, sys.version_info[:2],
+            sorted((state, sorted(("".join(activators), to_state)
+                               for activators, to_state in transitions.items()))
+                   for state, transitions in transitions_dict.items())
+        )).encode("utf-8")).hexdigest()
+
+        tables = self.loaded_tables.get(key)
+        if tables is None:
+            cache_path = os.path.join(cache_dir, "lexer-%s.marshal" % key)
+            try:
+                # One read: marshal.load on the file object reads it in
+                # small pieces and takes longer than building the tables
+                with open(cache_path, "rb") as fhandle:
+                    tables = marshal.loads(fhandle.read())
+            except (IOError, OSError, EOFError, ValueError, TypeError):
+                tables = self.build_tables(transitions_dict)
+                self.save_tables(cache_path, tables)
+            self.loaded_tables[key] = tables
+
+        self.table, self.start, self.unitary, self.token_kinds = tables
+
+    @classmethod
+    def build_tables(cls, transitions_dict):
+        width = cls.TABLE_WIDTH
+
+        names = ["start", "unitary"]
+        for from_state in transitions_dict:
+            for to_state in [from_state] + list(transitions_dict[from_state].values()):
+                if to_state not in names:
+                    names.append(to_state)
+        index = dict((name, i) for i, name in enumerate(names))
+
+        rows = []
+        for name in names:
+            row = [cls.DEAD] * width
+            for activator_string, to_state in transitions_dict.get(name, {}).items():
+                for activator in activator_string:
+                    # Multi-character activators such as "==" never match
+                    # a single character, the == operator is a lookahead
+                    if len(activator) == 1:
+                        row[ord(activator)] = index[to_state]
+            rows.append(row)
+
+        # A state is only observable through the token it produces when
+        # the production ends, which is what the initial classes capture.
+        # start and unitary produce no token of their own.
+        def token_kind(name):
+            if name in ("start", "unitary"):
+                return -1 - names.index(name)
+            return NUMBER_KIND if name == "number" else ID_KIND
+        initial = [token_kind(name) for name in names]
+        initial_ids = dict((kind, i) for i, kind in enumerate(sorted(set(initial))))
+        classes = minimize_states(len(names), rows,
+                                  [initial_ids[kind] for kind in initial])
+
+        num_classes = max(classes) + 1
+        representatives = {}
+        for state, state_class in enumerate(classes):
+            representatives.setdefault(state_class, state)
+
+        table = [cls.DEAD] * (num_classes * width)
+        token_kinds = [None] * num_classes
+        for state_class, state in representatives.items():
+            for byte, target in enumerate(rows[state]):
+                if target >= 0:
+                    table[state_class * width + byte] = classes[target] * width
+            token_kinds[state_class] = initial[state]
+
+        return (table,
+                classes[index["start"]] * width,
+                classes[index["unitary"]] * width,
+                dict((state_class * width, token_kinds[state_class])
+                     for state_class in range(num_classes)))
+
+    @staticmethod
+    def save_tables(cache_path, tables):
+        # Write to a temporary file first so readers never see a partial
+        # table; failing to cache is not an error
+        try:
+            cache_dir = os.path.dirname(cache_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, "wb") as fhandle:
+                marshal.dump(tables, fhandle)
+            os.rename(temp_path, cache_path)
+        except (IOError, OSError):
+            pass
+
+    def parse(self, source):
+        return list(self.tokenize((source,)))
+
+    def tokenize(self, chunks):
+        # Generator over the tokens of a source given as an iterable of text
+        # chunks. A token that spans chunks is carried over as text, and an
+        # = ending a chunk is decided when the next chunk arrives.
+        table = self.table
+        start = self.start
+        unitary = self.unitary
+        token_kinds = self.token_kinds
+
+        counter = LineCounter()
+        state = start
+        carry = ""
+        token_start = token_line = token_column = 0
+        pending_equals = False
+
+        for chunk in chunks:
+            if not chunk:
                 continue
 
-            previous_state = self.fsm.current_state
-            self.fsm.transition(char)
-            current_state = self.fsm.current_state
-
-            production_ready = (
-                (current_state == "start" and current_state != previous_state) or
-                (current_state == "unitary")
-            )
-
-            if production_ready:
-                if previous_state != "start":
-                    type_ = TokenType.id
-                    is_reserved = production_value in RESERVED_WORDS
-
-                    if previous_state == "number":
-                        type_ = TokenType.number
-                    elif is_reserved:
-                        type_ = TokenType.reserved
-
-                    token_stream.append(Token(type_, production_value))
-
-                if current_state == "unitary":
-                    type_ = TokenType.addop
-
-                    if char in mul_operators:
-                        type_ = TokenType.mulop
-                    elif char in rel_operators:
-                        type_ = TokenType.relop
-                    elif char in assignment_operators:
-                        # Check for another = in which case it is relop ==
-                        if len(source) >= (i+1) and source[i+1] == '=':
-                            type_ = TokenType.relop
+            data = bytearray(chunk.encode("utf-8"))
+            offset = counter.offset
+            begin = 0
+            skip_one = False
+
+            if pending_equals:
+                pending_equals = False
+                if data[0] == 61:
+                    yield Token(RELOP_KIND, "==", offset - 1, offset + 1,
+                                token_line, token_column)
+                    skip_one = True
+                else:
+                    yield Token(ASSIGNMENT_KIND, "=", offset - 1, offset,
+                                token_line, token_column)
+
+            for i, byte in enumerate(data):
+                next_state = table[state + byte]
+                if next_state == state:
+                    continue
+
+                # The second = of == always leads from start to unitary, so
+                # the check stays out of the fast path above
+                if skip_one:
+                    skip_one = False
+                    continue
+
+                if next_state < 0:
+                    line, column = counter.locate(chunk, i)
+                    raise ValueError("unexpected character %r at line %d, "
+                                     "column %d" % (chunk[i], line, column))
+
+                if next_state == start or next_state == unitary:
+                    if state != start:
+                        value = chunk[begin:i]
+                        if carry:
+                            value = carry + value
+                            carry = ""
+                        kind = token_kinds[state]
+                        if kind == ID_KIND:
+                            if value in RESERVED_KINDS:
+                                kind = RESERVED_KINDS[value]
+                            else:
+                                value = intern(value)
+                        yield Token(kind, value, token_start, offset + i,
+                                    token_line, token_column)
+
+                    if next_state == unitary:
+                        token_line, token_column = counter.locate(chunk, i)
+                        char = chunk[i]
+                        if char == "=":
+                            if i + 1 == len(data):
+                                pending_equals = True
+                            elif data[i + 1] == 61:
+                                yield Token(RELOP_KIND, "==", offset + i,
+                                            offset + i + 2, token_line,
+                                            token_column)
+                                skip_one = True
+                            else:
+                                yield Token(ASSIGNMENT_KIND, char,
+                                            offset + i, offset + i + 1,
+                                            token_line, token_column)
                         else:
-                            type_ = TokenType.assignment
-                    elif char in delimiters:
-                        type_ = TokenType.delimiter
+                            yield Token(UNITARY_KINDS[char], char, offset + i,
+                                        offset + i + 1, token_line, token_column)
+                        next_state = start
+
+                elif state == start:
+                    begin = i
+                    token_start = offset + i
+                    token_line, token_column = counter.locate(chunk, i)
+
+                state = next_state
+
+            if state != start:
+                carry += chunk[begin:]
+            counter.end_chunk(chunk)
+
+        if pending_equals:
+            yield Token(ASSIGNMENT_KIND, "=", counter.offset - 1,
+                        counter.offset, token_line, token_column)
+
+CHUNK_SIZE = 1 << 16
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, use_mmap=True):
+    # Generator over the text of a source file in chunks of chunk_size
+    # bytes, read through a memory map when possible so the file is never
+    # held in memory as a whole
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as fhandle:
+        if use_mmap and os.fstat(fhandle.fileno()).st_size:
+            mapped = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                release = getattr(mapped, "madvise", None)
+                for offset in range(0, len(mapped), chunk_size):
+                    yield decoder.decode(mapped[offset:offset + chunk_size])
+                    # Pages already lexed would otherwise stay resident
+                    if release and chunk_size % mmap.PAGESIZE == 0:
+                        release(mmap.MADV_DONTNEED, offset,
+                                min(chunk_size, len(mapped) - offset))
+            finally:
+                mapped.close()
+        else:
+            while True:
+                block = fhandle.read(chunk_size)
+                if not block:
+                    break
+                yield decoder.decode(block)
+    yield decoder.decode(b"", True)
+
+class TokenStream:
+    # Cursor over a token sequence. Tokens are read by index instead of
+    # slicing the list on every consume, so nothing is ever copied. The
+    # cursor only moves forward: while conditions are generated once (see
+    # expand_iteration_statement), so no token is read twice.
+    #
+    # The tokens can also come from an iterator, such as a lexer reading its
+    # source in chunks. They are then pulled FILL_SIZE at a time into the
+    # buffer, and the tokens already consumed are dropped on refill, so the
+    # memory in use does not grow with the size of the input.
+
+    FILL_SIZE = 4096
 
-                    if type_ == TokenType.relop and char == '=':
-                        token_stream.append(Token(type_, '=='))
-                        skip_one = True
-                    else:
-                        token_stream.append(Token(type_, char))
-                    self.fsm.reset()
+    def __init__(self, tokens):
+        if isinstance(tokens, (list, tuple)):
+            self.source = None
+        else:
+            self.source = iter(tokens)
+            tokens = []
+        self.buffer = tokens
+        self.position = 0
+
+    def __len__(self):
+        # Drains an iterator source
+        while self.fill(len(self.buffer) - self.position + self.FILL_SIZE):
+            pass
+        return len(self.buffer) - self.position
+
+    def __bool__(self):
+        return self.position < len(self.buffer) or self.fill(1)
+
+    __nonzero__ = __bool__
+
+    def fill(self, n):
+        # Pull tokens from the source until the buffer has n tokens left to
+        # read. Returns False if the source runs out first.
+        if self.source is None:
+            return len(self.buffer) - self.position >= n
+
+        buffer = self.buffer
+        if self.position:
+            buffer = self.buffer = buffer[self.position:]
+            self.position = 0
+
+        while len(buffer) < n:
+            tokens = list(itertools.islice(self.source, self.FILL_SIZE))
+            if not tokens:
+                self.source = None
+                break
+            buffer.extend(tokens)
+
+        return len(buffer) >= n
 
-                production_value = ""
+    def first_token(self):
+        if self.position < len(self.buffer):
+            return self.buffer[self.position]
+        return self.nth_token(1)
+
+    def nth_token(self, n):
+        if self.position + n <= len(self.buffer) or self.fill(n):
+            return self.buffer[self.position + n - 1]
+        return None
 
-            elif current_state != "start":
-                production_value += char
+    def consume(self):
+        if self.position >= len(self.buffer) and not self.fill(1):
+            raise IndexError("consume from an exhausted token stream")
 
-        return token_stream
+        token = self.buffer[self.position]
+        self.position += 1
+        return token
 
 class IntermediateCodeGenerator:
 
-    def __init__(self, tokens):
+    def __init__(self, tokens, ir=None, label_prefix="L", temp_prefix="t"):
+        if not isinstance(tokens, TokenStream):
+            tokens = TokenStream(tokens)
         self.tokens = tokens
+        self.ir = ir if ir is not None else IRBuffer()
         self.indent = 0 
-        self.consumed_tokens = []
         self.next_label = 1
         self.next_temp = 1
         self.last_label = None
         self.last_temp = None
+        self.label_prefix = label_prefix
+        self.temp_prefix = temp_prefix
 
     def generate_code(self):
         # Only functions can exist at the outermost scope of the program.
@@ -218,16 +726,15 @@ class IntermediateCodeGenerator:
             self.expand_function()
 
     def expand_function(self):
-        logging.debug("expand_function first=%r" % self.first_token())
-
         type_ = self.consume_token()
         func_name = self.consume_token()
         open_paren = self.consume_token()
 
-        self.expand_arguments()
+        params = self.expand_arguments()
 
         close_paren = self.consume_token()
 
+        self.ir.signatures[func_name.value] = tuple(params)
         self.produce_triplet("entry", func_name.value)
         self.indent += 1
 
@@ -238,6 +745,7 @@ class IntermediateCodeGenerator:
 
         self.indent -= 1
         self.produce_triplet("exit", func_name.value)
+        self.ir.end_function()
 
     def expand_arguments(self):
         # Expand arguments of the form
@@ -245,27 +753,29 @@ class IntermediateCodeGenerator:
         # type argname
         # type argname, type argname, ...
         # Knows when to stop when the first closing parenthesis is encountered
-        logging.debug("expand_arguments first=%r" % self.first_token())
+        # Returns the names of the arguments
 
-        if self.first_token() == VOID_TOKEN:
+        params = []
+        if self.first_token().kind == VOID_KIND:
             self.consume_token()
-            return
         else:
-            while self.first_token() != CLOSE_PAREN_TOKEN:
+            while self.first_token().kind != CLOSE_PAREN_KIND:
                 type_ = self.consume_token()
                 arg_name = self.consume_token()
+                params.append(arg_name.value)
+                self.declare_variable(arg_name.value)
 
-                if self.first_token() == COMMA_TOKEN:
+                if self.first_token().kind == COMMA_KIND:
                     self.consume_token()
+        return params
 
     def expand_compound_statement(self):
         # compound-stmt -> { local_declarations stament-list }
-        logging.debug("expand_compound_statement first=%r" % self.first_token())
         open_brace = self.consume_token()
 
         self.expand_local_declarations()
 
-        if self.first_token() == CLOSE_BRACE_TOKEN:
+        if self.first_token().kind == CLOSE_BRACE_KIND:
             self.consume_token()
             return
 
@@ -274,42 +784,37 @@ class IntermediateCodeGenerator:
         close_brace = self.consume_token()
 
     def expand_local_declarations(self):
-        logging.debug("expand_local_declarations first=%r" % self.first_token())
-
-        while self.first_token() in (INT_TOKEN, VOID_TOKEN):
+        while (1 << self.first_token().kind) & TYPE_KINDS:
             type_ = self.consume_token()
             var_name = self.consume_token()
             semicolon = self.consume_token()
+            self.declare_variable(var_name.value)
 
     def expand_statement_list(self):
         # statement-list only appears in the production
         # compound-stmt -> { local-declarations statement-list }
         # so we know it is delimited by a '}'
-        logging.debug("expand_statement_list first=%r" % self.first_token())
 
-        while self.first_token() != CLOSE_BRACE_TOKEN:
+        while self.first_token().kind != CLOSE_BRACE_KIND:
             self.expand_statement()
 
     def expand_statement(self):
-        logging.debug("expand_statement first=%r" % self.first_token())
-
-        if self.first_token() == IF_TOKEN:
+        kind = self.first_token().kind
+        if kind == IF_KIND:
             self.expand_selection_statement()
-        elif self.first_token() == RETURN_TOKEN:
+        elif kind == RETURN_KIND:
             self.expand_return_statement()
-        elif self.first_token() == WHILE_TOKEN:
+        elif kind == WHILE_KIND:
             self.expand_iteration_statement()
-        elif self.first_token() == OPEN_BRACE_TOKEN:
+        elif kind == OPEN_BRACE_KIND:
             self.expand_compound_statement()
-        elif (self.first_token() in (ID_TOKEN, READ_TOKEN, WRITE_TOKEN) and
-              self.nth_token(2) == OPEN_PAREN_TOKEN):
+        elif ((1 << kind) & CALLABLE_KINDS and
+              self.nth_token(2).kind == OPEN_PAREN_KIND):
             self.expand_call()
         else:
             self.expand_expression_statement()
 
     def expand_selection_statement(self):
-        logging.debug("expand_selection_statement first=%r" % self.first_token())
-
         if_ = self.consume_token()
         open_paren = self.consume_token()
 
@@ -322,13 +827,13 @@ class IntermediateCodeGenerator:
         self.produce_triplet("if_false", temp, "goto", else_label)
         self.indent += 1
 
-        if self.first_token() == OPEN_BRACE_TOKEN:
+        if self.first_token().kind == OPEN_BRACE_KIND:
             self.expand_compound_statement()
         else:
             self.expand_statement()
 
         avoid_else_label = None
-        if self.first_token() == ELSE_TOKEN:
+        if self.first_token().kind == ELSE_KIND:
             avoid_else_label = self.get_label()
             else_ = self.consume_token()
 
@@ -342,7 +847,7 @@ class IntermediateCodeGenerator:
         self.indent += 1
 
         if avoid_else_label:
-            if self.first_token() == OPEN_BRACE_TOKEN:
+            if self.first_token().kind == OPEN_BRACE_KIND:
                 self.expand_compound_statement()
             else:
                 self.expand_statement()
@@ -353,20 +858,18 @@ class IntermediateCodeGenerator:
         self.indent -= 1
 
     def expand_expression_statement(self):
-        logging.debug("expand_expression_statement first=%r" % self.first_token())
         temp = self.expand_expression()
         semicolon = self.consume_token()
         return temp
 
-    def expand_expression(self, final_temp=None):
-        logging.debug("expand_expression first=%r" % self.first_token())
-        if (self.first_token() == ID_TOKEN and
-            self.nth_token(2) == ASSIGNMENT_TOKEN):
+    def expand_expression(self):
+        if (self.first_token().kind == ID_KIND and
+            self.nth_token(2).kind == ASSIGNMENT_KIND):
 
             var = self.consume_token()
             equals = self.consume_token()
 
-            if (self.first_token() == READ_TOKEN):
+            if (self.first_token().kind == READ_KIND):
                 self.produce_triplet("read", var.value)
             else:
                 right_expression_temp = self.expand_expression()
@@ -374,11 +877,9 @@ class IntermediateCodeGenerator:
                 return var.value
 
         else:
-            return self.expand_simple_expression(final_temp)
+            return self.expand_simple_expression()
  
-    def expand_simple_expression(self, final_temp=None):
-        logging.debug("expand_simple_expression first=%r" % self.first_token())
-
+    def expand_simple_expression(self):
         # An expression ends when an unbalanced parenthesis is encountered
         # or a comma ","
         # Create a postfix list of tokens in the expression
@@ -388,54 +889,28 @@ class IntermediateCodeGenerator:
 
         temp = None
 
-        while not (self.first_token() == CLOSE_PAREN_TOKEN and
-                   open_paren_counter == 0):
-
-            if self.first_token() == COMMA_TOKEN: break
-            if self.first_token() == SEMICOLON_TOKEN: break
+        while True:
+            kind = self.first_token().kind
+            if kind == CLOSE_PAREN_KIND and open_paren_counter == 0: break
+            if (1 << kind) & EXPRESSION_END_KINDS: break
 
-            if (self.first_token() == ID_TOKEN and
-                self.nth_token(2) == OPEN_PAREN_TOKEN):
+            if (kind == ID_KIND and
+                self.nth_token(2).kind == OPEN_PAREN_KIND):
                     temp = self.expand_expr_call()
                     postfix.append(temp)
                     continue
 
-            if self.first_token() in (REL_OP_TOKEN, ADD_OP_TOKEN, MUL_OP_TOKEN,
-                                      OPEN_PAREN_TOKEN, CLOSE_PAREN_TOKEN):
+            if (1 << kind) & EXPRESSION_OPERATOR_KINDS:
 
                 op_token = self.consume_token()
                 op = op_token.value
 
                 if op == '(':
                     open_paren_counter += 1
-
-                if len(operators) == 0:
-                    operators.append(op)
-                elif op == ")":
-                    while True:
-                        if operators[-1] == '(':
-                            operators.pop()
-                            break
-                        postfix.append(operators.pop())
+                elif op == ")" and operators:
                     open_paren_counter -= 1
-                elif OP_PRECEDENCE[op] > OP_PRECEDENCE[operators[-1]]:
-                    operators.append(op)
-                elif OP_PRECEDENCE[op] == OP_PRECEDENCE[operators[-1]]:
-                    if op != '(':
-                        postfix.append(operators.pop())
 
-                    operators.append(op)
-                else:
-                    while operators and (OP_PRECEDENCE[op] <
-                                         OP_PRECEDENCE[operators[-1]]):
-                        if operators[-1] == '(':
-                            break
-                        postfix.append(operators.pop())
-                    if operators and (OP_PRECEDENCE[op] ==
-                                      OP_PRECEDENCE[operators[-1]]):
-                        if operators[-1] != '(':
-                            postfix.append(operators.pop())
-                    operators.append(op)
+                self.push_operator(op, postfix, operators)
             else:
                 operand_token = self.consume_token()
                 postfix.append(operand_token.value)
@@ -443,44 +918,70 @@ class IntermediateCodeGenerator:
         while operators:
             postfix.append(operators.pop())
 
-        # Generate code for expression by looking for the first operand 
-        # in the postfix list, creating a triplet for it and its two
-        # preceding operands, storing that in a temporary variable and
-        # inserting the temporary variable in place of the triplet
-        # in the postfix list
+        return self.emit_postfix(postfix, temp)
+
+    def push_operator(self, op, postfix, operators):
+        # Shunting-yard step: move the operators that bind at least as
+        # tightly as op from the operator stack to postfix, then push op.
+        # A closing parenthesis moves everything down to its opening one.
+        if len(operators) == 0:
+            operators.append(op)
+        elif op == ")":
+            while True:
+                if operators[-1] == '(':
+                    operators.pop()
+                    break
+                postfix.append(operators.pop())
+        elif OP_PRECEDENCE[op] > OP_PRECEDENCE[operators[-1]]:
+            operators.append(op)
+        elif OP_PRECEDENCE[op] == OP_PRECEDENCE[operators[-1]]:
+            if op != '(':
+                postfix.append(operators.pop())
+
+            operators.append(op)
+        else:
+            while operators and (OP_PRECEDENCE[op] <
+                                 OP_PRECEDENCE[operators[-1]]):
+                if operators[-1] == '(':
+                    break
+                postfix.append(operators.pop())
+            if operators and (OP_PRECEDENCE[op] ==
+                              OP_PRECEDENCE[operators[-1]]):
+                if operators[-1] != '(':
+                    postfix.append(operators.pop())
+            operators.append(op)
+
+    def emit_postfix(self, postfix, temp=None):
+        # Generate code for the postfix list in a single pass. Operands are
+        # pushed on a stack; each operator pops its two operands, produces
+        # a triplet storing them in a new temporary variable and pushes the
+        # temporary variable in their place.
         if len(postfix) == 1:
             temp = self.get_temp()
-            left = postfix[0]
-            if final_temp:
-                self.produce_triplet(final_temp, "=", left)
-            else:
-                self.produce_triplet(temp, "=", left)
-        else:
-            while set(postfix) & set(all_operators):
-                first_op_i = index_if(postfix, lambda x: x in all_operators)
-                temp = self.get_temp()
-                left = postfix[first_op_i - 2]
-                op = postfix[first_op_i]
-                right = postfix[first_op_i - 1]
-
-                if len(postfix) == 3 and final_temp:
-                    self.produce_triplet(final_temp, "=", left, op, right)
-                else:
-                    self.produce_triplet(temp, "=", left, op, right)
+            self.produce_triplet(temp, "=", postfix[0])
+            return temp
+
+        operands = []
+        for item in postfix:
+            if item not in OPERATORS:
+                operands.append(item)
+                continue
 
-                postfix = postfix[:first_op_i - 2] + [temp] + postfix[first_op_i + 1:]
+            temp = self.get_temp()
+            right = operands.pop()
+            left = operands.pop()
+            self.produce_triplet(temp, "=", left, item, right)
+            operands.append(temp)
 
         return temp
 
     def expand_return_statement(self):
-        logging.debug("expand_return_statement first=%r" % self.first_token())
         return_ = self.consume_token();
         return_value = self.expand_expression()
         semicolon = self.consume_token();
         self.produce_triplet("return", return_value)
 
     def expand_call(self):
-        logging.debug("expand_call first=%r" % self.first_token())
         func = self.consume_token()
 
         open_paren = self.consume_token()
@@ -503,7 +1004,6 @@ class IntermediateCodeGenerator:
         return return_temp
 
     def expand_expr_call(self):
-        logging.debug("expand_expr_call first=%r" % self.first_token())
         func = self.consume_token()
         open_paren = self.consume_token()
 
@@ -517,15 +1017,14 @@ class IntermediateCodeGenerator:
         return return_temp
 
     def expand_args(self, register=True):
-        logging.debug("expand_args first=%r" % self.first_token())
         arg_count = 0
-        while self.first_token() != CLOSE_PAREN_TOKEN:
+        while self.first_token().kind != CLOSE_PAREN_KIND:
             expr_temp = self.expand_expression()
 
             if register:
                 self.produce_triplet("param", expr_temp)
 
-            if self.first_token() == COMMA_TOKEN:
+            if self.first_token().kind == COMMA_KIND:
                 self.consume_token()
 
             arg_count += 1
@@ -533,103 +1032,733 @@ class IntermediateCodeGenerator:
         return arg_count
 
     def expand_iteration_statement(self):
-        logging.debug("expand_iteration_statement first=%r", self.first_token())
+        # The condition is generated once, into a buffer of its own, and
+        # placed after the body (loop rotation):
+        #
+        #     goto test
+        #     Label body
+        #         <body>
+        #     Label test
+        #     <condition>
+        #     if_false condition goto exit
+        #     goto body
+        #     Label exit
         while_ = self.consume_token()
         open_paren = self.consume_token()
 
-        num_tokens_before_condition = len(self.consumed_tokens)
-        condition_temp = self.expand_expression()
-        condition_tokens = self.consumed_tokens[num_tokens_before_condition:]
+        ir = self.ir
+        self.ir = IRBuffer()
+        try:
+            condition_temp = self.expand_expression()
+        finally:
+            condition_ir, self.ir = self.ir, ir
 
         close_paren = self.consume_token()
 
         exit_while_label = self.get_label()
-        reenter_while_label = self.get_label()
-        self.produce_triplet("Label", reenter_while_label)
-        self.produce_triplet("if_false", condition_temp, "goto", exit_while_label)
+        body_label = self.get_label()
+        test_label = self.get_label()
+        self.produce_triplet("goto", test_label)
+        self.produce_triplet("Label", body_label)
         self.indent += 1
 
-        if self.first_token() == OPEN_BRACE_TOKEN:
+        if self.first_token().kind == OPEN_BRACE_KIND:
             self.expand_compound_statement()
         else:
             self.expand_statement()
 
-        # Trigger recalculating of while condition by expanding
-        # condition expression again
-        self.tokens = condition_tokens + [CLOSE_PAREN_TOKEN] + self.tokens
-        self.expand_expression(condition_temp)
-        self.consume_token() # Consume dummy ) delimiter
-
         self.indent -= 1
 
-        self.produce_triplet("goto", reenter_while_label)
+        self.produce_triplet("Label", test_label)
+        self.ir.extend(condition_ir)
+        self.produce_triplet("if_false", condition_temp, "goto", exit_while_label)
+        self.produce_triplet("goto", body_label)
         self.produce_triplet("Label", exit_while_label)
 
     # frontier
 
     def produce_triplet(self, a, b="", c="", d="", e=""):
-        print(" "*4*self.indent + " ".join((a, b, c, d, e)))
+        self.ir.append_fields(self.indent, a, b, c, d, e)
 
     def consume_token(self):
-        token = self.tokens[0]
-        self.tokens = self.tokens[1:]
-        self.consumed_tokens.append(token)
-        return token
+        return self.tokens.consume()
 
     def first_token(self):
-        return self.tokens[0] if len(self.tokens) else None
+        return self.tokens.first_token()
 
     def nth_token(self, n):
-        return self.tokens[n-1] if len(self.tokens) >= n else None
+        return self.tokens.nth_token(n)
 
-    def put_back_token(self):
-        self.tokens = [self.consumed_tokens.pop()] + self.tokens
+    def declare_variable(self, name):
+        # A variable spelled like a temp (t<n>) shares its name with the
+        # temp of that number; the passes that tell temps from variables
+        # by their name are told it is a variable
+        if name[0] == "t" and name[1:].isdigit():
+            self.ir.variables_like_temps.add(name)
 
     def get_label(self):
-        label = "L" + str(self.next_label)
+        label = self.label_prefix + str(self.next_label)
         self.last_label = label
         self.next_label += 1
         return label
 
     def get_temp(self):
-        temp = "t" + str(self.next_temp)
+        temp = self.temp_prefix + str(self.next_temp)
         self.last_temp = temp
         self.next_temp += 1
         return temp
 
-if __name__ == '__main__':
-    transitions_map = {
-        "start": {
-            whitespace: "start",
-            letters: "id",
-            digits: "number",
-            unitary: "unitary"
-        },
-        "id": {
-            whitespace: "start",
-            letters: "id",
-            digits: "id",
-            unitary: "unitary"
-        },
-        "number": {
-            whitespace: "start",
-            letters: "error",
-            digits: "number",
-            unitary: "unitary"
-        }
-    }
+class PrattCodeGenerator(IntermediateCodeGenerator):
+    # Code generator that parses expressions by precedence climbing (a
+    # Pratt parser) and produces triplets during the descent instead of
+    # building a postfix list. Binding powers come from OP_PRECEDENCE, so a
+    # new binary operator only needs its entries there and in the lexer.
+    #
+    # Calls evaluate all of their arguments before begin_args, so calls
+    # nested in arguments no longer interleave with the outer call.
+
+    def binding_power(self, token):
+        if token is not None and (1 << token.kind) & BINARY_OPERATOR_KINDS:
+            return 2 * OP_PRECEDENCE[token.value] + 2
+        return 0
+
+    def expand_simple_expression(self):
+        value, computed = self.parse_expression(0)
+        if value is None:
+            return None
+
+        # Single operands are copied to a temporary variable like the
+        # postfix generator does
+        if not computed:
+            temp = self.get_temp()
+            self.produce_triplet(temp, "=", value)
+            return temp
 
-    source_file = sys.argv[1]
+        return value
 
-    source = None
+    def parse_expression(self, right_power):
+        # Returns the operand holding the value of the expression and
+        # whether it is the result of an operation generated here.
+        left, computed = self.parse_prefix()
 
-    with open(source_file) as fhandle:
-        source = fhandle.read()
+        while True:
+            power = self.binding_power(self.first_token())
+            if power <= right_power:
+                break
 
-    lexical_analyzer = LexicalAnalyzer(transitions_map)
+            op = self.consume_token().value
+            if op in RIGHT_ASSOCIATIVE:
+                right, _ = self.parse_expression(power - 1)
+            else:
+                right, _ = self.parse_expression(power)
+
+            target = self.get_temp()
+            self.produce_triplet(target, "=", left, op, right)
+            left, computed = target, True
+
+        return left, computed
+
+    def parse_prefix(self):
+        token = self.first_token()
+        kind = token.kind
+
+        if kind == OPEN_PAREN_KIND:
+            self.consume_token()
+            if self.first_token().kind == CLOSE_PAREN_KIND:
+                self.consume_token()
+                return None, False
+            value = self.parse_expression(0)
+            close_paren = self.consume_token()
+            return value
+
+        if kind == ID_KIND and self.nth_token(2).kind == OPEN_PAREN_KIND:
+            return self.expand_expr_call(), False
+
+        if (1 << kind) & OPERAND_KINDS:
+            self.consume_token()
+            return token.value, False
+
+        # Nothing to evaluate, e.g. the ) left behind by write
+        return None, False
+
+    def expand_call(self):
+        func = self.consume_token()
+        open_paren = self.consume_token()
+
+        if func.value == "write":
+            self.expand_args(register=False)
+            self.produce_triplet("write", self.last_temp)
+            return
 
-    tokens = lexical_analyzer.parse(source)
+        return_temp = self.produce_call(func.value, self.expand_arg_values())
+
+        close_paren = self.consume_token()
+        semicolon = self.consume_token()
+        return return_temp
+
+    def expand_expr_call(self):
+        func = self.consume_token()
+        open_paren = self.consume_token()
+
+        args = self.expand_arg_values()
+
+        close_paren = self.consume_token()
+        return self.produce_call(func.value, args)
+
+    def expand_arg_values(self):
+        values = []
+        while self.first_token().kind != CLOSE_PAREN_KIND:
+            values.append(self.expand_expression())
+
+            if self.first_token().kind == COMMA_KIND:
+                self.consume_token()
+        return values
+
+    def produce_call(self, func_name, args):
+        self.produce_triplet("begin_args")
+        for value in args:
+            self.produce_triplet("param", value)
+        return_temp = self.get_temp()
+        self.produce_triplet(return_temp, "=", "call", func_name, str(len(args)))
+        return return_temp
+
+class IterativeCodeGenerator(IntermediateCodeGenerator):
+    # Code generator that produces exactly the code of
+    # IntermediateCodeGenerator without recursing in Python, so the nesting
+    # depth of blocks, statements, calls and assignments is only limited by
+    # memory. Every production that can nest is a generator,
+    # iter_<production>, mirroring expand_<production>: it yields the
+    # generator of a nested production to run it and is sent back its
+    # result, and yields anything else to return it. run drives them with
+    # an explicit stack of suspended productions. The productions that
+    # never nest are inherited.
+    #
+    # Nesting that only involves parentheses never recursed: the postfix
+    # conversion of expressions is already iterative.
+
+    def generate_code(self):
+        self.run(self.iter_program())
+
+    def run(self, task):
+        stack = [task]
+        value = None
+        try:
+            while stack:
+                try:
+                    item = stack[-1].send(value)
+                except StopIteration:
+                    stack.pop()
+                    value = None
+                    continue
+                if type(item) is GeneratorType:
+                    stack.append(item)
+                    value = None
+                else:
+                    stack.pop()
+                    value = item
+        except BaseException:
+            # Unwind like recursion would, running the finally clauses of
+            # the suspended productions from the innermost out
+            while stack:
+                stack.pop().close()
+            raise
+        return value
+
+    def iter_program(self):
+        while self.tokens:
+            yield self.iter_function()
+
+    def iter_function(self):
+        type_ = self.consume_token()
+        func_name = self.consume_token()
+        open_paren = self.consume_token()
+
+        params = self.expand_arguments()
+
+        close_paren = self.consume_token()
+
+        self.ir.signatures[func_name.value] = tuple(params)
+        self.produce_triplet("entry", func_name.value)
+        self.indent += 1
+
+        yield self.iter_compound_statement()
+
+        if func_name.value == "main":
+            self.produce_triplet("return")
+
+        self.indent -= 1
+        self.produce_triplet("exit", func_name.value)
+        self.ir.end_function()
+
+    def iter_compound_statement(self):
+        open_brace = self.consume_token()
+
+        self.expand_local_declarations()
+
+        if self.first_token().kind == CLOSE_BRACE_KIND:
+            self.consume_token()
+            return
+
+        yield self.iter_statement_list()
+
+        close_brace = self.consume_token()
+
+    def iter_statement_list(self):
+        while self.first_token().kind != CLOSE_BRACE_KIND:
+            yield self.iter_statement()
+
+    def iter_statement(self):
+        # Only picks the production, so it returns its generator instead of
+        # being one
+        kind = self.first_token().kind
+        if kind == IF_KIND:
+            return self.iter_selection_statement()
+        elif kind == RETURN_KIND:
+            return self.iter_return_statement()
+        elif kind == WHILE_KIND:
+            return self.iter_iteration_statement()
+        elif kind == OPEN_BRACE_KIND:
+            return self.iter_compound_statement()
+        elif ((1 << kind) & CALLABLE_KINDS and
+              self.nth_token(2).kind == OPEN_PAREN_KIND):
+            return self.iter_call()
+        else:
+            return self.iter_expression_statement()
+
+    def iter_body(self):
+        # The statement or block after if, else and while
+        if self.first_token().kind == OPEN_BRACE_KIND:
+            return self.iter_compound_statement()
+        return self.iter_statement()
+
+    def iter_selection_statement(self):
+        if_ = self.consume_token()
+        open_paren = self.consume_token()
+
+        temp = yield self.iter_expression()
+
+        close_paren = self.consume_token()
+
+        else_label = self.get_label()
+
+        self.produce_triplet("if_false", temp, "goto", else_label)
+        self.indent += 1
+
+        yield self.iter_body()
+
+        avoid_else_label = None
+        if self.first_token().kind == ELSE_KIND:
+            avoid_else_label = self.get_label()
+            else_ = self.consume_token()
+
+        if avoid_else_label:
+            self.indent -= 1
+            self.produce_triplet("goto", avoid_else_label)
+            self.indent += 1
+
+        self.indent -= 1
+        self.produce_triplet("Label", else_label)
+        self.indent += 1
+
+        if avoid_else_label:
+            yield self.iter_body()
+            self.indent -= 1
+            self.produce_triplet("Label", avoid_else_label)
+            self.indent += 1
+
+        self.indent -= 1
+
+    def iter_expression_statement(self):
+        temp = yield self.iter_expression()
+        semicolon = self.consume_token()
+        yield temp
+
+    def iter_expression(self):
+        if (self.first_token().kind == ID_KIND and
+            self.nth_token(2).kind == ASSIGNMENT_KIND):
+            return self.iter_assignment()
+        return self.iter_simple_expression()
+
+    def iter_assignment(self):
+        var = self.consume_token()
+        equals = self.consume_token()
+
+        if (self.first_token().kind == READ_KIND):
+            self.produce_triplet("read", var.value)
+        else:
+            right_expression_temp = yield self.iter_expression()
+            self.produce_triplet(var.value, "=", right_expression_temp)
+            yield var.value
+
+    def iter_simple_expression(self):
+        postfix = []
+        operators = []
+        open_paren_counter = 0
+
+        temp = None
+
+        while True:
+            kind = self.first_token().kind
+            if kind == CLOSE_PAREN_KIND and open_paren_counter == 0: break
+            if (1 << kind) & EXPRESSION_END_KINDS: break
+
+            if (kind == ID_KIND and
+                self.nth_token(2).kind == OPEN_PAREN_KIND):
+                    temp = yield self.iter_expr_call()
+                    postfix.append(temp)
+                    continue
+
+            if (1 << kind) & EXPRESSION_OPERATOR_KINDS:
+
+                op_token = self.consume_token()
+                op = op_token.value
+
+                if op == '(':
+                    open_paren_counter += 1
+                elif op == ")" and operators:
+                    open_paren_counter -= 1
+
+                self.push_operator(op, postfix, operators)
+            else:
+                operand_token = self.consume_token()
+                postfix.append(operand_token.value)
+
+        while operators:
+            postfix.append(operators.pop())
+
+        yield self.emit_postfix(postfix, temp)
+
+    def iter_return_statement(self):
+        return_ = self.consume_token();
+        return_value = yield self.iter_expression()
+        semicolon = self.consume_token();
+        self.produce_triplet("return", return_value)
+
+    def iter_call(self):
+        func = self.consume_token()
+
+        open_paren = self.consume_token()
+
+        if func.value != "write":
+            self.produce_triplet("begin_args")
+
+        if func.value == "write":
+            yield self.iter_args(register=False)
+            self.produce_triplet("write", self.last_temp)
+            return
+
+        num_args = yield self.iter_args()
+        return_temp = self.get_temp()
+
+        self.produce_triplet(return_temp, "=", "call", func.value, str(num_args))
+
+        close_paren = self.consume_token()
+        semicolon = self.consume_token()
+
+    def iter_expr_call(self):
+        func = self.consume_token()
+        open_paren = self.consume_token()
+
+        self.produce_triplet("begin_args")
+        num_args = yield self.iter_args()
+
+        return_temp = self.get_temp()
+        self.produce_triplet(return_temp, "=", "call", func.value, str(num_args))
+
+        close_paren = self.consume_token()
+        yield return_temp
+
+    def iter_args(self, register=True):
+        arg_count = 0
+        while self.first_token().kind != CLOSE_PAREN_KIND:
+            expr_temp = yield self.iter_expression()
+
+            if register:
+                self.produce_triplet("param", expr_temp)
+
+            if self.first_token().kind == COMMA_KIND:
+                self.consume_token()
+
+            arg_count += 1
+
+        yield arg_count
+
+    def iter_iteration_statement(self):
+        while_ = self.consume_token()
+        open_paren = self.consume_token()
+
+        ir = self.ir
+        self.ir = IRBuffer()
+        try:
+            condition_temp = yield self.iter_expression()
+        finally:
+            condition_ir, self.ir = self.ir, ir
+
+        close_paren = self.consume_token()
+
+        exit_while_label = self.get_label()
+        body_label = self.get_label()
+        test_label = self.get_label()
+        self.produce_triplet("goto", test_label)
+        self.produce_triplet("Label", body_label)
+        self.indent += 1
+
+        yield self.iter_body()
+
+        self.indent -= 1
+
+        self.produce_triplet("Label", test_label)
+        self.ir.extend(condition_ir)
+        self.produce_triplet("if_false", condition_temp, "goto", exit_while_label)
+        self.produce_triplet("goto", body_label)
+        self.produce_triplet("Label", exit_while_label)
+
+def compile_source(source, lexical_analyzer,
+                   generator_class=IntermediateCodeGenerator):
+    # Lex and generate code for a whole source string, returning the IR
+    ir = IRBuffer()
+    generator_class(lexical_analyzer.parse(source), ir).generate_code()
+    return ir
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Generate intermediate code for a c-minus source file")
+    parser.add_argument("source_file")
+    parser.add_argument("--compiled-lexer", action="store_true",
+                        help="lex with the precompiled dense DFA tables")
+    parser.add_argument("--pratt", action="store_true",
+                        help="parse expressions by precedence climbing and "
+                             "evaluate call arguments before begin_args")
+    parser.add_argument("--iterative", action="store_true",
+                        help="generate code without recursion, for deeply "
+                             "nested sources")
+    parser.add_argument("--stream", action="store_true",
+                        help="read the source in chunks and generate code "
+                             "while it is being lexed")
+    parser.add_argument("--profile", metavar="JSON",
+                        help="write per-production call counts, times and "
+                             "tokens, phase times and peak memory to JSON")
+    parser.add_argument("--flame", metavar="FILE",
+                        help="write production times as collapsed stacks "
+                             "for flame graph tools")
+    parser.add_argument("--cache", action="store_true",
+                        help="reuse the code generated for an identical "
+                             "source from the on-disk cache")
+    parser.add_argument("--cache-dir",
+                        help="cache directory (default: $ICG_CACHE_DIR/ir)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="cache the code of every function and only "
+                             "generate code for the functions that changed")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="generate code for the functions of the file in "
+                             "this many worker processes")
+    parser.add_argument("-O", dest="optimize", type=int, default=0,
+                        choices=(0, 1, 2),
+                        help="optimization level: 1 folds constants, "
+                             "propagates copies and removes dead temps, 2 "
+                             "adds common subexpression elimination")
+    parser.add_argument("--inline", action="store_true",
+                        help="inline calls to small functions that are not "
+                             "recursive and turn tail calls of a function "
+                             "to itself into loops, before -O")
+    parser.add_argument("--inline-size", type=int, metavar="N",
+                        help="inline functions of at most N instructions "
+                             "(implies --inline)")
+    parser.add_argument("--inline-report", action="store_true",
+                        help="print the calls inlined or turned into loops "
+                             "in every function to stderr")
+    parser.add_argument("--loops", action="store_true",
+                        help="move invariant code out of loops and replace "
+                             "multiplies of induction variables by additions, "
+                             "after --inline and before -O")
+    parser.add_argument("--loop-report", action="store_true",
+                        help="print the code moved and the multiplies "
+                             "replaced in every loop to stderr")
+    parser.add_argument("--opt-report", action="store_true",
+                        help="print the instruction count before and after "
+                             "every optimization pass to stderr")
+    parser.add_argument("--dot", metavar="FILE",
+                        help="write the control flow graph of the generated "
+                             "code as Graphviz source")
+    parser.add_argument("--reuse-temps", action="store_true",
+                        help="reuse temps whose values are dead, so each "
+                             "function uses as few temps as possible")
+    parser.add_argument("--registers", type=int, metavar="N",
+                        help="reuse temps with at most N registers and spill "
+                             "the rest to %%s<n> stack slots")
+    parser.add_argument("--alloc-report", action="store_true",
+                        help="print temps, peak live temps, registers and "
+                             "spills of every function to stderr")
+    parser.add_argument("--binary", metavar="FILE",
+                        help="write the code to FILE in the binary format of "
+                             "irbin.py instead of as text to stdout")
+    args = parser.parse_args()
+    if args.registers is not None:
+        if args.registers < 1:
+            parser.error("--registers needs at least 1 register")
+        args.reuse_temps = True
+    if args.inline_size is not None:
+        args.inline = True
+    if (args.optimize or args.dot or args.reuse_temps or args.binary
+            or args.inline or args.loops) and args.stream:
+        parser.error("-O, --dot, --reuse-temps, --binary, --inline and "
+                     "--loops need the whole program, they cannot be used "
+                     "with --stream")
+    if args.jobs and (args.stream or args.incremental):
+        parser.error("--jobs cannot be used with --stream or --incremental")
+    if args.iterative and (args.pratt or args.jobs):
+        parser.error("--iterative cannot be used with --pratt or --jobs")
+    if args.cache_dir or args.incremental:
+        args.cache = True
+    if args.cache and args.stream:
+        parser.error("--cache needs the whole source, it cannot be used "
+                     "with --stream")
+
+    # Files and reports written besides the code; a cached or remote
+    # compile only gives the code, so these always compile here
+    side_outputs = (args.dot or args.profile or args.flame or args.opt_report
+                    or args.alloc_report or args.inline_report
+                    or args.loop_report)
+
+    # With ICG_SERVER set, plain compiles are sent to the compile server
+    # (server.py) and only done here when it cannot be reached or gives
+    # no usable reply
+    if os.environ.get("ICG_SERVER") and not (
+            side_outputs or args.stream or args.cache or args.jobs
+            or args.optimize or args.reuse_temps or args.iterative
+            or args.binary or args.inline or args.loops):
+        import client
+        try:
+            text = client.compile_remote(os.environ["ICG_SERVER"],
+                                         args.source_file, pratt=args.pratt)
+        except (IOError, OSError):
+            pass
+        except ValueError as error:
+            sys.exit("%s: %s" % (args.source_file, error))
+        else:
+            sys.stdout.write(text)
+            sys.exit(0)
+
+    if args.pratt:
+        generator_class = PrattCodeGenerator
+    elif args.iterative:
+        generator_class = IterativeCodeGenerator
+    else:
+        generator_class = IntermediateCodeGenerator
+
+    if args.profile or args.flame:
+        profiler = instrument.Profiler()
+    else:
+        profiler = instrument.NULL_PROFILER
+
+    if args.stream:
+        source = None
+    else:
+        with open(args.source_file) as fhandle:
+            source = fhandle.read()
+
+    if args.cache:
+        import cache
+        compile_cache = cache.CompileCache(args.cache_dir)
+        key = cache.cache_key(source, generator_class, "O%d R%s I%s L%d" % (
+            args.optimize, args.registers if args.reuse_temps else "-",
+            args.inline_size if args.inline else "-", args.loops))
+        # The cache only holds text, which has no function signatures, and
+        # a hit skips the compile that side outputs come from
+        text = None if args.binary or side_outputs else compile_cache.get(key)
+        if text is not None:
+            sys.stdout.write(text)
+            sys.exit(0)
+
+    if args.compiled_lexer:
+        lexical_analyzer = CompiledLexer(TRANSITIONS_MAP)
+    else:
+        lexical_analyzer = LexicalAnalyzer(TRANSITIONS_MAP)
+
+    if args.stream:
+        # Lexing happens on demand inside codegen, time each token there
+        tokens = profiler.timed_iter(
+            "lex", lexical_analyzer.tokenize(read_chunks(args.source_file)))
+        ir = IRBuffer(sink=sys.stdout)
+    elif args.incremental:
+        import incremental
+        tokens = None
+        with profiler.phase("codegen"):
+            ir = incremental.IncrementalCompiler(
+                compile_cache, lexical_analyzer, generator_class).compile(source)
+    elif args.jobs:
+        import parallel
+        tokens = None
+        with profiler.phase("codegen"):
+            ir = parallel.compile_parallel(source, args.jobs,
+                                           args.compiled_lexer, args.pratt)
+    else:
+        with profiler.phase("lex"):
+            tokens = lexical_analyzer.parse(source)
+        ir = IRBuffer()
+
+    if not (args.incremental or args.jobs):
+        codegen = generator_class(tokens, ir)
+
+        profiler.attach(codegen)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            instrument.trace(codegen)
+
+        with profiler.phase("codegen"):
+            codegen.generate_code()
+
+    if args.inline:
+        import inline
+        inliner = inline.Inliner(args.inline_size or inline.DEFAULT_MAX_SIZE)
+        with profiler.phase("inline"):
+            ir = inliner.inline(ir)
+        if args.inline_report:
+            print(inliner.report(), file=sys.stderr)
+
+    if args.loops:
+        import loops
+        loop_optimizer = loops.LoopOptimizer()
+        with profiler.phase("loops"):
+            ir = loop_optimizer.optimize(ir)
+        if args.loop_report:
+            print(loop_optimizer.report(), file=sys.stderr)
+
+    if args.optimize:
+        import optimize
+        optimizer = optimize.Optimizer(args.optimize)
+        with profiler.phase("optimize"):
+            ir = optimizer.optimize(ir)
+        if args.opt_report:
+            print(optimizer.report(), file=sys.stderr)
+
+    if args.reuse_temps:
+        import regalloc
+        allocator = regalloc.RegisterAllocator(args.registers)
+        with profiler.phase("regalloc"):
+            ir = IRBuffer.from_instructions(
+                allocator.allocate(list(ir), ir.variables_like_temps),
+                ir.signatures, ir.variables_like_temps)
+        if args.alloc_report:
+            print(allocator.report(), file=sys.stderr)
+
+    if args.dot:
+        import cfg
+        with open(args.dot, "w") as fhandle:
+            fhandle.write(cfg.to_dot(list(ir)))
+
+    with profiler.phase("write"):
+        if args.stream:
+            ir.flush()
+        elif args.binary:
+            import irbin
+            irbin.write(ir, args.binary)
+        else:
+            ir.write(sys.stdout)
 
-    codegen = IntermediateCodeGenerator(tokens)
+    if args.cache:
+        compile_cache.put(key, ir.text(), tokens)
 
-    codegen.generate_code()
+    if args.profile:
+        profiler.write_json(args.profile)
+    if args.flame:
+        profiler.write_collapsed(args.flame)
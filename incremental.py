@@ -0,0 +1,115 @@
+# Incremental compilation, one top-level function at a time.
+#
+# The source is split into its functions by matching braces. Each function
+# is compiled on its own with function-local label and temp names (%L1,
+# %t1, ...) and its IR is cached under the hash of its text. Assembling the
+# file renames the local names of every function to continue the numbering
+# of the functions before it, which gives the same output as compiling the
+# whole file at once. After an edit only the changed functions are
+# compiled again.
+from __future__ import print_function
+import marshal
+
+import cache
+import icg
+from ir import IRBuffer
+
+LOCAL_LABEL_PREFIX = "%L"
+LOCAL_TEMP_PREFIX = "%t"
+
+FUNCTION_SUFFIX = ".fn"
+
+def split_functions(source):
+    # Yields the text of every top-level function, each ending at the brace
+    # that closes its body. Text after the last function, if any, is
+    # yielded as is.
+    depth = 0
+    begin = 0
+    position = 0
+    while True:
+        position = min_index(source, "{", "}", position)
+        if position < 0:
+            break
+        if source[position] == "{":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                yield source[begin:position + 1]
+                begin = position + 1
+        position += 1
+    if source[begin:].strip():
+        yield source[begin:]
+
+def min_index(source, first, second, start):
+    i = source.find(first, start)
+    j = source.find(second, start)
+    if i < 0 or 0 <= j < i:
+        return j
+    return i
+
+def compile_function(text, lexical_analyzer,
+                     generator_class=icg.IntermediateCodeGenerator):
+    # Returns the IR of a function with local names, and the number of
+    # labels and temps it uses
+    ir = IRBuffer()
+    codegen = generator_class(lexical_analyzer.parse(text), ir,
+                              label_prefix=LOCAL_LABEL_PREFIX,
+                              temp_prefix=LOCAL_TEMP_PREFIX)
+    codegen.generate_code()
+    return ir, codegen.next_label - 1, codegen.next_temp - 1
+
+def globalizer(label_base, temp_base):
+    # Renames the local names of a function whose first label and temp
+    # come after label_base and temp_base
+    def rename(string):
+        if string.startswith(LOCAL_TEMP_PREFIX):
+            return "t" + str(int(string[len(LOCAL_TEMP_PREFIX):]) + temp_base)
+        elif string.startswith(LOCAL_LABEL_PREFIX):
+            return "L" + str(int(string[len(LOCAL_LABEL_PREFIX):]) + label_base)
+        return string
+    return rename
+
+class IncrementalCompiler:
+
+    def __init__(self, compile_cache=None, lexical_analyzer=None,
+                 generator_class=icg.IntermediateCodeGenerator):
+        self.cache = compile_cache or cache.CompileCache()
+        self.lexical_analyzer = lexical_analyzer or \
+            icg.LexicalAnalyzer(icg.TRANSITIONS_MAP)
+        self.generator_class = generator_class
+        self.reused = 0
+        self.compiled = 0
+
+    def function_ir(self, text):
+        # (ir, labels, temps) of a function, from the cache when possible
+        key = cache.cache_key(text.strip(), self.generator_class)
+        data = self.cache.read(key, FUNCTION_SUFFIX)
+        if data is not None:
+            self.cache.hits += 1
+            self.reused += 1
+            num_labels, num_temps, ir_data = marshal.loads(data)
+            return IRBuffer.loads(ir_data), num_labels, num_temps
+
+        self.cache.misses += 1
+        self.compiled += 1
+        ir, num_labels, num_temps = compile_function(
+            text, self.lexical_analyzer, self.generator_class)
+        self.cache.write(key, FUNCTION_SUFFIX,
+                         marshal.dumps((num_labels, num_temps, ir.dumps())))
+        return ir, num_labels, num_temps
+
+    def compile(self, source, ir=None):
+        if ir is None:
+            ir = IRBuffer()
+        label_base = temp_base = 0
+        for text in split_functions(source):
+            function_ir, num_labels, num_temps = self.function_ir(text)
+            ir.extend_buffer(function_ir, globalizer(label_base, temp_base))
+            label_base += num_labels
+            temp_base += num_temps
+        return ir
+
+    def stats_line(self):
+        return "incremental: %d functions reused, %d compiled" % (
+            self.reused, self.compiled)
@@ -0,0 +1,402 @@
+# Interprocedural optimization: inlining and tail calls.
+#
+# The call graph comes from the call instructions between every entry and
+# exit. Two transformations use it:
+#
+#   tail calls  a call of a function to itself whose result is returned
+#               right away (d = call f n, copies of d, return) becomes
+#               assignments to the parameters and a goto to the start of
+#               the function
+#   inlining    a call to a function that is not recursive and has at most
+#               max_size instructions is replaced by the body of the
+#               callee, as long as the caller grows by at most budget
+#               instructions. Callees are handled before their callers, so
+#               what gets inlined is already inlined itself.
+#
+# Arguments are copied where their param instruction was, so they keep the
+# values they had there. As in a new call, the locals of an inlined body
+# and of a function restarted by a tail call start at 0, parameters
+# without an argument are 0 and falling off the end of a function returns
+# 0. Inlined variables are renamed to <name>.<n>, with n counting the
+# inlined bodies, and temps and labels continue the numbering of the
+# program.
+from __future__ import print_function
+import re
+
+import cfg
+import ir
+from ir import IRBuffer, Instruction
+from optimize import BINARY, DEFINES, READS_A, is_constant, is_temp
+
+DEFAULT_MAX_SIZE = 24
+DEFAULT_BUDGET = 200
+
+LABEL_PATTERN = re.compile(r"L(\d+)$")
+TEMP_NUMBER_PATTERN = re.compile(r"t(\d+)$")
+
+def function_name(instructions):
+    if instructions and instructions[0].opcode == ir.ENTRY:
+        return instructions[0].a
+    return None
+
+def call_sites(instructions):
+    # {index of a call: (index of its begin_args, indexes of its params)}.
+    # Arguments can hold calls, so begin_args nest.
+    sites = {}
+    pending = []
+    for i, instruction in enumerate(instructions):
+        opcode = instruction.opcode
+        if opcode == ir.BEGIN_ARGS:
+            pending.append((i, []))
+        elif opcode == ir.PARAM and pending:
+            pending[-1][1].append(i)
+        elif opcode == ir.CALL and pending:
+            sites[i] = pending.pop()
+    return sites
+
+def call_graph(functions):
+    # {function: set of the functions it calls}
+    return dict((name, set(instruction.a for instruction in body
+                           if instruction.opcode == ir.CALL))
+                for name, body in functions.items())
+
+def strongly_connected(graph):
+    # Tarjan's algorithm without recursion. The components come out with
+    # every function after the functions it calls.
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    defined = set(graph)
+    for root in sorted(graph):
+        if root in index:
+            continue
+        work = [(root, iter(sorted(graph[root] & defined)))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, callees = work[-1]
+            callee = next(callees, None)
+            if callee is not None:
+                if callee not in index:
+                    index[callee] = lowlink[callee] = len(index)
+                    stack.append(callee)
+                    on_stack.add(callee)
+                    work.append((callee, iter(sorted(graph[callee] & defined))))
+                elif callee in on_stack:
+                    lowlink[node] = min(lowlink[node], index[callee])
+                continue
+            work.pop()
+            if work:
+                caller = work[-1][0]
+                lowlink[caller] = min(lowlink[caller], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+def recursive_functions(graph, components):
+    recursive = set()
+    for component in components:
+        if len(component) > 1 or component[0] in graph[component[0]]:
+            recursive.update(component)
+    return recursive
+
+def variables(instructions):
+    # Names of the variables and temps read or written by instructions
+    names = set()
+    for instruction in instructions:
+        opcode = instruction.opcode
+        if opcode in DEFINES:
+            names.add(instruction.dest)
+        if opcode in BINARY:
+            names.update((instruction.a, instruction.b))
+        elif opcode in READS_A and instruction.a is not None:
+            names.add(instruction.a)
+    return set(name for name in names if not is_constant(name))
+
+def returned_call(instructions, i):
+    # Whether the result of the call at i is returned unchanged: only
+    # copies of it follow, up to a return of the last copy
+    value = instructions[i].dest
+    for instruction in instructions[i + 1:]:
+        if instruction.opcode == ir.COPY and instruction.a == value:
+            value = instruction.dest
+        elif instruction.opcode == ir.RETURN:
+            return instruction.a == value
+        else:
+            return False
+    return False
+
+class FunctionStats:
+
+    def __init__(self, name, calls):
+        self.name = name
+        # Call instructions before and after
+        self.calls = calls
+        self.left = calls
+        self.inlined = 0
+        self.tail_calls = 0
+
+class Inliner:
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, budget=DEFAULT_BUDGET):
+        self.max_size = max_size
+        self.budget = budget
+        self.stats = []
+
+    def inline(self, buffer):
+        instructions = list(buffer)
+        self.signatures = buffer.signatures
+        self.variables = buffer.variables_like_temps
+        self.number_names(instructions)
+
+        # A function defined twice keeps its first definition in the call
+        # graph, the other is copied as is
+        chunks = cfg.split_functions(instructions)
+        functions = {}
+        for chunk in chunks:
+            name = function_name(chunk)
+            if name is not None and name not in functions:
+                functions[name] = chunk
+        stats = dict((name, FunctionStats(name, sum(
+                          1 for instruction in body
+                          if instruction.opcode == ir.CALL)))
+                     for name, body in functions.items())
+
+        for name in sorted(functions):
+            functions[name] = self.remove_tail_calls(name, functions[name],
+                                                     stats[name])
+
+        graph = call_graph(functions)
+        components = strongly_connected(graph)
+        recursive = recursive_functions(graph, components)
+        for component in components:
+            for name in component:
+                functions[name] = self.inline_calls(
+                    functions[name], functions, recursive, stats[name])
+
+        self.stats = []
+        inlined = []
+        for chunk in chunks:
+            name = function_name(chunk)
+            if name is None or functions.get(name) is None:
+                inlined.extend(chunk)
+                continue
+            inlined.extend(functions[name])
+            stats[name].left = sum(1 for instruction in functions[name]
+                                   if instruction.opcode == ir.CALL)
+            self.stats.append(stats[name])
+            functions[name] = None
+        return IRBuffer.from_instructions(inlined, self.signatures,
+                                          self.variables)
+
+    def number_names(self, instructions):
+        # New temps and labels continue after the highest numbers in use
+        self.next_temp = self.next_label = 1
+        self.next_instance = 1
+        for instruction in instructions:
+            for operand in (instruction.dest, instruction.a, instruction.b):
+                if operand is None:
+                    continue
+                match = TEMP_NUMBER_PATTERN.match(operand)
+                if match:
+                    self.next_temp = max(self.next_temp, int(match.group(1)) + 1)
+                match = LABEL_PATTERN.match(operand)
+                if match:
+                    self.next_label = max(self.next_label, int(match.group(1)) + 1)
+
+    def new_temp(self):
+        self.next_temp += 1
+        return "t%d" % (self.next_temp - 1)
+
+    def new_label(self):
+        self.next_label += 1
+        return "L%d" % (self.next_label - 1)
+
+    def locals_of(self, name, body):
+        # Variables of a function other than its parameters and temps
+        params = set(self.signatures.get(name, ()))
+        return sorted(variable for variable in variables(body)
+                      if not is_temp(variable, self.variables)
+                      and variable not in params)
+
+    def remove_tail_calls(self, name, body, stats):
+        sites = call_sites(body)
+        tail_calls = [i for i in sorted(sites)
+                      if body[i].a == name and returned_call(body, i)]
+        if not tail_calls:
+            return body
+
+        params = self.signatures.get(name, ())
+        start = self.new_label()
+        zeroed = self.locals_of(name, body)
+        begins = set()
+        snapshots = {}
+        jumps = {}
+        for i in tail_calls:
+            begin, param_indexes = sites[i]
+            begins.add(begin)
+            temps = []
+            for position in param_indexes:
+                temps.append(self.new_temp())
+                snapshots[position] = temps[-1]
+            jumps[i] = temps
+        stats.tail_calls += len(tail_calls)
+
+        rewritten = [body[0], Instruction(ir.LABEL, None, start, None,
+                                          body[0].indent + 1)]
+        skip_until = -1
+        for i, instruction in enumerate(body[1:], 1):
+            if i <= skip_until or i in begins:
+                continue
+            if i in snapshots:
+                rewritten.append(Instruction(ir.COPY, snapshots[i],
+                                             instruction.a, None,
+                                             instruction.indent))
+            elif i in jumps:
+                indent = instruction.indent
+                temps = jumps[i]
+                for k, param in enumerate(params):
+                    rewritten.append(Instruction(
+                        ir.COPY, param, temps[k] if k < len(temps) else "0",
+                        None, indent))
+                for variable in zeroed:
+                    rewritten.append(Instruction(ir.COPY, variable, "0", None,
+                                                 indent))
+                rewritten.append(Instruction(ir.GOTO, None, start, None, indent))
+                # Drop the copies of the result and the return
+                skip_until = i
+                while body[skip_until].opcode != ir.RETURN:
+                    skip_until += 1
+            else:
+                rewritten.append(instruction)
+        return rewritten
+
+    def inline_calls(self, body, functions, recursive, stats):
+        sites = call_sites(body)
+        chosen = {}
+        growth = 0
+        for i in sorted(sites):
+            callee = body[i].a
+            if callee not in functions or callee in recursive:
+                continue
+            size = len(functions[callee]) - 2
+            if size > self.max_size or growth + size > self.budget:
+                continue
+            growth += size
+            chosen[i] = self.next_instance
+            self.next_instance += 1
+        if not chosen:
+            return body
+        stats.inlined += len(chosen)
+
+        begins = set()
+        arguments = {}
+        for i, instance in chosen.items():
+            begin, param_indexes = sites[i]
+            begins.add(begin)
+            params = self.signatures.get(body[i].a, ())
+            for k, position in enumerate(param_indexes):
+                # Arguments past the parameters are dropped
+                arguments[position] = ("%s.%d" % (params[k], instance)
+                                       if k < len(params) else None)
+
+        inlined = []
+        for i, instruction in enumerate(body):
+            if i in begins:
+                continue
+            if i in arguments:
+                if arguments[i] is not None:
+                    inlined.append(Instruction(ir.COPY, arguments[i],
+                                               instruction.a, None,
+                                               instruction.indent))
+            elif i in chosen:
+                inlined.extend(self.inline_body(
+                    functions[instruction.a], instruction, chosen[i],
+                    len(sites[i][1])))
+            else:
+                inlined.append(instruction)
+        return inlined
+
+    def inline_body(self, callee, call, instance, num_args):
+        # The instructions that replace call, the body of callee with its
+        # returns assigning the destination of the call
+        name = callee[0].a
+        params = self.signatures.get(name, ())
+        names = {}
+        for variable in variables(callee) | set(params):
+            names[variable] = (self.new_temp()
+                               if is_temp(variable, self.variables)
+                               else "%s.%d" % (variable, instance))
+        labels = {}
+        for instruction in callee:
+            if instruction.opcode == ir.LABEL:
+                labels[instruction.a] = self.new_label()
+
+        def rename(operand):
+            return names.get(operand, operand)
+
+        indent = call.indent
+        shift = indent - callee[0].indent - 1
+        code = []
+        for param in params[num_args:]:
+            code.append(Instruction(ir.COPY, rename(param), "0", None, indent))
+        for variable in self.locals_of(name, callee):
+            code.append(Instruction(ir.COPY, rename(variable), "0", None, indent))
+
+        end = self.new_label()
+        jumps_to_end = False
+        body = callee[1:-1]
+        for position, instruction in enumerate(body):
+            opcode = instruction.opcode
+            instruction = instruction._replace(indent=instruction.indent + shift)
+            if opcode == ir.RETURN:
+                code.append(Instruction(ir.COPY, call.dest,
+                                        rename(instruction.a) or "0", None,
+                                        instruction.indent))
+                if position < len(body) - 1:
+                    code.append(Instruction(ir.GOTO, None, end, None,
+                                            instruction.indent))
+                    jumps_to_end = True
+                continue
+            if opcode in DEFINES:
+                instruction = instruction._replace(dest=rename(instruction.dest))
+            if opcode in BINARY:
+                instruction = instruction._replace(a=rename(instruction.a),
+                                                   b=rename(instruction.b))
+            elif opcode in READS_A and opcode != ir.IF_FALSE:
+                instruction = instruction._replace(a=rename(instruction.a))
+            if opcode == ir.IF_FALSE:
+                instruction = instruction._replace(a=rename(instruction.a),
+                                                   b=labels[instruction.b])
+            elif opcode in (ir.LABEL, ir.GOTO):
+                instruction = instruction._replace(a=labels[instruction.a])
+            code.append(instruction)
+
+        if not body or body[-1].opcode != ir.RETURN:
+            # Falling off the end of the callee
+            code.append(Instruction(ir.COPY, call.dest, "0", None, indent))
+        if jumps_to_end:
+            code.append(Instruction(ir.LABEL, None, end, None, indent))
+        return code
+
+    def report(self):
+        lines = ["%-16s %8s %8s %8s %8s" % ("function", "calls", "inlined",
+                                           "tail", "left")]
+        for function in self.stats:
+            lines.append("%-16s %8d %8d %8d %8d" % (
+                function.name, function.calls, function.inlined,
+                function.tail_calls, function.left))
+        return "\n".join(lines)
+
+def inline(buffer, max_size=DEFAULT_MAX_SIZE, budget=DEFAULT_BUDGET):
+    return Inliner(max_size, budget).inline(buffer)
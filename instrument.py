@@ -0,0 +1,257 @@
+# Instrumentation for icg.py code generators.
+#
+# Nothing here touches a generator unless it is attached: Profiler.attach
+# and trace wrap the production methods of one generator instance,
+# expand_* and the iter_* generators of IterativeCodeGenerator, so
+# generators that are not instrumented run their plain methods.
+from __future__ import print_function
+import json
+import logging
+import sys
+import time
+from types import GeneratorType
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+# iter_<production> generators do the work of expand_<production> in
+# IterativeCodeGenerator, both are reported as <production>
+PRODUCTION_PREFIXES = ("expand_", "iter_")
+
+def production_methods(codegen):
+    # (method name, production) pairs
+    methods = []
+    for name in dir(type(codegen)):
+        for prefix in PRODUCTION_PREFIXES:
+            if name.startswith(prefix):
+                methods.append((name, name[len(prefix):]))
+    return methods
+
+def trace(codegen, log=logging.debug):
+    # Log every production with the token it starts at
+    for name, production in production_methods(codegen):
+        setattr(codegen, name, traced(codegen, name, getattr(codegen, name), log))
+
+def traced(codegen, name, method, log):
+    def wrapper(*args, **kwargs):
+        log("%s first=%r", name, codegen.first_token())
+        return method(*args, **kwargs)
+    return wrapper
+
+def peak_memory_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+class Profiler:
+    # Records, for each grammar production (expand_<production> or
+    # iter_<production>), the number of calls, the time spent inside it
+    # including and excluding nested productions and the tokens it
+    # consumed, plus the time spent in each phase of the compile.
+
+    def __init__(self):
+        self.productions = {}
+        self.stacks = {}
+        self.phases = {}
+        self.phase_order = []
+        self.phase_stack = []
+        self.stack = []
+        self.tokens = 0
+
+    def attach(self, codegen):
+        for name, production in production_methods(codegen):
+            setattr(codegen, name, self.wrap(production, getattr(codegen, name)))
+
+        consume_token = codegen.consume_token
+        def counted_consume_token():
+            self.tokens += 1
+            return consume_token()
+        codegen.consume_token = counted_consume_token
+
+    def wrap(self, production, method):
+        stats = self.productions.setdefault(production, [0, 0.0, 0.0, 0])
+
+        def profiled(*args, **kwargs):
+            entry = self.enter(production)
+            tokens = self.tokens
+            start = timer()
+            try:
+                result = method(*args, **kwargs)
+            except BaseException:
+                self.leave(stats, entry, tokens, start)
+                raise
+            if type(result) is GeneratorType:
+                # Only created so far, the call is counted when it runs
+                self.stack.pop()
+                return self.profiled_generator(production, result)
+            self.leave(stats, entry, tokens, start)
+            return result
+        return profiled
+
+    def profiled_generator(self, production, generator):
+        # Runs generator for IterativeCodeGenerator.run, which resumes it
+        # and the generators it yields. The production stays on the stack
+        # while those run, so they nest under it like calls would, and
+        # leaves it before its result is handed back.
+        stats = self.productions[production]
+        entry = self.enter(production)
+        tokens = self.tokens
+        start = timer()
+        returns = False
+        try:
+            value = None
+            while True:
+                try:
+                    item = generator.send(value)
+                except StopIteration:
+                    break
+                if type(item) is GeneratorType:
+                    value = yield item
+                else:
+                    returns = True
+                    break
+        finally:
+            generator.close()
+            self.leave(stats, entry, tokens, start)
+        if returns:
+            yield item
+
+    def enter(self, production):
+        # Each stack entry is [production, child time]
+        entry = [production, 0.0]
+        self.stack.append(entry)
+        return entry
+
+    def leave(self, stats, entry, tokens, start):
+        elapsed = timer() - start
+        production = entry[0]
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1][1] += elapsed
+
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += elapsed - entry[1]
+        stats[3] += self.tokens - tokens
+
+        path = tuple(name for name, _ in self.stack) + (production,)
+        self.stacks[path] = self.stacks.get(path, 0.0) + elapsed - entry[1]
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def timed_iter(self, name, iterable):
+        # Charge the time spent producing each item to the phase name,
+        # e.g. a lexer that is consumed lazily by the code generator
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self):
+        productions = {}
+        for production, (calls, seconds, self_seconds, tokens) in self.productions.items():
+            if calls:
+                productions[production] = {
+                    "calls": calls,
+                    "seconds": seconds,
+                    "self_seconds": self_seconds,
+                    "tokens": tokens,
+                }
+        return {
+            "phases": dict((name, self.phases[name]) for name in self.phase_order),
+            "productions": productions,
+            "tokens": self.tokens,
+            "peak_memory_kb": peak_memory_kb(),
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as fhandle:
+            json.dump(self.report(), fhandle, indent=2, sort_keys=True)
+            fhandle.write("\n")
+
+    def collapsed_stacks(self):
+        # One "frame;frame;frame microseconds" line per call path, the
+        # format flamegraph.pl and speedscope read. Phase time not spent in
+        # productions is reported under the phase name.
+        lines = []
+        production_time = sum(self.stacks.values())
+        for name in self.phase_order:
+            seconds = self.phases[name]
+            if name == "codegen":
+                seconds -= production_time
+            if seconds > 0:
+                lines.append("%s %d" % (name, seconds * 1e6))
+        for path, seconds in sorted(self.stacks.items()):
+            lines.append("codegen;%s %d" % (";".join(path), seconds * 1e6))
+        return lines
+
+    def write_collapsed(self, path):
+        with open(path, "w") as fhandle:
+            for line in self.collapsed_stacks():
+                fhandle.write(line + "\n")
+
+class Phase:
+    # Times a phase of the compile. Time spent in a phase nested inside
+    # another one is only charged to the nested phase.
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        if self.name not in profiler.phases:
+            profiler.phases[self.name] = 0.0
+            profiler.phase_order.append(self.name)
+        self.nested = 0.0
+        profiler.phase_stack.append(self)
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = timer() - self.start
+        profiler = self.profiler
+        profiler.phase_stack.pop()
+        profiler.phases[self.name] += elapsed - self.nested
+        if profiler.phase_stack:
+            profiler.phase_stack[-1].nested += elapsed
+        return False
+
+class NullProfiler:
+    # Stands in for a Profiler when profiling is off
+
+    def attach(self, codegen):
+        pass
+
+    def phase(self, name):
+        return NULL_PHASE
+
+    def timed_iter(self, name, iterable):
+        return iterable
+
+class NullPhase:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_PHASE = NullPhase()
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,271 @@
+# Intermediate code produced by icg.IntermediateCodeGenerator.
+#
+# Instructions are kept in a columnar IRBuffer: one array for opcodes,
+# one for indentation levels and three for operands (dest, a and b) that
+# hold ids into a table of interned strings. Printing an instruction gives
+# exactly the line the generator used to print:
+#
+#   entry f              exit f               return [a]
+#   Label a              goto a               if_false a goto b
+#   begin_args           param a              read dest
+#   write a              dest = call a b      dest = a
+#   dest = a <op> b
+from __future__ import print_function
+from array import array
+from collections import namedtuple
+import marshal
+
+(ENTRY, EXIT, RETURN, LABEL, GOTO, IF_FALSE, BEGIN_ARGS, PARAM, READ, WRITE,
+ CALL, COPY, ADD, SUB, MUL, DIV, LT, GT, EQ) = range(19)
+
+OPCODE_NAMES = (
+    "entry", "exit", "return", "Label", "goto", "if_false", "begin_args",
+    "param", "read", "write", "call", "copy", "+", "-", "*", "/", "<", ">",
+    "=="
+)
+
+KEYWORD_OPCODES = dict((OPCODE_NAMES[opcode], opcode) for opcode in (
+    ENTRY, EXIT, RETURN, LABEL, GOTO, IF_FALSE, BEGIN_ARGS, PARAM, READ, WRITE))
+
+BINARY_OPCODES = dict((OPCODE_NAMES[opcode], opcode) for opcode in (
+    ADD, SUB, MUL, DIV, LT, GT, EQ))
+
+NONE = -1
+
+Instruction = namedtuple("Instruction", "opcode dest a b indent")
+
+# How each opcode is laid out on its line. The five fields are joined by
+# single spaces, so empty fields leave trailing spaces just like the
+# generator always did.
+DEST, A, B = "dest", "a", "b"
+
+LAYOUTS = {
+    ENTRY: ("entry", A, "", "", ""),
+    EXIT: ("exit", A, "", "", ""),
+    RETURN: ("return", A, "", "", ""),
+    LABEL: ("Label", A, "", "", ""),
+    GOTO: ("goto", A, "", "", ""),
+    IF_FALSE: ("if_false", A, "goto", B, ""),
+    BEGIN_ARGS: ("begin_args", "", "", "", ""),
+    PARAM: ("param", A, "", "", ""),
+    READ: ("read", DEST, "", "", ""),
+    WRITE: ("write", A, "", "", ""),
+    CALL: (DEST, "=", "call", A, B),
+    COPY: (DEST, "=", A, "", ""),
+}
+LAYOUTS.update((opcode, (DEST, "=", A, OPCODE_NAMES[opcode], B))
+               for opcode in BINARY_OPCODES.values())
+
+def compile_layout(layout):
+    template = " ".join("%s" if field in (DEST, A, B) else field.replace("%", "%%")
+                        for field in layout)
+    operands = tuple(field for field in layout if field in (DEST, A, B))
+    return template, operands
+
+FORMATS = dict((opcode, compile_layout(layout))
+               for opcode, layout in LAYOUTS.items())
+
+def format_instruction(instruction):
+    template, operands = FORMATS[instruction.opcode]
+    values = dict(dest=instruction.dest or "", a=instruction.a or "",
+                  b=instruction.b or "")
+    return " " * 4 * instruction.indent + template % tuple(
+        values[operand] for operand in operands)
+
+class IRBuffer:
+
+    # Number of lines joined into a single write
+    BLOCK_SIZE = 4096
+
+    def __init__(self, sink=None, flush_size=None):
+        self.opcodes = array("B")
+        self.indents = array("i")
+        self.dests = array("i")
+        self.a = array("i")
+        self.b = array("i")
+        self.strings = []
+        self.string_ids = {}
+        # Names of the parameters of every function, the text format has no
+        # place for them
+        self.signatures = {}
+        # Variables of the source spelled like a temp (t<n>), which the
+        # passes must not take for temps; the text and binary formats have
+        # no place for them either
+        self.variables_like_temps = set()
+        # With a sink, instructions are written out and dropped at the end
+        # of every function, and whenever flush_size of them have
+        # accumulated inside one
+        self.sink = sink
+        self.flush_size = flush_size or self.BLOCK_SIZE
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __getitem__(self, i):
+        strings = self.strings
+        dest, a, b = self.dests[i], self.a[i], self.b[i]
+        return Instruction(self.opcodes[i],
+                           strings[dest] if dest >= 0 else None,
+                           strings[a] if a >= 0 else None,
+                           strings[b] if b >= 0 else None,
+                           self.indents[i])
+
+    def __iter__(self):
+        for i in range(len(self.opcodes)):
+            yield self[i]
+
+    def intern(self, string):
+        if string is None:
+            return NONE
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+    def append(self, opcode, dest=None, a=None, b=None, indent=0):
+        self.opcodes.append(opcode)
+        self.indents.append(indent)
+        self.dests.append(self.intern(dest))
+        self.a.append(self.intern(a))
+        self.b.append(self.intern(b))
+        if self.sink is not None and len(self.opcodes) >= self.flush_size:
+            self.flush()
+        return len(self.opcodes) - 1
+
+    def append_fields(self, indent, first, second="", third="", fourth="",
+                      fifth=""):
+        # Store a line given as the five fields of the text format
+        if second == "=":
+            if third == "call":
+                return self.append(CALL, first, fourth, fifth, indent)
+            elif fourth:
+                return self.append(BINARY_OPCODES[fourth], first, third, fifth,
+                                   indent)
+            return self.append(COPY, first, third, None, indent)
+
+        opcode = KEYWORD_OPCODES[first]
+        if opcode == READ:
+            return self.append(opcode, second, None, None, indent)
+        elif opcode == IF_FALSE:
+            return self.append(opcode, None, second, fourth, indent)
+        return self.append(opcode, None, second or None, None, indent)
+
+    def extend(self, instructions):
+        for instruction in instructions:
+            self.append(*instruction)
+
+    def extend_buffer(self, other, rename=None):
+        # Append all the instructions of another buffer, passing each of its
+        # distinct strings through rename once
+        string_ids = [self.intern(rename(string) if rename else string)
+                      for string in other.strings]
+        for column, source in ((self.dests, other.dests), (self.a, other.a),
+                               (self.b, other.b)):
+            column.extend(string_ids[string_id] if string_id >= 0 else NONE
+                          for string_id in source)
+        self.opcodes.extend(other.opcodes)
+        self.indents.extend(other.indents)
+        self.signatures.update(other.signatures)
+        self.variables_like_temps.update(other.variables_like_temps)
+        if self.sink is not None and len(self.opcodes) >= self.flush_size:
+            self.flush()
+
+    @classmethod
+    def from_instructions(cls, instructions, signatures=None,
+                          variables_like_temps=None):
+        buffer = cls()
+        buffer.extend(instructions)
+        if signatures:
+            buffer.signatures.update(signatures)
+        if variables_like_temps:
+            buffer.variables_like_temps.update(variables_like_temps)
+        return buffer
+
+    def dumps(self):
+        # Compact serialization of the columns, read back by loads
+        return marshal.dumps((self.opcodes.tolist(), self.indents.tolist(),
+                              self.dests.tolist(), self.a.tolist(),
+                              self.b.tolist(), self.strings, self.signatures,
+                              sorted(self.variables_like_temps)))
+
+    @classmethod
+    def loads(cls, data):
+        (opcodes, indents, dests, a, b, strings, signatures,
+         variables_like_temps) = marshal.loads(data)
+        buffer = cls()
+        buffer.opcodes.extend(opcodes)
+        buffer.indents.extend(indents)
+        buffer.dests.extend(dests)
+        buffer.a.extend(a)
+        buffer.b.extend(b)
+        buffer.strings.extend(strings)
+        buffer.string_ids.update((string, i) for i, string in enumerate(strings))
+        buffer.signatures.update(signatures)
+        buffer.variables_like_temps.update(variables_like_temps)
+        return buffer
+
+    @classmethod
+    def parse(cls, lines):
+        # Read back the text format, one instruction per line
+        buffer = cls()
+        for line in lines:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            stripped = line.lstrip(" ")
+            buffer.append_fields((len(line) - len(stripped)) // 4,
+                                 *stripped.split(" "))
+        return buffer
+
+    def format(self, i):
+        strings = self.strings
+        template, operands = FORMATS[self.opcodes[i]]
+        values = []
+        for operand in operands:
+            string_id = (self.dests if operand == DEST else
+                         self.a if operand == A else self.b)[i]
+            values.append(strings[string_id] if string_id >= 0 else "")
+        return " " * 4 * self.indents[i] + template % tuple(values)
+
+    def lines(self, start=0, stop=None):
+        if stop is None:
+            stop = len(self.opcodes)
+        for i in range(start, stop):
+            yield self.format(i)
+
+    def write(self, stream, start=0, stop=None):
+        # Write the instructions as text, BLOCK_SIZE lines per write
+        if stop is None:
+            stop = len(self.opcodes)
+        for block in range(start, stop, self.BLOCK_SIZE):
+            lines = self.lines(block, min(block + self.BLOCK_SIZE, stop))
+            stream.write("\n".join(lines) + "\n")
+
+    def text(self):
+        return "".join(line + "\n" for line in self.lines())
+
+    def clear(self):
+        # Drops the instructions only; signatures are dropped by
+        # end_function, once the function they belong to is written out
+        for column in (self.opcodes, self.indents, self.dests, self.a, self.b):
+            del column[:]
+        del self.strings[:]
+        self.string_ids.clear()
+
+    def flush(self):
+        # Write the instructions to the sink and drop them. append flushes
+        # in the middle of long functions too, so the signatures stay.
+        self.write(self.sink)
+        self.clear()
+
+    def end_function(self):
+        # Called by the generator after the exit of every function. With a
+        # sink the function is written out right away and its signature
+        # and variables are dropped with it, so at most one function is
+        # held at a time and memory does not grow with their number.
+        if self.sink is not None:
+            if len(self.opcodes):
+                self.flush()
+            self.signatures.clear()
+            self.variables_like_temps.clear()
@@ -0,0 +1,282 @@
+#! /usr/bin/env python
+# Binary format of the intermediate code.
+#
+#   python irbin.py to-binary program.ir program.irb
+#   python irbin.py to-text program.irb [program.ir]
+#
+# A file has a header, fixed-width instruction records, a string table and
+# a function index, all little-endian:
+#
+#   header        magic "ICGB", version, then the number of instructions,
+#                 strings and functions and the offsets of the three
+#                 sections
+#   instructions  16 bytes each: opcode | indent << 8, then the string ids
+#                 of dest, a and b, -1 where there is none
+#   strings       count + 1 offsets into the UTF-8 bytes that follow them;
+#                 every identifier, temp, label and constant is stored once
+#   functions     name id, first instruction, instruction past the exit and
+#                 position and number of the parameter ids, which follow
+#                 the records
+#
+# BinaryIR memory-maps a file and decodes instructions and strings only
+# when they are read, so opening a file costs the same whatever its size
+# and one function can be read without the others.
+from __future__ import print_function
+import argparse
+from array import array
+import mmap
+import struct
+import sys
+
+import ir
+from ir import IRBuffer, Instruction
+
+MAGIC = b"ICGB"
+# Bump when the layout changes; readers reject other versions
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHIIIIII")
+RECORD = struct.Struct("<Iiii")
+FUNCTION = struct.Struct("<iIIII")
+OFFSET = struct.Struct("<I")
+
+# Indents are stored next to the opcode in the first field of a record
+OPCODE_BITS = 8
+OPCODE_MASK = (1 << OPCODE_BITS) - 1
+
+def little_endian(column):
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+def function_ranges(opcodes):
+    # (first, stop) of every entry ... exit in opcodes
+    ranges = []
+    first = None
+    for i, opcode in enumerate(opcodes):
+        if opcode == ir.ENTRY:
+            first = i
+        elif opcode == ir.EXIT and first is not None:
+            ranges.append((first, i + 1))
+            first = None
+    return ranges
+
+def dumps(buffer):
+    # The binary form of an IRBuffer
+    count = len(buffer)
+    records = array("i", [0]) * (4 * count)
+    # Indents are never negative, so the first field fits an int as well
+    records[0::4] = array("i", [opcode | indent << OPCODE_BITS for opcode, indent
+                                in zip(buffer.opcodes, buffer.indents)])
+    records[1::4] = buffer.dests
+    records[2::4] = buffer.a
+    records[3::4] = buffer.b
+
+    # Parameters that are never used do not appear in the code, their
+    # names are added after the strings of the buffer
+    strings = list(buffer.strings)
+    extra_ids = {}
+    def string_id(string):
+        found = buffer.string_ids.get(string)
+        if found is None:
+            found = extra_ids.get(string)
+            if found is None:
+                found = extra_ids[string] = len(strings)
+                strings.append(string)
+        return found
+
+    function_records = []
+    params = array("i")
+    for first, stop in function_ranges(buffer.opcodes):
+        name = buffer.strings[buffer.a[first]]
+        param_ids = [string_id(param)
+                     for param in buffer.signatures.get(name, ())]
+        function_records.append(FUNCTION.pack(buffer.a[first], first, stop,
+                                              len(params), len(param_ids)))
+        params.extend(param_ids)
+    functions = b"".join(function_records) + little_endian(params).tobytes()
+
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = array("I", [0])
+    for string in encoded:
+        offsets.append(offsets[-1] + len(string))
+    string_table = little_endian(offsets).tobytes() + b"".join(encoded)
+
+    instructions_offset = HEADER.size
+    strings_offset = instructions_offset + RECORD.size * count
+    functions_offset = strings_offset + len(string_table)
+    header = HEADER.pack(MAGIC, VERSION, 0, count, len(encoded),
+                         len(function_records), instructions_offset,
+                         strings_offset, functions_offset)
+    return b"".join((header, little_endian(records).tobytes(), string_table,
+                     functions))
+
+def write(buffer, path):
+    with open(path, "wb") as fhandle:
+        fhandle.write(dumps(buffer))
+
+class BinaryIR:
+
+    def __init__(self, path):
+        with open(path, "rb") as fhandle:
+            self.data = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.read_header()
+        except Exception:
+            self.data.close()
+            raise
+        self.cache = {}
+        self.index = None
+
+    @classmethod
+    def from_bytes(cls, data):
+        reader = cls.__new__(cls)
+        reader.data = data
+        reader.read_header()
+        reader.cache = {}
+        reader.index = None
+        return reader
+
+    def read_header(self):
+        if len(self.data) < HEADER.size:
+            raise ValueError("truncated binary IR header")
+        (magic, version, flags, self.count, self.string_count,
+         self.function_count, self.instructions_offset, self.strings_offset,
+         self.functions_offset) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("not a binary IR file")
+        if version != VERSION:
+            raise ValueError("binary IR version %d, expected %d"
+                             % (version, VERSION))
+        self.text_offset = self.strings_offset + OFFSET.size * (self.string_count + 1)
+
+    def close(self):
+        if hasattr(self.data, "close"):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def string(self, string_id):
+        if string_id < 0:
+            return None
+        string = self.cache.get(string_id)
+        if string is None:
+            begin, end = struct.unpack_from(
+                "<II", self.data, self.strings_offset + OFFSET.size * string_id)
+            string = self.cache[string_id] = self.data[
+                self.text_offset + begin:self.text_offset + end].decode("utf-8")
+        return string
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("instruction index out of range")
+        first, dest, a, b = RECORD.unpack_from(
+            self.data, self.instructions_offset + RECORD.size * i)
+        string = self.string
+        return Instruction(first & OPCODE_MASK, string(dest), string(a),
+                           string(b), first >> OPCODE_BITS)
+
+    def __iter__(self):
+        return self.instructions(0, self.count)
+
+    def instructions(self, start, stop):
+        for i in range(start, stop):
+            yield self[i]
+
+    def functions(self):
+        # {name: (first, stop, parameter names)}, read on first use
+        if self.index is None:
+            params_offset = self.functions_offset + FUNCTION.size * self.function_count
+            self.index = {}
+            for i in range(self.function_count):
+                name_id, first, stop, params_start, params_count = \
+                    FUNCTION.unpack_from(self.data, self.functions_offset
+                                         + FUNCTION.size * i)
+                param_ids = struct.unpack_from(
+                    "<%di" % params_count, self.data,
+                    params_offset + OFFSET.size * params_start)
+                self.index[self.string(name_id)] = (
+                    first, stop, tuple(self.string(param) for param in param_ids))
+        return self.index
+
+    def function(self, name):
+        # The instructions of one function, entry to exit
+        first, stop, params = self.functions()[name]
+        return list(self.instructions(first, stop))
+
+    @property
+    def signatures(self):
+        return dict((name, params) for name, (first, stop, params)
+                    in self.functions().items())
+
+    def to_buffer(self):
+        # Everything at once into an IRBuffer, a lot faster than reading
+        # the instructions one by one
+        buffer = IRBuffer()
+        records = array("i")
+        records.frombytes(self.data[self.instructions_offset:self.strings_offset])
+        records = little_endian(records)
+        firsts = records[0::4]
+        buffer.opcodes.extend([first & OPCODE_MASK for first in firsts])
+        buffer.indents.extend([first >> OPCODE_BITS for first in firsts])
+        buffer.dests.extend(records[1::4])
+        buffer.a.extend(records[2::4])
+        buffer.b.extend(records[3::4])
+
+        offsets = array("I")
+        offsets.frombytes(self.data[self.strings_offset:self.text_offset])
+        offsets = little_endian(offsets)
+        text = self.data[self.text_offset:self.text_offset + offsets[-1]]
+        buffer.strings.extend(text[offsets[i]:offsets[i + 1]].decode("utf-8")
+                              for i in range(self.string_count))
+        buffer.string_ids.update((string, i)
+                                 for i, string in enumerate(buffer.strings))
+        buffer.signatures.update(self.signatures)
+        return buffer
+
+def load(path):
+    # The IRBuffer stored in a binary file
+    with BinaryIR(path) as reader:
+        return reader.to_buffer()
+
+def is_binary(path):
+    with open(path, "rb") as fhandle:
+        return fhandle.read(len(MAGIC)) == MAGIC
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert intermediate code between text and binary")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    to_binary = subparsers.add_parser("to-binary")
+    to_binary.add_argument("text_file")
+    to_binary.add_argument("binary_file")
+    to_text = subparsers.add_parser("to-text")
+    to_text.add_argument("binary_file")
+    to_text.add_argument("text_file", nargs="?",
+                         help="output file (default: stdout)")
+    args = parser.parse_args()
+
+    if args.command == "to-binary":
+        with open(args.text_file) as fhandle:
+            write(IRBuffer.parse(fhandle), args.binary_file)
+    else:
+        try:
+            buffer = load(args.binary_file)
+        except ValueError as error:
+            sys.exit("%s: %s" % (args.binary_file, error))
+        if args.text_file:
+            with open(args.text_file, "w") as fhandle:
+                buffer.write(fhandle)
+        else:
+            buffer.write(sys.stdout)
@@ -0,0 +1,530 @@
+#! /usr/bin/env python
+# Loop optimizations of the generated intermediate code.
+#
+#   python loops.py program.c [--input 5 3] [-O2] [--inline]
+#
+# Natural loops are found on the control flow graph of every function (see
+# cfg.py): an edge from a block to a block that dominates it closes a loop,
+# made of that header and of every block that reaches the edge without
+# going through the header. The generator rotates while loops, so the
+# header of a loop is its condition and the body comes before it.
+#
+#   hoisting   an assignment of an expression whose operands do not change
+#              in the loop moves to the preheader, the block that enters
+#              the loop, when it is the only assignment to its destination
+#              in the loop, the destination is not read in the loop before
+#              it is assigned, and the value is not needed after the loop
+#              unless the assignment runs before every exit. Division is
+#              only hoisted by a constant other than 0.
+#   strength   in a loop where a variable i only changes by constant steps
+#   reduction  (i = i + c, directly or through a temp), every i * k with k
+#              constant or unchanged in the loop becomes a copy of a new
+#              temp set to i * k in the preheader and increased by c * k
+#              after every step of i.
+#
+# Run as a script, the program is executed by vm.py before and after the
+# loop optimizations and the instructions executed in every loop are
+# compared.
+from __future__ import print_function
+import argparse
+import sys
+
+import cfg
+import ir
+from ir import IRBuffer, Instruction
+from inline import LABEL_PATTERN, TEMP_NUMBER_PATTERN
+from optimize import DEFINES, PURE, is_constant, uses
+import vm
+
+def block_successors(blocks):
+    labels = cfg.label_map(blocks)
+    return [cfg.successors(blocks, labels, i) for i in range(len(blocks))]
+
+def block_predecessors(successors):
+    predecessors = [[] for _ in successors]
+    for i, following in enumerate(successors):
+        for j in following:
+            predecessors[j].append(i)
+    return predecessors
+
+def immediate_dominators(successors):
+    # {block: immediate dominator} of the blocks reachable from block 0,
+    # by the iterative algorithm of Cooper, Harvey and Kennedy
+    order = []
+    visited = set([0])
+    pending = [(0, iter(successors[0]))]
+    while pending:
+        node, following = pending[-1]
+        for j in following:
+            if j not in visited:
+                visited.add(j)
+                pending.append((j, iter(successors[j])))
+                break
+        else:
+            pending.pop()
+            order.append(node)
+    order.reverse()
+    rank = dict((node, i) for i, node in enumerate(order))
+    predecessors = block_predecessors(successors)
+
+    idom = {0: 0}
+    changed = True
+    while changed:
+        changed = False
+        for node in order[1:]:
+            new = None
+            for p in predecessors[node]:
+                if p not in idom:
+                    continue
+                if new is None:
+                    new = p
+                    continue
+                a, b = p, new
+                while a != b:
+                    while rank[a] > rank[b]:
+                        a = idom[a]
+                    while rank[b] > rank[a]:
+                        b = idom[b]
+                new = a
+            if idom.get(node) != new:
+                idom[node] = new
+                changed = True
+    return idom
+
+def dominates(idom, a, b):
+    while True:
+        if a == b:
+            return True
+        if b == 0 or b not in idom:
+            return False
+        b = idom[b]
+
+class Loop:
+
+    def __init__(self, header, blocks):
+        self.header = header
+        self.blocks = blocks
+
+def natural_loops(successors, idom):
+    # The loops of a function, inner loops before the loops around them
+    by_header = {}
+    predecessors = block_predecessors(successors)
+    for tail in idom:
+        for header in successors[tail]:
+            if not dominates(idom, header, tail):
+                continue
+            members = by_header.setdefault(header, set([header]))
+            pending = [tail]
+            while pending:
+                node = pending.pop()
+                if node not in members:
+                    members.add(node)
+                    pending.extend(p for p in predecessors[node] if p in idom)
+    return sorted((Loop(header, members) for header, members in by_header.items()),
+                  key=lambda loop: (len(loop.blocks), loop.header))
+
+def defined(instruction):
+    if instruction.opcode in DEFINES:
+        return instruction.dest
+    return None
+
+def live_in(blocks, successors):
+    # Variables and temps live at the start of every block
+    block_uses = []
+    block_defs = []
+    for block in blocks:
+        used, defs = set(), set()
+        for instruction in block:
+            used.update(operand for operand in uses(instruction)
+                        if operand not in defs and not is_constant(operand))
+            dest = defined(instruction)
+            if dest is not None:
+                defs.add(dest)
+        block_uses.append(used)
+        block_defs.append(defs)
+
+    live = [set() for _ in blocks]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(len(blocks))):
+            out = set()
+            for j in successors[i]:
+                out |= live[j]
+            new = block_uses[i] | (out - block_defs[i])
+            if new != live[i]:
+                live[i] = new
+                changed = True
+    return live
+
+def constant_step(instruction, variable):
+    # c when instruction is variable + c, c + variable or variable - c
+    opcode, a, b = instruction.opcode, instruction.a, instruction.b
+    if opcode == ir.ADD:
+        if a == variable and is_constant(b):
+            return int(b)
+        if b == variable and is_constant(a):
+            return int(a)
+    elif opcode == ir.SUB and a == variable and is_constant(b):
+        return -int(b)
+    return None
+
+def induction_step(block, position):
+    # What the assignment at position adds to its destination, or None:
+    # i = i + c, or i = t after t = i + c in the same block with no other
+    # assignment to i in between
+    instruction = block[position]
+    dest = instruction.dest
+    if instruction.opcode != ir.COPY:
+        return constant_step(instruction, dest)
+    for previous in reversed(block[:position]):
+        assigned = defined(previous)
+        if assigned == dest:
+            return None
+        if assigned == instruction.a:
+            return constant_step(previous, dest)
+    return None
+
+class LoopStats:
+
+    def __init__(self, function, header):
+        self.function = function
+        self.header = header
+        self.hoisted = 0
+        self.reduced = 0
+
+class LoopOptimizer:
+
+    def __init__(self):
+        self.stats = []
+
+    def optimize(self, buffer):
+        instructions = list(buffer)
+        self.number_names(instructions)
+        self.stats = []
+        optimized = []
+        for function in cfg.split_functions(instructions):
+            optimized.extend(self.optimize_function(function))
+        return IRBuffer.from_instructions(optimized, buffer.signatures,
+                                          buffer.variables_like_temps)
+
+    def number_names(self, instructions):
+        # New temps and labels continue after the highest numbers in use
+        self.next_temp = self.next_label = 1
+        for instruction in instructions:
+            for operand in (instruction.dest, instruction.a, instruction.b):
+                if operand is None:
+                    continue
+                match = TEMP_NUMBER_PATTERN.match(operand)
+                if match:
+                    self.next_temp = max(self.next_temp, int(match.group(1)) + 1)
+                match = LABEL_PATTERN.match(operand)
+                if match:
+                    self.next_label = max(self.next_label, int(match.group(1)) + 1)
+
+    def new_temp(self):
+        self.next_temp += 1
+        return "t%d" % (self.next_temp - 1)
+
+    def new_label(self):
+        self.next_label += 1
+        return "L%d" % (self.next_label - 1)
+
+    def optimize_function(self, instructions):
+        name = instructions[0].a if instructions[0].opcode == ir.ENTRY else None
+        stats = {}
+        # Every change takes code out of a loop or a multiply out of a
+        # loop, so start over after each one until no loop changes
+        while True:
+            blocks = cfg.split_blocks(instructions)
+            successors = block_successors(blocks)
+            idom = immediate_dominators(successors)
+            for loop in natural_loops(successors, idom):
+                header = cfg.block_label(blocks[loop.header])
+                if header is None:
+                    header = "#%d" % loop.header
+                if header not in stats:
+                    stats[header] = LoopStats(name, header)
+                    self.stats.append(stats[header])
+                if self.optimize_loop(blocks, successors, idom, loop,
+                                      stats[header]):
+                    instructions = [instruction for block in blocks
+                                    for instruction in block]
+                    break
+            else:
+                return instructions
+
+    def optimize_loop(self, blocks, successors, idom, loop, stats):
+        # Rewrites blocks and returns True if anything in the loop changed
+        if loop.header == 0:
+            return False
+        members = sorted(loop.blocks)
+        definitions = {}
+        for i in members:
+            for instruction in blocks[i]:
+                dest = defined(instruction)
+                if dest is not None:
+                    definitions[dest] = definitions.get(dest, 0) + 1
+
+        hoisted = self.invariants(blocks, successors, idom, loop, definitions)
+        removed = set(hoisted)
+        preheader = [blocks[i][position] for i, position in hoisted]
+        replaced, updates = self.reduce_strength(blocks, members, definitions,
+                                                 preheader)
+        if not preheader:
+            return False
+        stats.hoisted += len(hoisted)
+        stats.reduced += len(replaced)
+
+        for i in members:
+            rewritten = []
+            for position, instruction in enumerate(blocks[i]):
+                if (i, position) in removed:
+                    continue
+                if (i, position) in replaced:
+                    instruction = Instruction(ir.COPY, instruction.dest,
+                                              replaced[(i, position)], None,
+                                              instruction.indent)
+                rewritten.append(instruction)
+                for temp, step in updates.get((i, position), ()):
+                    if step.startswith("-"):
+                        rewritten.append(Instruction(ir.SUB, temp, temp, step[1:],
+                                                     instruction.indent))
+                    else:
+                        rewritten.append(Instruction(ir.ADD, temp, temp, step,
+                                                     instruction.indent))
+            blocks[i] = rewritten
+        self.insert_preheader(blocks, successors, loop, preheader)
+        return True
+
+    def invariants(self, blocks, successors, idom, loop, definitions):
+        # (block, position) of the assignments that can move to the
+        # preheader, in an order that keeps them valid there
+        live = live_in(blocks, successors)
+        exiting = [i for i in loop.blocks
+                   if any(j not in loop.blocks for j in successors[i])]
+        live_after = set()
+        for i in exiting:
+            for j in successors[i]:
+                if j not in loop.blocks:
+                    live_after |= live[j]
+        header_live = live[loop.header]
+
+        hoisted = []
+        hoisted_names = set()
+        changed = True
+        while changed:
+            changed = False
+            for i in sorted(loop.blocks):
+                for position, instruction in enumerate(blocks[i]):
+                    dest = instruction.dest
+                    if (instruction.opcode not in PURE or dest in hoisted_names
+                            or definitions[dest] != 1 or dest in header_live):
+                        continue
+                    if not all(is_constant(operand) or operand not in definitions
+                               or operand in hoisted_names
+                               for operand in uses(instruction)):
+                        continue
+                    # Division could fail where the loop would not have
+                    # run it
+                    if instruction.opcode == ir.DIV and not (
+                            is_constant(instruction.b) and int(instruction.b)):
+                        continue
+                    if dest in live_after and not all(
+                            dominates(idom, i, j) for j in exiting):
+                        continue
+                    hoisted.append((i, position))
+                    hoisted_names.add(dest)
+                    changed = True
+        return hoisted
+
+    def reduce_strength(self, blocks, members, definitions, preheader):
+        # Replaces i * k by copies of new temps, appending their first
+        # values to preheader. Returns {(block, position) of a multiply:
+        # temp} and {(block, position) of a step of i: [(temp, step)]}.
+        steps = {}
+        varying = set()
+        for i in members:
+            for position, instruction in enumerate(blocks[i]):
+                dest = defined(instruction)
+                if dest is None:
+                    continue
+                step = induction_step(blocks[i], position)
+                if step is None:
+                    varying.add(dest)
+                else:
+                    steps.setdefault(dest, []).append(((i, position), step))
+        for variable in varying:
+            steps.pop(variable, None)
+
+        replaced = {}
+        updates = {}
+        temps = {}
+        for i in members:
+            for position, instruction in enumerate(blocks[i]):
+                if instruction.opcode != ir.MUL:
+                    continue
+                if instruction.a in steps:
+                    variable, factor = instruction.a, instruction.b
+                elif instruction.b in steps:
+                    variable, factor = instruction.b, instruction.a
+                else:
+                    continue
+                if not is_constant(factor) and factor in definitions:
+                    continue
+                temp = temps.get((variable, factor))
+                if temp is None:
+                    temp = temps[(variable, factor)] = self.new_temp()
+                    preheader.append(Instruction(ir.MUL, temp, variable, factor,
+                                                 instruction.indent))
+                    increments = {}
+                    for where, step in steps[variable]:
+                        if is_constant(factor):
+                            increment = str(step * int(factor))
+                        elif step == 1:
+                            increment = factor
+                        elif step in increments:
+                            increment = increments[step]
+                        else:
+                            increment = increments[step] = self.new_temp()
+                            preheader.append(Instruction(
+                                ir.MUL, increment, str(step), factor,
+                                instruction.indent))
+                        updates.setdefault(where, []).append((temp, increment))
+                replaced[(i, position)] = temp
+        return replaced, updates
+
+    def insert_preheader(self, blocks, successors, loop, code):
+        # Code that runs once before the loop goes into the block that
+        # enters it, if only that block does and it goes nowhere else,
+        # otherwise into a new block just before the header
+        header = loop.header
+        outside = [i for i in range(len(blocks))
+                   if header in successors[i] and i not in loop.blocks]
+        if len(outside) == 1 and successors[outside[0]] == [header]:
+            block = blocks[outside[0]]
+            end = len(block)
+            if block[-1].opcode == ir.GOTO:
+                end -= 1
+            indent = block[end - 1].indent if end else block[-1].indent
+            block[end:end] = [instruction._replace(indent=indent)
+                              for instruction in code]
+            return
+
+        target = cfg.block_label(blocks[header])
+        label = self.new_label()
+        indent = blocks[header][0].indent
+        before = blocks[header - 1]
+        if header - 1 in loop.blocks and before[-1].opcode not in cfg.NO_FALLTHROUGH:
+            before.append(Instruction(ir.GOTO, None, target, None, indent))
+        for i in outside:
+            if cfg.jump_target(blocks[i][-1]) == target:
+                blocks[i][-1] = cfg.retarget(blocks[i][-1], label)
+        blocks.insert(header, [Instruction(ir.LABEL, None, label, None, indent)]
+                      + [instruction._replace(indent=indent) for instruction in code])
+
+    def report(self):
+        lines = ["%-16s %-8s %8s %8s" % ("function", "loop", "hoisted",
+                                         "reduced")]
+        for loop in self.stats:
+            lines.append("%-16s %-8s %8d %8d" % (loop.function, loop.header,
+                                                 loop.hoisted, loop.reduced))
+        return "\n".join(lines)
+
+def optimize_loops(buffer):
+    return LoopOptimizer().optimize(buffer)
+
+def loop_profile(buffer, inputs=(), entry="main", args=()):
+    # Run buffer in the VM and count the instructions executed in every
+    # loop, inner loops included. Returns the result, the output, the
+    # instructions executed in all and {function and header: (executed,
+    # multiplies)}.
+    machine = vm.VM(buffer, inputs, output=[])
+    result, counts = machine.run_counted(entry, args)
+    executed = [0] * len(machine.instructions)
+    for pc, count in enumerate(counts):
+        executed[machine.positions[pc]] = count
+
+    loops = {}
+    start = 0
+    for function in cfg.split_functions(machine.instructions):
+        name = function[0].a if function[0].opcode == ir.ENTRY else None
+        blocks = cfg.split_blocks(function)
+        firsts = []
+        for block in blocks:
+            firsts.append(start)
+            start += len(block)
+        successors = block_successors(blocks)
+        for loop in natural_loops(successors, immediate_dominators(successors)):
+            total = multiplies = 0
+            for i in loop.blocks:
+                for offset, instruction in enumerate(blocks[i]):
+                    count = executed[firsts[i] + offset]
+                    total += count
+                    if instruction.opcode == ir.MUL:
+                        multiplies += count
+            header = cfg.block_label(blocks[loop.header]) or "#%d" % loop.header
+            loops[(name, header)] = (total, multiplies)
+    return result, machine.output, sum(counts), loops
+
+def main(argv=None):
+    import icg
+    import inline
+    import optimize
+
+    parser = argparse.ArgumentParser(
+        description="Compare the instructions a program executes in every "
+                    "loop before and after the loop optimizations")
+    parser.add_argument("source_file")
+    parser.add_argument("--input", type=int, nargs="*", default=[],
+                        help="values returned by read, in order")
+    parser.add_argument("-O", dest="optimize", type=int, default=0,
+                        choices=(0, 1, 2),
+                        help="optimization level of both versions, applied "
+                             "after the loop optimizations")
+    parser.add_argument("--inline", action="store_true",
+                        help="inline small functions first in both versions")
+    parser.add_argument("--entry", default="main",
+                        help="function to run (default: main)")
+    parser.add_argument("--args", type=int, nargs="*", default=[],
+                        help="arguments of the function run")
+    args = parser.parse_args(argv)
+
+    with open(args.source_file) as fhandle:
+        source = fhandle.read()
+    before = icg.compile_source(source, icg.LexicalAnalyzer(icg.TRANSITIONS_MAP))
+    if args.inline:
+        before = inline.inline(before)
+    optimizer = LoopOptimizer()
+    after = optimizer.optimize(before)
+    if args.optimize:
+        before = optimize.Optimizer(args.optimize).optimize(before)
+        after = optimize.Optimizer(args.optimize).optimize(after)
+
+    try:
+        result, output, executed, loops = loop_profile(
+            before, args.input, args.entry, args.args)
+        new_result, new_output, new_executed, new_loops = loop_profile(
+            after, args.input, args.entry, args.args)
+    except vm.VMError as error:
+        sys.exit("%s: %s" % (args.source_file, error))
+    if (new_result, new_output) != (result, output):
+        sys.exit("%s: the loop optimizations changed the result" % args.source_file)
+
+    print(optimizer.report())
+    print()
+    print("%-16s %-8s %10s %10s %8s %10s %10s" % (
+        "function", "loop", "before", "after", "change", "mul before",
+        "mul after"))
+    for key in sorted(set(loops) | set(new_loops)):
+        old, old_multiplies = loops.get(key, (0, 0))
+        new, new_multiplies = new_loops.get(key, (0, 0))
+        print("%-16s %-8s %10d %10d %7.1f%% %10d %10d" % (
+            key[0], key[1], old, new, 100.0 * (new - old) / old if old else 0,
+            old_multiplies, new_multiplies))
+    print("%-25s %10d %10d %7.1f%%" % (
+        "total", executed, new_executed,
+        100.0 * (new_executed - executed) / executed if executed else 0))
+
+if __name__ == '__main__':
+    main()
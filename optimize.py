@@ -0,0 +1,239 @@
+# Local optimizations of the generated intermediate code.
+#
+# The passes work on the instructions of an IRBuffer and only look inside
+# basic blocks, except dead temp elimination which counts the uses of
+# every temp in the whole program. C-minus has no globals, pointers or
+# arrays, so a call can not change the variables of its caller and only
+# assignments and read define a variable.
+#
+#   fold      t1 = 3 + 5          ->  t1 = 8
+#   copy      t2 = t1; x = t2 + 1 ->  t2 = t1; x = t1 + 1
+#   cse       t3 = a * b; t4 = a * b  ->  t3 = a * b; t4 = t3
+#   coalesce  t5 = a + b; x = t5  ->  x = a + b  (when t5 has no other use)
+#   dead      t6 = a - 1          ->  removed when t6 is never used
+#   cfg       jump threading and unreachable code removal, see cfg.py
+from __future__ import print_function
+import re
+
+import cfg
+import ir
+from ir import IRBuffer, Instruction
+
+# Names the generator gives its temps. Source variables can be spelled the
+# same; the generator lists them in IRBuffer.variables_like_temps and
+# is_temp is given that list.
+TEMP_PATTERN = re.compile(r"t\d+$")
+CONSTANT_PATTERN = re.compile(r"-?\d+$")
+
+# Instructions after which a new basic block starts
+BLOCK_ENDS = frozenset((ir.ENTRY, ir.EXIT, ir.RETURN, ir.GOTO, ir.IF_FALSE))
+
+# Opcodes whose a and b operands are both variables or constants that are
+# read; the a operand of the other opcodes below is the only one read
+BINARY = frozenset(ir.BINARY_OPCODES.values())
+READS_A = frozenset((ir.COPY, ir.IF_FALSE, ir.PARAM, ir.WRITE, ir.RETURN))
+DEFINES = frozenset((ir.COPY, ir.CALL, ir.READ)) | BINARY
+PURE = frozenset((ir.COPY,)) | BINARY
+COMMUTATIVE = frozenset((ir.ADD, ir.MUL, ir.EQ))
+
+def is_temp(operand, variables=()):
+    return (operand is not None and TEMP_PATTERN.match(operand) is not None
+            and operand not in variables)
+
+def is_constant(operand):
+    return operand is not None and CONSTANT_PATTERN.match(operand) is not None
+
+def uses(instruction):
+    if instruction.opcode in BINARY:
+        return (instruction.a, instruction.b)
+    elif instruction.opcode in READS_A and instruction.a is not None:
+        return (instruction.a,)
+    return ()
+
+def starts_block(instruction):
+    return instruction.opcode == ir.LABEL
+
+def evaluate(opcode, a, b):
+    # The value of a op b with C semantics, None if it can not be folded
+    if opcode == ir.ADD:
+        return a + b
+    elif opcode == ir.SUB:
+        return a - b
+    elif opcode == ir.MUL:
+        return a * b
+    elif opcode == ir.DIV:
+        if b == 0:
+            return None
+        # C division truncates toward zero
+        quotient = abs(a) // abs(b)
+        return quotient if (a < 0) == (b < 0) else -quotient
+    elif opcode == ir.LT:
+        return int(a < b)
+    elif opcode == ir.GT:
+        return int(a > b)
+    elif opcode == ir.EQ:
+        return int(a == b)
+
+def fold_constants(instructions):
+    folded = []
+    for instruction in instructions:
+        if (instruction.opcode in BINARY and is_constant(instruction.a)
+                and is_constant(instruction.b)):
+            value = evaluate(instruction.opcode, int(instruction.a),
+                             int(instruction.b))
+            if value is not None:
+                instruction = Instruction(ir.COPY, instruction.dest, str(value),
+                                          None, instruction.indent)
+        folded.append(instruction)
+    return folded
+
+def propagate_copies(instructions):
+    # Replace the uses of x after x = y by y, for as long as neither x nor
+    # y is assigned again in the block
+    propagated = []
+    copies = {}
+    for instruction in instructions:
+        if starts_block(instruction):
+            copies.clear()
+
+        opcode = instruction.opcode
+        if opcode in BINARY:
+            instruction = instruction._replace(
+                a=copies.get(instruction.a, instruction.a),
+                b=copies.get(instruction.b, instruction.b))
+        elif opcode in READS_A and instruction.a in copies:
+            instruction = instruction._replace(a=copies[instruction.a])
+
+        if opcode in DEFINES:
+            dest = instruction.dest
+            copies.pop(dest, None)
+            for name in [name for name, value in copies.items() if value == dest]:
+                del copies[name]
+            if opcode == ir.COPY and instruction.a != dest:
+                copies[dest] = instruction.a
+
+        propagated.append(instruction)
+        if opcode in BLOCK_ENDS:
+            copies.clear()
+    return propagated
+
+def eliminate_common_subexpressions(instructions):
+    # Replace d = a op b by d = h when h = a op b was computed earlier in
+    # the block and none of a, b and h has been assigned since
+    eliminated = []
+    available = {}
+    for instruction in instructions:
+        if starts_block(instruction):
+            available.clear()
+
+        opcode = instruction.opcode
+        key = None
+        if opcode in BINARY:
+            a, b = instruction.a, instruction.b
+            if opcode in COMMUTATIVE and b < a:
+                a, b = b, a
+            key = (opcode, a, b)
+            holder = available.get(key)
+            if holder is not None:
+                instruction = Instruction(ir.COPY, instruction.dest, holder, None,
+                                          instruction.indent)
+
+        if opcode in DEFINES:
+            dest = instruction.dest
+            for expression in [expression for expression, holder
+                               in available.items()
+                               if dest in (holder, expression[1], expression[2])]:
+                del available[expression]
+            if key is not None and instruction.opcode != ir.COPY \
+                    and dest not in key[1:]:
+                available[key] = dest
+
+        eliminated.append(instruction)
+        if opcode in BLOCK_ENDS:
+            available.clear()
+    return eliminated
+
+def use_counts(instructions):
+    counts = {}
+    for instruction in instructions:
+        for operand in uses(instruction):
+            counts[operand] = counts.get(operand, 0) + 1
+    return counts
+
+def coalesce_copies(instructions, variables=()):
+    # t = a op b; x = t  ->  x = a op b, when the copy is the only use of t
+    counts = use_counts(instructions)
+    coalesced = []
+    for instruction in instructions:
+        if (instruction.opcode == ir.COPY and coalesced
+                and is_temp(instruction.a, variables)
+                and counts.get(instruction.a) == 1):
+            previous = coalesced[-1]
+            if previous.opcode in PURE and previous.dest == instruction.a:
+                coalesced[-1] = previous._replace(dest=instruction.dest)
+                continue
+        coalesced.append(instruction)
+    return coalesced
+
+def remove_dead_temps(instructions, variables=()):
+    # Drop assignments to temps that are never used, until none is left;
+    # removing one can leave the temps it used without uses
+    while True:
+        counts = use_counts(instructions)
+        live = [instruction for instruction in instructions
+                if not (instruction.opcode in PURE
+                        and is_temp(instruction.dest, variables)
+                        and instruction.dest not in counts)]
+        if len(live) == len(instructions):
+            return live
+        instructions = live
+
+PASSES = {
+    "fold": fold_constants,
+    "copy": propagate_copies,
+    "cse": eliminate_common_subexpressions,
+    "coalesce": coalesce_copies,
+    "dead": remove_dead_temps,
+    "cfg": cfg.simplify,
+}
+
+# Passes that tell temps from variables, they also take the variables
+# spelled like temps
+TEMP_PASSES = frozenset(("coalesce", "dead"))
+
+LEVELS = {
+    0: (),
+    # Branches on constants are removed by cfg, which can leave the temps
+    # of their conditions dead
+    1: ("copy", "fold", "coalesce", "dead", "cfg", "dead"),
+    # Folding and copy propagation feed each other, so they run twice
+    2: ("copy", "fold", "copy", "fold", "cse", "copy", "coalesce", "dead",
+        "cfg", "dead"),
+}
+
+class Optimizer:
+
+    def __init__(self, level=1, passes=None):
+        self.passes = passes if passes is not None else LEVELS[level]
+        # (pass, instructions before, instructions after) of every pass run
+        self.stats = []
+
+    def optimize(self, buffer):
+        instructions = list(buffer)
+        for name in self.passes:
+            before = len(instructions)
+            if name in TEMP_PASSES:
+                instructions = PASSES[name](instructions,
+                                            buffer.variables_like_temps)
+            else:
+                instructions = PASSES[name](instructions)
+            self.stats.append((name, before, len(instructions)))
+        return IRBuffer.from_instructions(instructions, buffer.signatures,
+                                          buffer.variables_like_temps)
+
+    def report(self):
+        lines = ["%-10s %8s %8s %8s" % ("pass", "before", "after", "removed")]
+        for name, before, after in self.stats:
+            lines.append("%-10s %8d %8d %8d" % (name, before, after,
+                                                before - after))
+        return "\n".join(lines)
@@ -0,0 +1,76 @@
+# Parallel code generation for the functions of one source file.
+#
+# The functions of a file only share the label and temp counters. The
+# source is cut at function boundaries into partitions of consecutive
+# functions, worker processes lex and generate each partition with local
+# label and temp names, and the partitions are appended in source order,
+# renaming their local names to continue the numbering of the partitions
+# before them. The result is the same as compiling the file serially.
+from __future__ import print_function
+import multiprocessing
+
+import batch
+import incremental
+from ir import IRBuffer
+
+# Partitions per worker, so that a slow partition does not leave the other
+# workers idle at the end
+PARTITIONS_PER_JOB = 4
+
+def partition(functions, num_partitions):
+    # Groups consecutive functions into num_partitions texts of about the
+    # same length
+    total = sum(len(text) for text in functions)
+    target = max(1, total // max(1, num_partitions))
+    partitions = []
+    current = []
+    size = 0
+    for text in functions:
+        current.append(text)
+        size += len(text)
+        if size >= target:
+            partitions.append("".join(current))
+            current = []
+            size = 0
+    if current:
+        partitions.append("".join(current))
+    return partitions
+
+def compile_partition(text):
+    ir, num_labels, num_temps = incremental.compile_function(
+        text, batch.worker["lexer"], batch.worker["generator_class"])
+    return ir.dumps(), num_labels, num_temps
+
+def compile_parallel(source, jobs=None, compiled_lexer=False, pratt=False,
+                     ir=None):
+    if ir is None:
+        ir = IRBuffer()
+    jobs = jobs or multiprocessing.cpu_count()
+    partitions = partition(list(incremental.split_functions(source)),
+                           jobs * PARTITIONS_PER_JOB)
+
+    if jobs == 1 or len(partitions) == 1:
+        batch.init_worker(compiled_lexer, pratt)
+        results = (incremental.compile_function(
+            text, batch.worker["lexer"], batch.worker["generator_class"])
+            for text in partitions)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, batch.init_worker,
+                                    (compiled_lexer, pratt))
+        results = ((IRBuffer.loads(data), num_labels, num_temps)
+                   for data, num_labels, num_temps
+                   in pool.imap(compile_partition, partitions))
+
+    try:
+        label_base = temp_base = 0
+        for partition_ir, num_labels, num_temps in results:
+            ir.extend_buffer(partition_ir,
+                             incremental.globalizer(label_base, temp_base))
+            label_base += num_labels
+            temp_base += num_temps
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return ir
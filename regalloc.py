@@ -0,0 +1,221 @@
+# Temp reuse by liveness analysis and linear scan allocation.
+#
+# The generator never reuses a temp, so a function with thousands of
+# expressions has thousands of temps. Here the live range of every temp
+# is computed over the control flow graph of its function and the temps
+# are packed into as few registers as their live ranges allow, linear
+# scan style. Registers keep the temp names t1, t2, ...; with a limited
+# number of registers the temps that do not fit are spilled to stack
+# slots named %s1, %s2, ..., which are reused the same way. Source
+# variables spelled like a temp are left alone, and no register is given
+# their name.
+from __future__ import print_function
+
+import cfg
+import ir
+from optimize import BINARY, DEFINES, READS_A, is_temp, uses
+
+REGISTER_PREFIX = "t"
+SPILL_PREFIX = "%s"
+
+def temp_uses(instruction, variables=()):
+    return [operand for operand in uses(instruction)
+            if is_temp(operand, variables)]
+
+def temp_def(instruction, variables=()):
+    if instruction.opcode in DEFINES and is_temp(instruction.dest, variables):
+        return instruction.dest
+    return None
+
+def register_names(count, variables=()):
+    # Names of the first count registers, skipping the variables
+    names = []
+    number = 1
+    while len(names) < count:
+        name = REGISTER_PREFIX + str(number)
+        if name not in variables:
+            names.append(name)
+        number += 1
+    return names
+
+def live_intervals(instructions, variables=()):
+    # {temp: [first, last]} positions in instructions where temp is live,
+    # defined or used
+    blocks = cfg.split_blocks(instructions)
+    labels = cfg.label_map(blocks)
+    successors = [cfg.successors(blocks, labels, i) for i in range(len(blocks))]
+
+    block_uses = []
+    block_defs = []
+    for block in blocks:
+        used, defined = set(), set()
+        for instruction in block:
+            used.update(temp for temp in temp_uses(instruction, variables)
+                        if temp not in defined)
+            temp = temp_def(instruction, variables)
+            if temp is not None:
+                defined.add(temp)
+        block_uses.append(used)
+        block_defs.append(defined)
+
+    live_in = [set() for block in blocks]
+    live_out = [set() for block in blocks]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(len(blocks))):
+            out = set()
+            for j in successors[i]:
+                out |= live_in[j]
+            new_in = block_uses[i] | (out - block_defs[i])
+            if out != live_out[i] or new_in != live_in[i]:
+                live_out[i], live_in[i] = out, new_in
+                changed = True
+
+    intervals = {}
+    def extend(temp, position):
+        interval = intervals.get(temp)
+        if interval is None:
+            intervals[temp] = [position, position]
+        else:
+            interval[0] = min(interval[0], position)
+            interval[1] = max(interval[1], position)
+
+    position = len(instructions)
+    for i in reversed(range(len(blocks))):
+        live = set(live_out[i])
+        for instruction in reversed(blocks[i]):
+            position -= 1
+            for temp in live:
+                extend(temp, position)
+            temp = temp_def(instruction, variables)
+            if temp is not None:
+                live.discard(temp)
+                extend(temp, position)
+            for temp in temp_uses(instruction, variables):
+                live.add(temp)
+                extend(temp, position)
+        for temp in live:
+            extend(temp, position)
+    return intervals
+
+def peak_live(intervals):
+    # Most intervals overlapping at one position. An interval ending where
+    # another starts does not overlap it: the instruction there reads the
+    # first temp before it writes the second. At one position, intervals
+    # end (0), then start (1), then the ones of a single position end (2).
+    events = []
+    for first, last in intervals.values():
+        events.append((first, 1, 1))
+        events.append((last, 0 if last > first else 2, -1))
+    peak = live = 0
+    for position, order, change in sorted(events):
+        live += change
+        peak = max(peak, live)
+    return peak
+
+def linear_scan(intervals, registers=None):
+    # {temp: register number} and {temp: spill slot number}, numbered from
+    # 1. registers=None allows as many registers as needed.
+    order = sorted(intervals, key=lambda temp: (intervals[temp][0],
+                                                int(temp[len(REGISTER_PREFIX):])))
+    assigned = {}
+    spilled = []
+    active = []
+    free = []
+    next_register = 1
+    for temp in order:
+        first, last = intervals[temp]
+        for other in [other for other in active if intervals[other][1] <= first]:
+            active.remove(other)
+            free.append(assigned[other])
+        if registers is not None and len(active) == registers:
+            # Spill whichever of the active temps and this one lives longest
+            victim = max(active, key=lambda other: intervals[other][1])
+            if intervals[victim][1] > last:
+                assigned[temp] = assigned.pop(victim)
+                active.remove(victim)
+                spilled.append(victim)
+                active.append(temp)
+            else:
+                spilled.append(temp)
+            continue
+        if free:
+            free.sort()
+            assigned[temp] = free.pop(0)
+        else:
+            assigned[temp] = next_register
+            next_register += 1
+        active.append(temp)
+
+    # Spill slots are packed the same way, with no limit on their number
+    slots = {}
+    if spilled:
+        slots = linear_scan(dict((temp, intervals[temp]) for temp in spilled))[0]
+    return assigned, slots
+
+class FunctionAllocation:
+
+    def __init__(self, name, temps, peak, registers, spill_slots, spilled):
+        self.name = name
+        self.temps = temps
+        self.peak = peak
+        self.registers = registers
+        self.spill_slots = spill_slots
+        self.spilled = spilled
+
+class RegisterAllocator:
+
+    def __init__(self, registers=None):
+        if registers is not None and registers < 1:
+            raise ValueError("at least one register is needed")
+        self.registers = registers
+        self.functions = []
+
+    def allocate(self, instructions, variables=()):
+        # variables are the source variables spelled like temps
+        allocated = []
+        for function in cfg.split_functions(instructions):
+            allocated.extend(self.allocate_function(function, variables))
+        return allocated
+
+    def allocate_function(self, instructions, variables=()):
+        intervals = live_intervals(instructions, variables)
+        assigned, slots = linear_scan(intervals, self.registers)
+
+        registers = register_names(
+            max(assigned.values()) if assigned else 0, variables)
+        names = {}
+        for temp, register in assigned.items():
+            names[temp] = registers[register - 1]
+        for temp, slot in slots.items():
+            names[temp] = SPILL_PREFIX + str(slot)
+
+        name = instructions[0].a if instructions[0].opcode == ir.ENTRY else None
+        self.functions.append(FunctionAllocation(
+            name, len(intervals), peak_live(intervals),
+            len(set(assigned.values())), len(set(slots.values())), len(slots)))
+
+        allocated = []
+        for instruction in instructions:
+            opcode = instruction.opcode
+            if temp_def(instruction, variables) is not None:
+                instruction = instruction._replace(dest=names[instruction.dest])
+            if opcode in BINARY:
+                instruction = instruction._replace(
+                    a=names.get(instruction.a, instruction.a),
+                    b=names.get(instruction.b, instruction.b))
+            elif opcode in READS_A:
+                instruction = instruction._replace(
+                    a=names.get(instruction.a, instruction.a))
+            allocated.append(instruction)
+        return allocated
+
+    def report(self):
+        lines = ["%-16s %8s %8s %10s %8s %8s" % (
+            "function", "temps", "peak", "registers", "spilled", "slots")]
+        for function in self.functions:
+            lines.append("%-16s %8d %8d %10d %8d %8d" % (
+                function.name, function.temps, function.peak,
+                function.registers, function.spilled, function.spill_slots))
+        return "\n".join(lines)
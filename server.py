@@ -0,0 +1,170 @@
+#! /usr/bin/env python3
+# A long-lived compile server, so that tools compiling many small files
+# do not pay for interpreter startup and lexer construction every time.
+#
+#   python3 server.py --socket /tmp/icg.sock -j 4
+#   python3 server.py --stdio
+#   python client.py --socket /tmp/icg.sock file.c
+#
+# Requests and responses are JSON objects, one per line:
+#
+#   {"id": 1, "path": "/abs/path/file.c", "pratt": false}
+#   {"id": 2, "source": "int main(void) { ... }"}
+#   {"id": 1, "ir": "entry main ..."}
+#   {"id": 2, "error": "ValueError: unexpected character '$' at ..."}
+#
+# Requests are compiled by a pool of worker processes that build their
+# lexer once, and answered as they complete, so a response can overtake an
+# earlier request; "id" is echoed back to match them. The number of
+# requests in flight is bounded, past it the server stops reading until
+# a worker is free.
+from __future__ import print_function
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import signal
+import sys
+
+import batch
+import client
+import icg
+
+# Requests in flight per worker
+QUEUE_DEPTH = 2
+
+def compile_request(source, pratt):
+    # Runs in a worker process set up by batch.init_worker
+    if pratt:
+        generator_class = icg.PrattCodeGenerator
+    else:
+        generator_class = icg.IntermediateCodeGenerator
+    compile_cache = batch.worker["cache"]
+    if compile_cache is not None:
+        return compile_cache.compile(source, batch.worker["lexer"],
+                                     generator_class)
+    return icg.compile_source(source, batch.worker["lexer"],
+                              generator_class).text()
+
+class CompileServer:
+
+    def __init__(self, jobs=None, compiled_lexer=False, cache_dir=None):
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.jobs, initializer=batch.init_worker,
+            initargs=(compiled_lexer, False, cache_dir))
+        # Start the workers before there is any socket for them to inherit:
+        # a worker forked while a connection is open would keep it open
+        # after the server closes it, and the client would never see EOF
+        self.executor.submit(compile_request, "", False).result()
+        self.slots = None
+
+    async def handle(self, line, write):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            if "source" in request:
+                source = request["source"]
+            else:
+                with open(request["path"]) as fhandle:
+                    source = fhandle.read()
+            ir = await asyncio.get_running_loop().run_in_executor(
+                self.executor, compile_request, source,
+                bool(request.get("pratt")))
+            response = {"id": request_id, "ir": ir}
+        except Exception as error:
+            response = {"id": request_id,
+                        "error": "%s: %s" % (type(error).__name__, error)}
+        finally:
+            self.slots.release()
+        write((json.dumps(response) + "\n").encode("utf-8"))
+
+    async def serve_stream(self, reader, write):
+        # Compile every request read from reader, answering through write
+        tasks = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            await self.slots.acquire()
+            task = asyncio.ensure_future(self.handle(line.decode("utf-8"), write))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def serve_connection(self, reader, writer):
+        try:
+            await self.serve_stream(reader, writer.write)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve_unix(self, path):
+        self.slots = asyncio.Semaphore(self.jobs * QUEUE_DEPTH)
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.serve_connection, path)
+        stopped = asyncio.get_running_loop().create_future()
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, stopped.set_result, None)
+        try:
+            await stopped
+        finally:
+            server.close()
+            os.remove(path)
+
+    async def serve_stdio(self):
+        self.slots = asyncio.Semaphore(self.jobs * QUEUE_DEPTH)
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+        def write(data):
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+        await self.serve_stream(reader, write)
+
+    def close(self):
+        self.executor.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="c-minus compile server")
+    parser.add_argument("--socket", default=None,
+                        help="Unix socket to listen on (default: $ICG_SERVER "
+                             "or server.sock in the cache directory)")
+    parser.add_argument("--stdio", action="store_true",
+                        help="read requests from stdin and answer on stdout")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--compiled-lexer", action="store_true",
+                        help="lex with the precompiled dense DFA tables")
+    parser.add_argument("--cache-dir",
+                        help="share a compile cache in this directory")
+
+    args = parser.parse_args(argv)
+    socket_path = args.socket or client.default_socket()
+
+    server = CompileServer(args.jobs, args.compiled_lexer, args.cache_dir)
+    try:
+        if args.stdio:
+            asyncio.run(server.serve_stdio())
+        else:
+            directory = os.path.dirname(socket_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            asyncio.run(server.serve_unix(socket_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
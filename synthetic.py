@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+# Seeded generator of valid c-minus programs for benchmarks.
+#
+#   python synthetic.py --functions 100 --expression 20 --seed 1 > big.c
+#
+# Every size can be scaled on its own:
+#
+#   functions    number of functions
+#   statements   statements in the body of every function
+#   depth        nesting depth of the if/while statement that starts every
+#                function body
+#   expression   binary operators in every expression
+#   fan_out      parameters of every function, and arguments of every call
+#
+# Functions only call the functions defined before them and loops are not
+# guaranteed to end: the programs are meant to be compiled, not run. The
+# same seed and sizes always give the same program.
+from __future__ import print_function
+import argparse
+import random
+
+AXES = ("functions", "statements", "depth", "expression", "fan_out")
+
+OPERATORS = ("+", "-", "*", "/", "<", ">", "==")
+
+LOCALS = 3
+
+class ProgramGenerator:
+
+    def __init__(self, seed=0, functions=10, statements=10, depth=2,
+                 expression=4, fan_out=2):
+        self.rng = random.Random(seed)
+        self.functions = functions
+        self.statements = statements
+        self.depth = depth
+        self.expression = expression
+        self.fan_out = fan_out
+
+    def generate(self):
+        return "".join(self.function(i) for i in range(self.functions))
+
+    def function(self, index):
+        params = ["p%d" % i for i in range(self.fan_out)]
+        self.index = index
+        self.variables = params + ["v%d" % i for i in range(LOCALS)]
+        lines = ["int f%d(%s)" % (index, ", ".join("int " + param for param in params)
+                                   or "void"),
+                 "{"]
+        lines.extend("  int v%d;" % i for i in range(LOCALS))
+        body = []
+        if self.depth:
+            self.nested(body, self.depth, 1)
+        for _ in range(self.statements - (1 if self.depth else 0)):
+            self.statement(body, 1)
+        lines.extend(body)
+        lines.append("  return %s;" % self.expr())
+        lines.append("}")
+        return "\n".join(lines) + "\n\n"
+
+    def nested(self, lines, depth, indent):
+        # An if or while holding an assignment and the next level, iterative
+        # so deep nesting does not recurse here
+        closing = []
+        for level in range(depth):
+            pad = "  " * (indent + level)
+            keyword = self.rng.choice(("if", "while"))
+            lines.append("%s%s (%s) {" % (pad, keyword, self.expr()))
+            lines.append("%s  %s" % (pad, self.assignment()))
+            closing.append(pad)
+        for pad in reversed(closing):
+            lines.append(pad + "}")
+
+    def statement(self, lines, indent):
+        pad = "  " * indent
+        choice = self.rng.random()
+        if choice < 0.6:
+            lines.append(pad + self.assignment())
+        elif choice < 0.7:
+            lines.append("%swrite(%s);" % (pad, self.expr()))
+        elif choice < 0.8:
+            lines.append("%s%s = read();" % (pad, self.rng.choice(self.variables)))
+        elif choice < 0.9:
+            lines.append("%sif (%s) %s else %s" % (pad, self.expr(),
+                                                  self.assignment(),
+                                                  self.assignment()))
+        else:
+            lines.append("%swhile (%s) %s" % (pad, self.expr(), self.assignment()))
+
+    def assignment(self):
+        return "%s = %s;" % (self.rng.choice(self.variables), self.expr())
+
+    def operand(self):
+        rng = self.rng
+        choice = rng.random()
+        if choice < 0.1 and self.index > 0:
+            return "f%d(%s)" % (rng.randrange(self.index),
+                                ", ".join(self.atom() for _ in range(self.fan_out)))
+        elif choice < 0.2:
+            return "(%s %s %s)" % (self.atom(), rng.choice(OPERATORS), self.atom())
+        return self.atom()
+
+    def atom(self):
+        if self.rng.random() < 0.3:
+            return str(self.rng.randrange(1, 100))
+        return self.rng.choice(self.variables)
+
+    def expr(self):
+        parts = [self.operand()]
+        for _ in range(self.expression):
+            parts.append(self.rng.choice(OPERATORS))
+            parts.append(self.operand())
+        return " ".join(parts)
+
+def generate(seed=0, **sizes):
+    return ProgramGenerator(seed, **sizes).generate()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Write a random c-minus program to stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    defaults = ProgramGenerator()
+    for axis in AXES:
+        parser.add_argument("--" + axis.replace("_", "-"), dest=axis, type=int,
+                            default=getattr(defaults, axis))
+    args = parser.parse_args()
+    print(generate(args.seed, **dict((axis, getattr(args, axis)) for axis in AXES)),
+          end="")
@@ -0,0 +1,40 @@
+# The iterative generator gives the same code as the recursive one, and
+# its code for sources nested far beyond the recursion limit computes
+# what the source does
+import pytest
+
+import bench
+import icg
+import vm
+
+# Depth at which the recursive generator still works, and the depth of
+# the programs that are run
+CHECK_DEPTH = 100
+DEPTH = 100000
+
+LEXER = icg.CompiledLexer(icg.TRANSITIONS_MAP)
+
+SHAPE_NAMES = [name for name, build, value in bench.NESTED_SHAPES]
+
+@pytest.mark.parametrize("name, build, value", bench.NESTED_SHAPES,
+                         ids=SHAPE_NAMES)
+def test_iterative_matches_recursive(name, build, value):
+    source = bench.nested_program(build(CHECK_DEPTH))
+    expected = icg.compile_source(source, LEXER).text()
+    assert icg.compile_source(source, LEXER,
+                              icg.IterativeCodeGenerator).text() == expected
+
+@pytest.mark.parametrize("name, build, value", bench.NESTED_SHAPES,
+                         ids=SHAPE_NAMES)
+def test_deep_nesting_runs(name, build, value):
+    buffer = icg.compile_source(bench.nested_program(build(DEPTH)), LEXER,
+                                icg.IterativeCodeGenerator)
+    assert vm.VM(buffer).run() == value(DEPTH)
+
+def test_nested_calls_and_assignments_run():
+    # The nested calls of f add DEPTH to 1 and the chained assignment
+    # adds one more
+    source = bench.NESTED_CALLS_SOURCE % ("f(" * DEPTH, ")" * DEPTH,
+                                          "x = " * DEPTH)
+    buffer = icg.compile_source(source, LEXER, icg.IterativeCodeGenerator)
+    assert vm.VM(buffer).run() == DEPTH + 2
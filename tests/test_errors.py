@@ -0,0 +1,60 @@
+# A source that fails to compile is reported, and does not break the good
+# sources compiled after it by the same worker, which keeps its lexer
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import batch
+import icg
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BAD_SOURCE = "void main(void)\n{ int x;\n  x = 3$;\n}\n"
+
+with open(os.path.join(REPOSITORY, "example.c")) as fhandle:
+    GOOD_SOURCE = fhandle.read()
+
+EXPECTED = icg.compile_source(
+    GOOD_SOURCE, icg.LexicalAnalyzer(icg.TRANSITIONS_MAP)).text()
+
+LEXERS = pytest.mark.parametrize("compiled_lexer", (False, True),
+                                 ids=("fsm", "compiled"))
+
+@LEXERS
+def test_batch_compiles_after_an_error(tmp_path, compiled_lexer):
+    bad_path, good_path = str(tmp_path / "bad.c"), str(tmp_path / "good.c")
+    for path, source in ((bad_path, BAD_SOURCE), (good_path, GOOD_SOURCE)):
+        with open(path, "w") as fhandle:
+            fhandle.write(source)
+    results = list(batch.run_batch([bad_path, good_path, good_path], 1,
+                                   compiled_lexer))
+    assert results[0][2].startswith("ValueError")
+    assert [(text, error) for _, text, error, _, _ in results[1:]] == \
+        [(EXPECTED, None)] * 2
+
+def server_outcomes(sources, compiled_lexer):
+    # Compile sources in order on a one worker server.py --stdio
+    argv = [sys.executable, os.path.join(REPOSITORY, "server.py"), "--stdio",
+            "-j", "1"]
+    if compiled_lexer:
+        argv.append("--compiled-lexer")
+    requests = "".join(json.dumps({"id": i, "source": source}) + "\n"
+                       for i, source in enumerate(sources))
+    process = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    stdout, _ = process.communicate(requests)
+    outcomes = [None] * len(sources)
+    for line in stdout.splitlines():
+        response = json.loads(line)
+        outcomes[response["id"]] = response.get("error") or response["ir"]
+    return outcomes
+
+@LEXERS
+def test_server_compiles_after_an_error(compiled_lexer):
+    outcomes = server_outcomes([BAD_SOURCE, GOOD_SOURCE, GOOD_SOURCE],
+                               compiled_lexer)
+    assert outcomes[0].startswith("ValueError")
+    assert outcomes[1:] == [EXPECTED] * 2
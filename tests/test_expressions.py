@@ -0,0 +1,18 @@
+# The linear postfix reduction of expand_simple_expression gives the same
+# code as the quadratic one it replaced, for long and deeply nested
+# expressions
+import random
+
+import pytest
+
+import bench
+import icg
+
+@pytest.mark.parametrize("build", (bench.long_expression,
+                                   bench.nested_expression))
+@pytest.mark.parametrize("size", (1, 10, 1000, 3000))
+def test_postfix_matches_quadratic_reduction(build, size):
+    source = bench.expression_program(build(size, random.Random(size)))
+    text = bench.generate(icg.IntermediateCodeGenerator, source)[0]
+    expected = bench.generate(bench.QuadraticPostfixGenerator, source)[0]
+    assert text == expected
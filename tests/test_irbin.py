@@ -0,0 +1,46 @@
+# The binary IR reads back the same instructions and signatures as the
+# buffer it was written from, whole, lazily and one function at a time
+import pytest
+
+import icg
+import ir
+import irbin
+import synthetic
+
+FUNCTIONS = 30
+
+@pytest.fixture(scope="module")
+def written(tmp_path_factory):
+    source = synthetic.generate(0, functions=FUNCTIONS)
+    buffer = icg.compile_source(source, icg.CompiledLexer(icg.TRANSITIONS_MAP))
+    path = str(tmp_path_factory.mktemp("irbin") / "program.irb")
+    irbin.write(buffer, path)
+    return buffer, path
+
+def test_load_matches_text(written):
+    buffer, path = written
+    with open(path + ".ir", "w") as fhandle:
+        buffer.write(fhandle)
+    with open(path + ".ir") as fhandle:
+        parsed = icg.IRBuffer.parse(fhandle)
+    loaded = irbin.load(path)
+    assert loaded.text() == parsed.text() == buffer.text()
+    assert loaded.signatures == buffer.signatures
+
+def test_lazy_reading(written):
+    buffer, path = written
+    with irbin.BinaryIR(path) as reader:
+        assert len(reader) == len(buffer)
+        assert list(reader) == list(buffer)
+        assert reader.signatures == buffer.signatures
+
+def test_one_function(written):
+    buffer, path = written
+    instructions = list(buffer)
+    name = "f%d" % (FUNCTIONS // 2)
+    first = [i for i, instruction in enumerate(instructions)
+             if instruction.opcode == ir.ENTRY and instruction.a == name][0]
+    with irbin.BinaryIR(path) as reader:
+        function = reader.function(name)
+    assert function[-1].opcode == ir.EXIT
+    assert function == instructions[first:first + len(function)]
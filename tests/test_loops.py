@@ -0,0 +1,30 @@
+# Loop-invariant code motion and strength reduction keep the result of
+# nested loops and leave fewer multiplies to execute
+import pytest
+
+import bench
+import icg
+import ir
+import loops
+import optimize
+import vm
+
+N = 20
+
+def executed_multiplies(machine, counts):
+    return sum(count for pc, count in enumerate(counts)
+               if machine.instructions[machine.positions[pc]].opcode == ir.MUL)
+
+@pytest.mark.parametrize("level", sorted(optimize.LEVELS))
+def test_loops_keep_the_result(level):
+    unoptimized = icg.compile_source(bench.LOOPS_SOURCE % N,
+                                     icg.LexicalAnalyzer(icg.TRANSITIONS_MAP))
+    expected = sum(i * N + j * 4 + (N - 1) * (N + 1) // 2
+                   for i in range(N) for j in range(N))
+    multiplies = []
+    for buffer in (unoptimized, loops.optimize_loops(unoptimized)):
+        machine = vm.VM(optimize.Optimizer(level).optimize(buffer))
+        result, counts = machine.run_counted()
+        assert result == expected
+        multiplies.append(executed_multiplies(machine, counts))
+    assert multiplies[1] < multiplies[0]
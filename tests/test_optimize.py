@@ -0,0 +1,52 @@
+# Source variables spelled like temps (t<n>) keep their names and are
+# not taken for the temps of the same number by the passes that tell
+# temps from variables
+import pytest
+
+import icg
+import inline
+import loops
+import optimize
+import regalloc
+import vm
+from ir import IRBuffer
+
+SOURCE = """int f(int t2)
+{ int t1;
+  t1 = t2 * 3;
+  return t1 + 1;
+}
+
+int main(void)
+{ int t3;
+  int x;
+  t3 = 5;
+  x = t3 + 2;
+  t3 = f(x);
+  return t3;
+}
+"""
+
+def compile_source():
+    return icg.compile_source(SOURCE, icg.LexicalAnalyzer(icg.TRANSITIONS_MAP))
+
+def test_variables_keep_their_names():
+    buffer = compile_source()
+    assert buffer.variables_like_temps == set(("t1", "t2", "t3"))
+    assert buffer.signatures["f"] == ("t2",)
+    assert "t1 = " in buffer.text()
+
+@pytest.mark.parametrize("registers", (None, 1))
+@pytest.mark.parametrize("level", sorted(optimize.LEVELS))
+def test_passes_keep_variables_like_temps(level, registers):
+    buffer = optimize.Optimizer(level).optimize(compile_source())
+    allocator = regalloc.RegisterAllocator(registers)
+    buffer = IRBuffer.from_instructions(
+        allocator.allocate(list(buffer), buffer.variables_like_temps),
+        buffer.signatures, buffer.variables_like_temps)
+    assert vm.VM(buffer).run() == 22
+
+def test_inline_and_loops_keep_variables_like_temps():
+    buffer = inline.Inliner(inline.DEFAULT_MAX_SIZE).inline(compile_source())
+    buffer = loops.LoopOptimizer().optimize(buffer)
+    assert vm.VM(optimize.Optimizer(2).optimize(buffer)).run() == 22
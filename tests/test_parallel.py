@@ -0,0 +1,28 @@
+# Code generated for the functions of one file on several processes is
+# the same as the code of a serial compile
+import pytest
+
+import bench
+import icg
+import parallel
+
+# With variables spelled like temps, which the partitions must pass on
+SOURCE = bench.synthetic_source(200) + """
+int g(int t1)
+{ int t2;
+  t2 = t1 * 2;
+  return t2 + 1;
+}
+"""
+
+@pytest.mark.parametrize("compiled_lexer", (False, True),
+                         ids=("fsm", "compiled"))
+@pytest.mark.parametrize("jobs", (1, 2, 4))
+def test_parallel_matches_serial(jobs, compiled_lexer):
+    expected = icg.compile_source(SOURCE,
+                                  icg.LexicalAnalyzer(icg.TRANSITIONS_MAP))
+    ir = parallel.compile_parallel(SOURCE, jobs, compiled_lexer)
+    assert ir.text() == expected.text()
+    assert ir.signatures == expected.signatures
+    assert ir.variables_like_temps == expected.variables_like_temps == \
+        set(("t1", "t2"))
@@ -0,0 +1,53 @@
+# Streaming compiles hold one function at a time: the code of a function
+# is written out at its exit, with its signature, and long functions are
+# flushed on the way without losing theirs
+import io
+
+import pytest
+
+import bench
+import cfg
+import icg
+from ir import IRBuffer
+
+class RecordingBuffer(IRBuffer):
+    # Records the most instructions held at once, and the signatures held
+    # at the end of every function
+
+    def __init__(self, sink, flush_size=None):
+        IRBuffer.__init__(self, sink, flush_size)
+        self.most_instructions = 0
+        self.ended = []
+
+    def flush(self):
+        self.most_instructions = max(self.most_instructions, len(self))
+        IRBuffer.flush(self)
+
+    def end_function(self):
+        self.ended.append(sorted(self.signatures))
+        IRBuffer.end_function(self)
+
+def stream(path, flush_size=None):
+    sink = io.StringIO()
+    buffer = RecordingBuffer(sink, flush_size)
+    tokens = icg.CompiledLexer(icg.TRANSITIONS_MAP).tokenize(
+        icg.read_chunks(path))
+    icg.IntermediateCodeGenerator(tokens, buffer).generate_code()
+    return sink.getvalue(), buffer
+
+@pytest.mark.parametrize("flush_size", (None, 3))
+def test_stream_holds_one_function(tmp_path, flush_size):
+    source = bench.synthetic_source(300)
+    path = str(tmp_path / "functions.c")
+    with open(path, "w") as fhandle:
+        fhandle.write(source)
+    expected = icg.compile_source(source,
+                                  icg.LexicalAnalyzer(icg.TRANSITIONS_MAP))
+    functions = cfg.split_functions(list(expected))
+
+    text, buffer = stream(path, flush_size)
+    assert text == expected.text()
+    assert buffer.most_instructions <= (
+        flush_size or max(len(function) for function in functions))
+    assert buffer.ended == [[function[0].a] for function in functions]
+    assert not buffer.signatures
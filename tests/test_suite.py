@@ -0,0 +1,52 @@
+# The synthetic programs of the benchmark suite, and how the suite finds
+# regressions against a baseline
+import pytest
+
+import bench
+import icg
+import synthetic
+
+def suite_results(exponent, **metrics):
+    run = {"size": 40, "tokens_per_second": 1000.0,
+           "lines_per_second": 1000.0, "peak_kb": 100}
+    run.update(metrics)
+    return {"axes": {"functions": {"exponent": exponent, "runs": [run]}}}
+
+@pytest.mark.parametrize("axis", synthetic.AXES)
+def test_synthetic_programs_compile(axis):
+    sizes = dict(bench.SUITE_SIZES)
+    sizes[axis] *= 2
+    source = synthetic.generate(1, **sizes)
+    assert source == synthetic.generate(1, **sizes)
+    expected = icg.compile_source(
+        source, icg.LexicalAnalyzer(icg.TRANSITIONS_MAP)).text()
+    assert expected
+    assert icg.compile_source(source, icg.CompiledLexer(icg.TRANSITIONS_MAP),
+                              icg.IterativeCodeGenerator).text() == expected
+
+def test_scaling_exponent():
+    sizes = [1, 2, 4, 8]
+    assert bench.scaling_exponent(sizes, [size * 0.5 for size in sizes]) \
+        == pytest.approx(1)
+    assert bench.scaling_exponent(sizes, [size ** 2 for size in sizes]) \
+        == pytest.approx(2)
+
+def test_regressions_within_threshold():
+    baseline = suite_results(1.0)
+    results = suite_results(1.2, tokens_per_second=800.0, peak_kb=120)
+    assert bench.regressions(results, baseline, 0.25) == []
+
+def test_regressions_in_both_directions():
+    baseline = suite_results(1.0)
+    results = suite_results(1.5, lines_per_second=500.0, peak_kb=200)
+    found = bench.regressions(results, baseline, 0.25)
+    assert [regression.split(":")[0] for regression in found] == [
+        "functions exponent", "functions=40 lines_per_second",
+        "functions=40 peak_kb"]
+
+def test_regressions_skip_what_the_baseline_lacks():
+    baseline = {"axes": {"depth": suite_results(1.0)["axes"]["functions"]}}
+    assert bench.regressions(suite_results(3.0), baseline, 0.25) == []
+    baseline = suite_results(1.0, size=80)
+    assert bench.regressions(suite_results(1.0, tokens_per_second=1.0),
+                             baseline, 0.25) == []
@@ -0,0 +1,19 @@
+# The interpreter computes what the source does, at every optimization
+# level
+import math
+
+import pytest
+
+import bench
+import icg
+import optimize
+import vm
+
+ITERATIONS, N = 50, 8
+
+@pytest.mark.parametrize("level", sorted(optimize.LEVELS))
+def test_fact_at_every_level(level):
+    source = bench.FACT_SOURCE % (ITERATIONS, N)
+    buffer = optimize.Optimizer(level).optimize(icg.compile_source(
+        source, icg.LexicalAnalyzer(icg.TRANSITIONS_MAP)))
+    assert vm.VM(buffer).run() == ITERATIONS * (math.factorial(N) // 1000)
@@ -0,0 +1,397 @@
+#! /usr/bin/env python
+# Interpreter for the intermediate code.
+#
+#   python vm.py program.c [-O2] [--input 5 3] [--profile]
+#
+# A VM turns an IRBuffer into one array of instruction handlers for
+# all its functions, built through a table of handler factories indexed by
+# opcode. Each handler is a closure over its operands that updates the
+# variables of the running function and returns the index of the next
+# instruction, so labels cost nothing at run time: jumps go straight to
+# the instruction after the label, which is left out of the array.
+#
+# Variables live in a dict per call. It starts as a copy of a template
+# holding 0 for every variable of the function and the value of every
+# constant under its own text, so "t1 = x + 3" is env["x"] + env["3"].
+# Calls and returns use an explicit stack, so deep recursion in the
+# program does not recurse in Python.
+#
+# Semantics: values are Python ints, / truncates toward zero like C,
+# relational operators give 1 or 0, locals start at 0 and a call with
+# fewer arguments than parameters leaves the others at 0. begin_args
+# opens a new argument list, param appends to the innermost one and call
+# takes it.
+from __future__ import print_function
+import argparse
+import sys
+
+import ir
+from optimize import BINARY, READS_A, is_constant
+
+# Handlers return these instead of an instruction index to call a
+# function or return from one
+CALL = -1
+RETURN = -2
+
+class VMError(Exception):
+    pass
+
+def make_nop(vm, instruction, next_pc, target):
+    def nop(env):
+        return next_pc
+    return nop
+
+def make_goto(vm, instruction, next_pc, target):
+    def goto(env):
+        return target
+    return goto
+
+def make_if_false(vm, instruction, next_pc, target):
+    condition = instruction.a
+    def if_false(env):
+        if env[condition]:
+            return next_pc
+        return target
+    return if_false
+
+def make_copy(vm, instruction, next_pc, target):
+    dest, a = instruction.dest, instruction.a
+    def copy(env):
+        env[dest] = env[a]
+        return next_pc
+    return copy
+
+def make_add(vm, instruction, next_pc, target):
+    dest, a, b = instruction.dest, instruction.a, instruction.b
+    def add(env):
+        env[dest] = env[a] + env[b]
+        return next_pc
+    return add
+
+def make_sub(vm, instruction, next_pc, target):
+    dest, a, b = instruction.dest, instruction.a, instruction.b
+    def sub(env):
+        env[dest] = env[a] - env[b]
+        return next_pc
+    return sub
+
+def make_mul(vm, instruction, next_pc, target):
+    dest, a, b = instruction.dest, instruction.a, instruction.b
+    def mul(env):
+        env[dest] = env[a] * env[b]
+        return next_pc
+    return mul
+
+def make_div(vm, instruction, next_pc, target):
+    dest, a, b = instruction.dest, instruction.a, instruction.b
+    def div(env):
+        divisor = env[b]
+        if not divisor:
+            raise VMError("division by zero")
+        dividend = env[a]
+        quotient = abs(dividend) // abs(divisor)
+        env[dest] = quotient if (dividend < 0) == (divisor < 0) else -quotient
+        return next_pc
+    return div
+
+def make_lt(vm, instruction, next_pc, target):
+    dest, a, b = instruction.dest, instruction.a, instruction.b
+    def lt(env):
+        env[dest] = 1 if env[a] < env[b] else 0
+        return next_pc
+    return lt
+
+def make_gt(vm, instruction, next_pc, target):
+    dest, a, b = instruction.dest, instruction.a, instruction.b
+    def gt(env):
+        env[dest] = 1 if env[a] > env[b] else 0
+        return next_pc
+    return gt
+
+def make_eq(vm, instruction, next_pc, target):
+    dest, a, b = instruction.dest, instruction.a, instruction.b
+    def eq(env):
+        env[dest] = 1 if env[a] == env[b] else 0
+        return next_pc
+    return eq
+
+def make_begin_args(vm, instruction, next_pc, target):
+    arg_lists = vm.arg_lists
+    def begin_args(env):
+        arg_lists.append([])
+        return next_pc
+    return begin_args
+
+def make_param(vm, instruction, next_pc, target):
+    arg_lists, a = vm.arg_lists, instruction.a
+    def param(env):
+        arg_lists[-1].append(env[a])
+        return next_pc
+    return param
+
+def make_call(vm, instruction, next_pc, target):
+    arg_lists = vm.arg_lists
+    call_state = (instruction.a, instruction.dest, next_pc)
+    def call(env):
+        vm.call_state = call_state
+        vm.call_args = arg_lists.pop() if arg_lists else []
+        return CALL
+    return call
+
+def make_return(vm, instruction, next_pc, target):
+    a = instruction.a
+    def return_(env):
+        vm.result = env[a] if a is not None else 0
+        return RETURN
+    return return_
+
+def make_exit(vm, instruction, next_pc, target):
+    def exit_(env):
+        vm.result = 0
+        return RETURN
+    return exit_
+
+def make_read(vm, instruction, next_pc, target):
+    dest = instruction.dest
+    def read(env):
+        env[dest] = vm.read()
+        return next_pc
+    return read
+
+def make_write(vm, instruction, next_pc, target):
+    a = instruction.a
+    def write(env):
+        vm.write(env[a])
+        return next_pc
+    return write
+
+HANDLER_FACTORIES = {
+    ir.ENTRY: make_nop,
+    ir.EXIT: make_exit,
+    ir.RETURN: make_return,
+    ir.GOTO: make_goto,
+    ir.IF_FALSE: make_if_false,
+    ir.BEGIN_ARGS: make_begin_args,
+    ir.PARAM: make_param,
+    ir.READ: make_read,
+    ir.WRITE: make_write,
+    ir.CALL: make_call,
+    ir.COPY: make_copy,
+    ir.ADD: make_add,
+    ir.SUB: make_sub,
+    ir.MUL: make_mul,
+    ir.DIV: make_div,
+    ir.LT: make_lt,
+    ir.GT: make_gt,
+    ir.EQ: make_eq,
+}
+
+class Function:
+
+    def __init__(self, name, entry, params, template):
+        self.name = name
+        self.entry = entry
+        self.params = params
+        self.template = template
+
+class VM:
+
+    def __init__(self, buffer, inputs=(), output=None):
+        self.inputs = iter(inputs)
+        self.output = output
+        self.arg_lists = []
+        self.call_state = None
+        self.call_args = None
+        self.result = 0
+        self.load(buffer)
+
+    def load(self, buffer):
+        instructions = list(buffer)
+        signatures = buffer.signatures
+
+        # Labels are left out of the code, so first find the index every
+        # instruction and label will have
+        indexes = []
+        labels = {}
+        index = 0
+        for instruction in instructions:
+            indexes.append(index)
+            if instruction.opcode == ir.LABEL:
+                labels[instruction.a] = index
+            else:
+                index += 1
+
+        self.code = []
+        # Index in instructions of every handler, for reports
+        self.positions = []
+        self.functions = {}
+        function = None
+        for position, instruction in enumerate(instructions):
+            opcode = instruction.opcode
+            if opcode == ir.ENTRY:
+                if instruction.a not in signatures:
+                    raise VMError("no signature for function %s" % instruction.a)
+                function = Function(instruction.a, indexes[position],
+                                    signatures[instruction.a], {})
+                self.functions[instruction.a] = function
+                for param in function.params:
+                    function.template[param] = 0
+            elif opcode == ir.LABEL:
+                continue
+
+            if function is not None:
+                operands = [instruction.dest]
+                if opcode in BINARY:
+                    operands.extend((instruction.a, instruction.b))
+                elif opcode in READS_A:
+                    operands.append(instruction.a)
+                for operand in operands:
+                    if operand is not None:
+                        function.template[operand] = \
+                            int(operand) if is_constant(operand) else 0
+
+            target = None
+            if opcode == ir.GOTO:
+                target = labels[instruction.a]
+            elif opcode == ir.IF_FALSE:
+                target = labels[instruction.b]
+            self.code.append(HANDLER_FACTORIES[opcode](
+                self, instruction, len(self.code) + 1, target))
+            self.positions.append(position)
+        self.instructions = instructions
+
+    def read(self):
+        try:
+            return next(self.inputs)
+        except StopIteration:
+            raise VMError("read past the end of the input")
+
+    def write(self, value):
+        if self.output is None:
+            print(value)
+        else:
+            self.output.append(value)
+
+    def enter(self, name, args):
+        function = self.functions.get(name)
+        if function is None:
+            raise VMError("call to undefined function %s" % name)
+        env = function.template.copy()
+        for param, value in zip(function.params, args):
+            env[param] = value
+        return function.entry, env
+
+    def run(self, name="main", args=()):
+        # Run function name and return its result
+        code = self.code
+        stack = []
+        pc, env = self.enter(name, args)
+        while True:
+            pc = code[pc](env)
+            if pc < 0:
+                if pc == CALL:
+                    function, dest, return_pc = self.call_state
+                    stack.append((return_pc, env, dest))
+                    pc, env = self.enter(function, self.call_args)
+                else:
+                    if not stack:
+                        return self.result
+                    pc, env, dest = stack.pop()
+                    env[dest] = self.result
+
+    def run_counted(self, name="main", args=()):
+        # Like run, but also count how often every instruction runs.
+        # Returns the result and the counts, indexed like self.code.
+        code = self.code
+        counts = [0] * len(code)
+        stack = []
+        pc, env = self.enter(name, args)
+        while True:
+            counts[pc] += 1
+            pc = code[pc](env)
+            if pc < 0:
+                if pc == CALL:
+                    function, dest, return_pc = self.call_state
+                    stack.append((return_pc, env, dest))
+                    pc, env = self.enter(function, self.call_args)
+                else:
+                    if not stack:
+                        return self.result, counts
+                    pc, env, dest = stack.pop()
+                    env[dest] = self.result
+
+    def hot_spots(self, counts, limit=20):
+        # The most executed instructions as (count, text) pairs
+        ranked = sorted(range(len(counts)), key=lambda pc: -counts[pc])
+        return [(counts[pc], ir.format_instruction(
+                     self.instructions[self.positions[pc]]._replace(indent=0)).rstrip())
+                for pc in ranked[:limit] if counts[pc]]
+
+def main(argv=None):
+    import time
+    import icg
+    import inline
+    import loops
+    import optimize
+    import regalloc
+
+    parser = argparse.ArgumentParser(
+        description="Compile a c-minus program and run its intermediate code")
+    parser.add_argument("source_file")
+    parser.add_argument("--input", type=int, nargs="*", default=[],
+                        help="values returned by read, in order")
+    parser.add_argument("-O", dest="optimize", type=int, default=0,
+                        choices=(0, 1, 2))
+    parser.add_argument("--inline", action="store_true",
+                        help="inline small functions and turn tail calls "
+                             "into loops before -O")
+    parser.add_argument("--loops", action="store_true",
+                        help="optimize loops after --inline and before -O")
+    parser.add_argument("--registers", type=int, metavar="N",
+                        help="reuse temps with at most N registers")
+    parser.add_argument("--entry", default="main",
+                        help="function to run (default: main)")
+    parser.add_argument("--args", type=int, nargs="*", default=[],
+                        help="arguments of the function run")
+    parser.add_argument("--profile", action="store_true",
+                        help="count executed instructions and print the most "
+                             "executed ones to stderr")
+    args = parser.parse_args(argv)
+    if args.registers is not None and args.registers < 1:
+        parser.error("--registers needs at least 1 register")
+
+    with open(args.source_file) as fhandle:
+        source = fhandle.read()
+    buffer = icg.compile_source(source, icg.LexicalAnalyzer(icg.TRANSITIONS_MAP))
+    if args.inline:
+        buffer = inline.inline(buffer)
+    if args.loops:
+        buffer = loops.optimize_loops(buffer)
+    if args.optimize:
+        buffer = optimize.Optimizer(args.optimize).optimize(buffer)
+    if args.registers is not None:
+        buffer = ir.IRBuffer.from_instructions(
+            regalloc.RegisterAllocator(args.registers).allocate(
+                list(buffer), buffer.variables_like_temps),
+            buffer.signatures, buffer.variables_like_temps)
+
+    vm = VM(buffer, args.input)
+    start = time.time()
+    if args.profile:
+        result, counts = vm.run_counted(args.entry, args.args)
+    else:
+        result = vm.run(args.entry, args.args)
+    elapsed = time.time() - start
+
+    if args.profile:
+        executed = sum(counts)
+        print("%d instructions in %.3f s, %.0f per second"
+              % (executed, elapsed, executed / elapsed if elapsed else 0),
+              file=sys.stderr)
+        for count, text in vm.hot_spots(counts):
+            print("%12d  %s" % (count, text), file=sys.stderr)
+    return result
+
+if __name__ == '__main__':
+    result = main()
+    sys.exit(result if isinstance(result, int) and 0 <= result < 256 else 0)